@@ -451,7 +451,7 @@ const initSaveVersionBtns = function () {
             };
             let msgGen = function (isSuccess, response) {
                 return isSuccess ?
-                    'History saved successfully' :
+                    'History is being saved. It can be downloaded once it is no longer pending' :
                     `Something's wrong, server says ${response}. Version not saved.`;
             };
             postRequest({
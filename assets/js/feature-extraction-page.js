@@ -24,6 +24,7 @@ const switchRecreateSubmitBtns = function (dmExists) {
     if (dmExists) {
         scheduleBtn.parent().hide();
         recreateBtn.parent().show();
+        $('#force-section').show();
 
         scheduleBtn.prop('disabled', true);
         recreateBtn.prop('disabled', false);
@@ -32,6 +33,7 @@ const switchRecreateSubmitBtns = function (dmExists) {
     else {
         scheduleBtn.parent().show();
         recreateBtn.parent().hide();
+        $('#force-section').hide();
 
         scheduleBtn.prop('disabled', false);
         recreateBtn.prop('disabled', true);
@@ -5,6 +5,7 @@ require('slickgrid/slick.formatters');
 
 import {isNull, getValue, isEmpty, isValidDate, PAGE_CAPACITY} from './utils';
 import {SelectizeEditor} from './selectize-formatter';
+import {getSpectUrl, requestSpectUrl} from './spect-packs';
 
 export const editabilityAwareFormatter = function (row, cell, value, columnDef, item) {
     if (isNull(value)) {
@@ -86,6 +87,42 @@ const ImageFormatter = function (row, cell, imgUrl) {
     return `<img src="${imgUrl}" height="100%"/>`;
 };
 
+const SPECT_MAX_RETRIES = 5;
+const SPECT_RETRY_DELAY = 2000;
+
+/**
+ * Spectrograms of newly saved segments are rendered in the background, so their images might not exist yet when the
+ * grid is drawn. Show a placeholder and retry a few times before giving up.
+ * @param img the <img> element that failed to load
+ */
+window.onSpectError = function (img) {
+    let $img = $(img);
+    let retries = parseInt($img.attr('retries') || 0);
+    $img.addClass('spect-pending');
+    if (retries >= SPECT_MAX_RETRIES) {
+        img.onerror = null;
+        return;
+    }
+    $img.attr('retries', retries + 1);
+
+    // Spectrograms loaded from a pack that fail to show are retried from their own file
+    let src = $img.attr('fallback-src');
+    setTimeout(function () {
+        $img.attr('src', `${src}?retry=${retries + 1}`);
+    }, SPECT_RETRY_DELAY * (retries + 1));
+};
+
+window.onSpectLoad = function (img) {
+    $(img).removeClass('spect-pending');
+};
+
+const spectImg = function (id, tid) {
+    let src = requestSpectUrl(tid);
+    let srcAttr = src === null ? 'class="spect-pending"' : `src="${src}"`;
+    return `<img seg-id="${id}" spect-tid="${tid}" ${srcAttr} fallback-src="${getSpectUrl(tid)}" height="100%" ` +
+        'onerror="onSpectError(this)" onload="onSpectLoad(this)"/>';
+};
+
 /**
  * Render one or many images given the id or array of ids of the spectrograms
  * spetrogram images are located at /user_data/spect/syllable/<page>/<ID>.png
@@ -95,10 +132,7 @@ const ImageFormatter = function (row, cell, imgUrl) {
 const SpectsFormatter = function (row, cell, idsTids) {
     let retval = '';
     $.each(idsTids, function (idx, idsTid) {
-        let id = idsTid[0];
-        let tid = idsTid[1];
-        let page = Math.floor(tid / PAGE_CAPACITY);
-        retval += `<img seg-id="${id}" src="/user_data/spect/syllable/${page}/${tid}.png" height="100%"/>`;
+        retval += spectImg(idsTid[0], idsTid[1]);
     });
     return retval;
 };
@@ -111,8 +145,7 @@ const SpectsFormatter = function (row, cell, idsTids) {
  * @constructor
  */
 const SpectFormatter = function (row, cell, value, columnDef, dataContext) {
-    let page = Math.floor(value / PAGE_CAPACITY);
-    return `<img seg-id="${dataContext.id}" src="/user_data/spect/syllable/${page}/${value}.png" height="100%"/>`;
+    return spectImg(dataContext.id, value);
 };
 
 
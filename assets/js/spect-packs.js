@@ -0,0 +1,269 @@
+/**
+ * Load syllable spectrograms from their page's pack (see koe/spect_packs.py) instead of one request per image.
+ * The index at the front of a pack is read first, then all spectrograms requested from the same page in one go are
+ * read with one range request and turned into object URLs.
+ * If the server doesn't support range requests the whole pack is downloaded once and reused.
+ * Spectrograms that are not in the pack (e.g. just created) are loaded from their own PNG file.
+ * Packs are rebuilt when their spectrograms change. A pack's version is its ETag (or Last-Modified). Each page is
+ * checked again once its pack is older than PACK_REVALIDATE_INTERVAL, and spectrograms loaded from an older version
+ * are reloaded.
+ */
+
+import {getCache, PAGE_CAPACITY} from './utils';
+
+const PACK_MAGIC = 'KOESPK01';
+const PACK_PREFIX_SIZE = 12;
+const PACK_ENTRY_SIZE = 12;
+const PACK_INDEX_MAX_SIZE = PACK_PREFIX_SIZE + PACK_ENTRY_SIZE * PAGE_CAPACITY;
+const PACK_REVALIDATE_INTERVAL = 60 * 1000;
+
+// page -> {promise, loadedAt}. The promise resolves to {index, buffer, version} or to null if the page doesn't have a
+// pack
+const packs = {};
+
+// tid -> {url, page, version}: object URL of a spectrogram that has been loaded from a pack, and that pack's version
+const spectUrls = {};
+
+// page -> tids requested but not yet loaded
+let pendingTids = {};
+let loadScheduled = false;
+
+
+export const getSpectUrl = function (tid) {
+    let page = Math.floor(tid / PAGE_CAPACITY);
+    return `/user_data/spect/syllable/${page}/${tid}.png`;
+};
+
+
+const getPackUrl = function (page) {
+    return `/user_data/spect/syllable/${page}.pack`;
+};
+
+
+/**
+ * Request bytes [start, end] of a file.
+ * @returns {Promise} resolves to {status, buffer, version} or to null if the request failed
+ */
+const rangeRequest = function (url, start, end) {
+    return new Promise(function (resolve) {
+        let req = new XMLHttpRequest();
+        req.open('GET', url, true);
+        req.responseType = 'arraybuffer';
+        req.setRequestHeader('Range', `bytes=${start}-${end}`);
+
+        // Packs are rebuilt in place, so always revalidate
+        req.setRequestHeader('Cache-Control', 'no-cache');
+
+        req.onload = function () {
+            if (req.status === 200 || req.status === 206) {
+                let version = req.getResponseHeader('ETag') || req.getResponseHeader('Last-Modified');
+                resolve({status: req.status, buffer: req.response, version});
+            }
+            else {
+                resolve(null);
+            }
+        };
+        req.onerror = function () {
+            resolve(null);
+        };
+        req.send(null);
+    });
+};
+
+
+/**
+ * @param buffer ArrayBuffer starting at the beginning of the pack
+ * @returns {*} dict tid -> [offset, length] or null if this isn't a pack
+ */
+const parseIndex = function (buffer) {
+    if (buffer.byteLength < PACK_PREFIX_SIZE) {
+        return null;
+    }
+    let magic = String.fromCharCode.apply(null, new Uint8Array(buffer, 0, PACK_MAGIC.length));
+    if (magic !== PACK_MAGIC) {
+        return null;
+    }
+
+    let view = new DataView(buffer);
+    let count = view.getUint32(PACK_MAGIC.length, true);
+    let index = {};
+    for (let i = 0; i < count; i++) {
+        let entryOffset = PACK_PREFIX_SIZE + i * PACK_ENTRY_SIZE;
+        let tid = view.getUint32(entryOffset, true);
+        index[tid] = [view.getUint32(entryOffset + 4, true), view.getUint32(entryOffset + 8, true)];
+    }
+    return index;
+};
+
+
+/**
+ * Get the pack of a page, requesting its index again if the one loaded is older than PACK_REVALIDATE_INTERVAL
+ * @returns {Promise} resolves to {index, buffer, version} or to null if the page doesn't have a pack
+ */
+const loadPack = function (page) {
+    let pack = packs[page];
+    if (pack !== undefined && Date.now() - pack.loadedAt < PACK_REVALIDATE_INTERVAL) {
+        return pack.promise;
+    }
+
+    let promise = rangeRequest(getPackUrl(page), 0, PACK_INDEX_MAX_SIZE - 1).then(function (response) {
+        let index = response === null ? null : parseIndex(response.buffer);
+        if (index === null) {
+            reloadChangedSpects(page, null);
+            return null;
+        }
+
+        // The range has been ignored and the whole pack downloaded: keep it to read the spectrograms from
+        let buffer = response.status === 200 ? response.buffer : null;
+        reloadChangedSpects(page, response.version);
+        return {index, buffer, version: response.version};
+    });
+    packs[page] = {promise, loadedAt: Date.now()};
+    return promise;
+};
+
+
+/**
+ * Forget the spectrograms of this page that were loaded from a different version of its pack and load them again
+ * @param page
+ * @param version version of the pack now, null if the page doesn't have a pack
+ */
+const reloadChangedSpects = function (page, version) {
+    let changedTids = [];
+    $.each(spectUrls, function (tid, spect) {
+        if (spect.page === page && spect.version !== version) {
+            URL.revokeObjectURL(spect.url);
+            changedTids.push(parseInt(tid));
+        }
+    });
+    if (changedTids.length > 0) {
+        $.each(changedTids, function (idx, tid) {
+            delete spectUrls[tid];
+        });
+        loadFromPack(page, changedTids);
+    }
+};
+
+
+const setSpectSrc = function (tid, url) {
+    $(`img[spect-tid="${tid}"]`).attr('src', url);
+};
+
+
+/**
+ * Load spectrograms of one page from its pack and show them
+ * @param page
+ * @param tids
+ * @param retried true if this is a second attempt after the pack changed while being read
+ */
+const loadFromPack = function (page, tids, retried = false) {
+    loadPack(page).then(function (pack) {
+        let packedTids = [];
+        $.each(tids, function (idx, tid) {
+            if (pack !== null && pack.index[tid] !== undefined) {
+                packedTids.push(tid);
+            }
+            else {
+                setSpectSrc(tid, getSpectUrl(tid));
+            }
+        });
+
+        if (packedTids.length === 0) {
+            return;
+        }
+
+        let start = Infinity;
+        let end = 0;
+        $.each(packedTids, function (idx, tid) {
+            let [offset, length] = pack.index[tid];
+            start = Math.min(start, offset);
+            end = Math.max(end, offset + length);
+        });
+
+        let dataPromise;
+        if (pack.buffer === null) {
+            dataPromise = rangeRequest(getPackUrl(page), start, end - 1).then(function (response) {
+                if (response === null) {
+                    return null;
+                }
+                if (response.version !== pack.version) {
+                    return {changed: true};
+                }
+                return {buffer: response.buffer, bufferStart: response.status === 206 ? start : 0};
+            });
+        }
+        else {
+            dataPromise = Promise.resolve({buffer: pack.buffer, bufferStart: 0});
+        }
+
+        dataPromise.then(function (data) {
+            // The pack has been rebuilt since its index was read, so the offsets are no longer right
+            if (data !== null && data.changed) {
+                if (retried) {
+                    data = null;
+                }
+                else {
+                    delete packs[page];
+                    loadFromPack(page, packedTids, true);
+                    return;
+                }
+            }
+
+            $.each(packedTids, function (idx, tid) {
+                if (data === null) {
+                    setSpectSrc(tid, getSpectUrl(tid));
+                    return;
+                }
+                let [offset, length] = pack.index[tid];
+                let bytes = new Uint8Array(data.buffer, offset - data.bufferStart, length);
+                let url = URL.createObjectURL(new Blob([bytes], {type: 'image/png'}));
+                spectUrls[tid] = {url, page, version: pack.version};
+                setSpectSrc(tid, url);
+            });
+        });
+    });
+};
+
+
+const loadPendingSpects = function () {
+    let tidsByPage = pendingTids;
+    pendingTids = {};
+    loadScheduled = false;
+
+    $.each(tidsByPage, function (page, tids) {
+        loadFromPack(parseInt(page), tids);
+    });
+};
+
+
+/**
+ * Get the URL of a spectrogram to show straight away. If packs are enabled and this spectrogram hasn't been loaded
+ * yet, it's queued to be loaded together with all others requested in the same rendering pass, and null is returned.
+ * Once loaded, the src of all <img spect-tid="tid"> is set.
+ * @param tid
+ * @returns {*} URL or null
+ */
+export const requestSpectUrl = function (tid) {
+    if (!getCache('settings', 'spectPacks')) {
+        return getSpectUrl(tid);
+    }
+
+    let page = Math.floor(tid / PAGE_CAPACITY);
+    let spect = spectUrls[tid];
+    if (spect !== undefined) {
+        // Shown straight away, and replaced if the pack turns out to have changed
+        loadPack(page);
+        return spect.url;
+    }
+
+    if (pendingTids[page] === undefined) {
+        pendingTids[page] = [];
+    }
+    pendingTids[page].push(tid);
+
+    if (!loadScheduled) {
+        loadScheduled = true;
+        setTimeout(loadPendingSpects, 0);
+    }
+    return null;
+};
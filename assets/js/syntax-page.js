@@ -8,7 +8,7 @@ import {queryAndPlayAudio, changePlaybackSpeed} from './audio-handler';
 import {updateSlickGridData} from './grid-utils';
 import {FlexibleGrid, defaultGridOptions} from './flexible-grid';
 import {getUrl, getCache, setCache, isEmpty, logError, debug, deepCopy, pdist, argsort, isNumber, isNull, normalise,
-    PAGE_CAPACITY
+    PAGE_CAPACITY, decodeColumnarMetadata
 } from './utils';
 import {downloadRequest, postRequest, createSpinner} from './ajax-handler';
 import {constructSelectizeOptionsForLabellings, initSelectize} from './selectize-formatter';
@@ -710,11 +710,7 @@ const downloadTensorData = function () {
             ind2label[ind] = label;
         });
 
-        let metaRows = meta.split('\n');
-        let csvHeaderRow = metaRows[0];
-        let csvBodyRows = metaRows.slice(2);
-
-        let columnNames = csvHeaderRow.split('\t');
+        let {columnNames, rows: metaRows} = decodeColumnarMetadata(JSON.parse(meta));
 
         for (let i = 0; i < columnNames.length; i++) {
             let columnName = columnNames[i];
@@ -722,8 +718,8 @@ const downloadTensorData = function () {
             columnsMap[columnName] = i;
         }
 
-        for (let rowIdx = 0; rowIdx < csvBodyRows.length; rowIdx++) {
-            let csvRow = csvBodyRows[rowIdx].split('\t');
+        for (let rowIdx = 0; rowIdx < metaRows.length; rowIdx++) {
+            let csvRow = metaRows[rowIdx];
             let rowMetadata = makeMetadata(columnNames, csvRow);
             rowsMetadata.push(rowMetadata);
 
@@ -741,10 +737,10 @@ const downloadTensorData = function () {
             }
         }
 
-        let ncols = bytes.length / csvBodyRows.length;
+        let ncols = bytes.length / metaRows.length;
         let byteStart = 0;
         let byteEnd = ncols;
-        for (let i = 0; i < csvBodyRows.length; i++) {
+        for (let i = 0; i < metaRows.length; i++) {
             dataMatrix.push(Array.from(bytes.slice(byteStart, byteEnd)));
             byteStart += ncols;
             byteEnd += ncols;
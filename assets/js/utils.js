@@ -1054,3 +1054,23 @@ export function indicesOf(arr, val) {
     }
     return indices;
 }
+
+
+/**
+ * Turn columnar metadata (see write_metadata_columns in koe/ts_utils.py) back into rows
+ * @param meta parsed JSON of format {headers, ids, tids, columns: [{values, indices}]}
+ * @returns {{columnNames: Array, rows: Array}} each row is an array of strings, in the order of columnNames
+ */
+export function decodeColumnarMetadata(meta) {
+    let nRows = meta.ids.length;
+    let rows = [];
+    for (let i = 0; i < nRows; i++) {
+        let row = [String(meta.ids[i]), String(meta.tids[i])];
+        for (let j = 0; j < meta.columns.length; j++) {
+            let column = meta.columns[j];
+            row.push(column.values[column.indices[i]]);
+        }
+        rows.push(row);
+    }
+    return {columnNames: meta.headers, rows};
+}
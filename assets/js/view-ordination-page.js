@@ -3,7 +3,8 @@ require('bootstrap-slider/dist/bootstrap-slider.js');
 require('jquery.scrollintoview/jquery.scrollintoview.js');
 
 import {queryAndPlayAudio, changePlaybackSpeed} from './audio-handler';
-import {getUrl, getCache, setCache, isEmpty, logError, PAGE_CAPACITY} from './utils';
+import {getUrl, getCache, setCache, isEmpty, logError, PAGE_CAPACITY,
+    decodeColumnarMetadata} from './utils';
 import {downloadRequest, postRequest, createSpinner} from './ajax-handler';
 import {constructSelectizeOptionsForLabellings, initSelectize} from './selectize-formatter';
 
@@ -639,11 +640,7 @@ const downloadTensorData = function () {
         let meta = values[0];
         let bytes = values[1];
 
-        let metaRows = meta.split('\n');
-        let csvHeaderRow = metaRows[0];
-        let csvBodyRows = metaRows.slice(2);
-
-        let columnNames = csvHeaderRow.split('\t');
+        let {columnNames, rows: metaRows} = decodeColumnarMetadata(JSON.parse(meta));
 
         for (let i = 0; i < columnNames.length; i++) {
             let columnName = columnNames[i];
@@ -651,8 +648,8 @@ const downloadTensorData = function () {
             columnsMap[columnName] = i;
         }
 
-        for (let rowIdx = 0; rowIdx < csvBodyRows.length; rowIdx++) {
-            let csvRow = csvBodyRows[rowIdx].split('\t');
+        for (let rowIdx = 0; rowIdx < metaRows.length; rowIdx++) {
+            let csvRow = metaRows[rowIdx];
             let rowMetadata = makeMetadata(columnNames, csvRow);
             rowsMetadata.push(rowMetadata);
 
@@ -670,10 +667,10 @@ const downloadTensorData = function () {
             }
         }
 
-        let ncols = bytes.length / csvBodyRows.length;
+        let ncols = bytes.length / metaRows.length;
         let byteStart = 0;
         let byteEnd = ncols;
-        for (let i = 0; i < csvBodyRows.length; i++) {
+        for (let i = 0; i < metaRows.length; i++) {
             dataMatrix.push(Array.from(bytes.slice(byteStart, byteEnd)));
             byteStart += ncols;
             byteEnd += ncols;
@@ -82,11 +82,109 @@ def xcorr_chirp(feature, seg_feature_value, args):
     return retval
 
 
+def make_ragged_batch(arrs):
+    """
+    Concatenate feature values of many segments along their last (time) axis.
+    All arrays must have the same number of dimensions and, if two dimensional, the same number of rows
+    :param arrs: list of 1D or 2D arrays
+    :return: values and offsets such that arrs[i] == values[..., offsets[i]:offsets[i + 1]]
+    """
+    lengths = np.array([arr.shape[-1] for arr in arrs], dtype=np.int64)
+    offsets = np.zeros((len(arrs) + 1,), dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate(arrs, axis=-1)
+    return values, offsets
+
+
+def _segment_lengths(offsets):
+    return np.diff(offsets)
+
+
+def _as_input_type(result, values):
+    if np.issubdtype(values.dtype, np.floating):
+        return result.astype(values.dtype)
+    return result
+
+
+def segment_sum(values, offsets):
+    return np.add.reduceat(values, offsets[:-1], axis=-1, dtype=np.float64)
+
+
+def segment_mean(values, offsets):
+    return _as_input_type(segment_sum(values, offsets) / _segment_lengths(offsets), values)
+
+
+def segment_var(values, offsets):
+    lengths = _segment_lengths(offsets)
+    means = segment_sum(values, offsets) / lengths
+    deviations = values - np.repeat(means, lengths, axis=-1)
+    return _as_input_type(np.add.reduceat(deviations**2, offsets[:-1], axis=-1) / lengths, values)
+
+
+def segment_std(values, offsets):
+    return _as_input_type(np.sqrt(segment_var(values, offsets).astype(np.float64)), values)
+
+
+def segment_min(values, offsets):
+    return np.minimum.reduceat(values, offsets[:-1], axis=-1)
+
+
+def segment_max(values, offsets):
+    return np.maximum.reduceat(values, offsets[:-1], axis=-1)
+
+
+def segment_first(values, offsets):
+    return values[..., offsets[:-1]]
+
+
+def segment_last(values, offsets):
+    return values[..., offsets[1:] - 1]
+
+
+def segment_median(values, offsets):
+    """
+    Lay the segments out in a (..., nsegs, longest length) array padded with the largest value, sort it along the
+    last axis and take the middle value(s) of each segment
+    """
+    lengths = _segment_lengths(offsets)
+    nsegs = len(lengths)
+    segment_ids = np.repeat(np.arange(nsegs), lengths)
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+
+    if np.issubdtype(values.dtype, np.floating):
+        padding = np.inf
+    else:
+        padding = np.iinfo(values.dtype).max
+    padded = np.full(values.shape[:-1] + (nsegs, lengths.max()), padding, dtype=values.dtype)
+    padded[..., segment_ids, positions] = values
+    padded.sort(axis=-1)
+
+    segment_inds = np.arange(nsegs)
+    lower_mids = padded[..., segment_inds, (lengths - 1) // 2].astype(np.float64)
+    upper_mids = padded[..., segment_inds, lengths // 2]
+    medians = (lower_mids + upper_mids) / 2
+
+    # np.median returns NaN if there is any NaN in the array
+    has_nan = np.add.reduceat(np.isnan(values), offsets[:-1], axis=-1) > 0
+    medians[has_nan] = np.nan
+    return _as_input_type(medians, values)
+
+
 class Aggregator(ABC):
     @abstractmethod
     def process(self, input, **kwargs):
         pass
 
+    def process_batch(self, values, offsets, **kwargs):
+        """
+        Aggregate feature values of many segments at once. By default this calls process() on each segment,
+        subclasses that can do better override this
+        :param values: feature values of all segments, concatenated along the last axis (see make_ragged_batch)
+        :param offsets: values[..., offsets[i]:offsets[i + 1]] are the values of the i-th segment
+        :return: aggregated values, one per segment, the same as process() returns for each segment
+        """
+        return [self.process(values[..., offsets[i] : offsets[i + 1]], **kwargs) for i in range(len(offsets) - 1)]
+
     @abstractmethod
     def get_name(self):
         pass
@@ -110,6 +208,13 @@ class StatsAggregator(Aggregator):
     def process(self, input, **kwargs):
         return self.method(input, axis=-1)
 
+    def process_batch(self, values, offsets, **kwargs):
+        segment_reduce = segment_reducers.get(self.method, None)
+        if segment_reduce is None or np.any(_segment_lengths(offsets) == 0):
+            return super(StatsAggregator, self).process_batch(values, offsets, **kwargs)
+
+        return np.moveaxis(segment_reduce(values, offsets), -1, 0)
+
     def is_chirpy(self):
         return False
 
@@ -163,6 +268,48 @@ class DivideConquer(Aggregator):
         divs = divide_conquer(input, self.ndivs)
         return np.array([self.method(div, axis=-1) for div in divs]).ravel()
 
+    def process_batch(self, values, offsets, **kwargs):
+        """
+        Turn every division of every segment into a segment of its own (the same divisions as divide_conquer makes,
+        including the upsampling of short segments), then reduce all of them at once
+        """
+        segment_reduce = segment_reducers.get(self.method, None)
+        lengths = _segment_lengths(offsets)
+        if segment_reduce is None or np.any(lengths == 0):
+            return super(DivideConquer, self).process_batch(values, offsets, **kwargs)
+
+        ndivs = self.ndivs
+        nsegs = len(lengths)
+
+        proper_lengths = np.where(lengths // ndivs >= 10, lengths, np.lcm(lengths, ndivs))
+        upsample_factors = proper_lengths // lengths
+        div_lens = proper_lengths / ndivs
+        div_inds = np.arange(ndivs)
+        div_starts = np.floor(div_inds[None, :] * div_lens[:, None]).astype(np.int64).ravel()
+        div_ends = np.ceil((div_inds[None, :] + 1) * div_lens[:, None]).astype(np.int64)
+        # Rounding errors can put the last end past the array, which slicing in divide_conquer silently ignores
+        div_ends = np.minimum(div_ends, proper_lengths[:, None]).ravel()
+
+        div_lengths = div_ends - div_starts
+        div_offsets = np.zeros((nsegs * ndivs + 1,), dtype=np.int64)
+        np.cumsum(div_lengths, out=div_offsets[1:])
+
+        # Index of each element of each division in the upsampled segment, then in the original values
+        div_segment_ids = np.repeat(np.arange(nsegs), ndivs)
+        positions = np.arange(div_offsets[-1]) - np.repeat(div_offsets[:-1], div_lengths)
+        upsampled_inds = np.repeat(div_starts, div_lengths) + positions
+        inds = np.repeat(offsets[:-1][div_segment_ids], div_lengths) + upsampled_inds // np.repeat(
+            upsample_factors[div_segment_ids], div_lengths
+        )
+
+        reduced = segment_reduce(values[..., inds], div_offsets)
+        if values.ndim == 1:
+            return reduced.reshape((nsegs, ndivs))
+
+        # Same order as the raveled (ndivs x nrows) array returned by process()
+        nrows = values.shape[0]
+        return reduced.reshape((nrows, nsegs, ndivs)).transpose(1, 2, 0).reshape((nsegs, ndivs * nrows))
+
     def is_chirpy(self):
         return False
 
@@ -206,6 +353,17 @@ def get_last(arr, axis):
     return np.take(arr, indices=-1, axis=axis)
 
 
+segment_reducers = {
+    np.mean: segment_mean,
+    np.median: segment_median,
+    np.std: segment_std,
+    np.min: segment_min,
+    np.max: segment_max,
+    np.var: segment_var,
+    get_first: segment_first,
+    get_last: segment_last,
+}
+
 enabled_aggregators = {
     "stats": [
         StatsAggregator(np.mean),
@@ -0,0 +1,132 @@
+"""
+How many syllables of a database each annotator has labelled, at each label level.
+Counted with one grouped query per database and cached, one cache entry per (database, annotator, label level) so
+that new labels can be added with an atomic increment (see koe.signals). The counts are recounted if the segments of
+the database change and expire after a day, so whatever the increments miss (e.g. labels removed) doesn't stay wrong
+"""
+
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from koe.models import Database, Segment
+from root.models import ExtraAttr, ExtraAttrValue
+
+
+label_levels = ["label", "label_family", "label_subfamily"]
+
+coverage_timeout = 60 * 60 * 24
+
+
+def _cache_key(database_id):
+    return "annotation-coverage-{}".format(database_id)
+
+
+def _count_key(database_id, generation, user_id, level):
+    return "annotation-coverage-{}-{}-{}-{}".format(database_id, generation, user_id, level)
+
+
+def _get_segments_signature(database_id):
+    stats = Segment.objects.filter(audio_file__database=database_id).aggregate(count=Count("id"), max_id=Max("id"))
+    return [stats["count"], stats["max_id"] or 0]
+
+
+def count_annotations(database_id):
+    """
+    :return: dict {user_id -> {label level -> number of syllables labelled}}. Users who have labelled nothing at
+             all are not included
+    """
+    attrs = ExtraAttr.objects.filter(klass=Segment.__name__, name__in=label_levels)
+    attr_id_to_name = {x: y for x, y in attrs.values_list("id", "name")}
+
+    syls = Segment.objects.filter(audio_file__database=database_id).values("id")
+    values = ExtraAttrValue.objects.filter(attr__in=list(attr_id_to_name.keys()), owner_id__in=syls)
+    counts = {}
+    for user_id, attr_id, count in values.values_list("user", "attr").annotate(count=Count("id")).order_by():
+        if user_id not in counts:
+            counts[user_id] = {level: 0 for level in label_levels}
+        counts[user_id][attr_id_to_name[attr_id]] = count
+    return counts
+
+
+def get_annotation_coverage(database, user_ids, refresh=False):
+    """
+    Get the number of syllables and the annotation counts of these users in a database, from cache if the database
+    hasn't gained or lost syllables since, otherwise count and cache them.
+    Each recount starts a new generation of count keys, so increments racing with it can't land in the new counts
+    :param user_ids: ids of the users to get the counts of
+    :param refresh: if True, recount regardless of the cache
+    :return: nsyls, dict {user_id -> {label level -> number of syllables labelled}}
+    """
+    signature = _get_segments_signature(database.id)
+    key = _cache_key(database.id)
+    cached = None if refresh else cache.get(key)
+
+    if cached is not None and cached["signature"] == signature:
+        generation = cached["generation"]
+        keys = {(x, y): _count_key(database.id, generation, x, y) for x in user_ids for y in label_levels}
+        cached_counts = cache.get_many(list(keys.values()))
+        if len(cached_counts) == len(keys):
+            counts = {x: {} for x in user_ids}
+            for (user_id, level), count_key in keys.items():
+                counts[user_id][level] = cached_counts[count_key]
+            return signature[0], counts
+
+    all_counts = count_annotations(database.id)
+    generation = uuid4().hex
+    counts = {x: all_counts.get(x, {y: 0 for y in label_levels}) for x in set(user_ids) | set(all_counts.keys())}
+    to_cache = {}
+    for user_id, user_counts in counts.items():
+        for level, count in user_counts.items():
+            to_cache[_count_key(database.id, generation, user_id, level)] = count
+    cache.set_many(to_cache, coverage_timeout)
+    cache.set(key, dict(signature=signature, generation=generation), coverage_timeout)
+
+    return signature[0], {x: counts[x] for x in user_ids}
+
+
+def get_annotation_percentages(database, annotators):
+    """
+    :return: dict {annotator -> {label level -> percentage of syllables labelled}}
+    """
+    nsyls, counts = get_annotation_coverage(database, [x.id for x in annotators])
+    retval = {}
+    for annotator in annotators:
+        retval[annotator] = {}
+        for level in label_levels:
+            if nsyls == 0:
+                retval[annotator][level] = 100
+            else:
+                retval[annotator][level] = counts[annotator.id][level] / nsyls * 100
+    return retval
+
+
+def add_annotations(attr, user, owner_ids):
+    """
+    Increment the cached counts after values of attr have been created for these segments. Counts that aren't
+    cached are left for the next recount
+    """
+    if attr.name not in label_levels or len(owner_ids) == 0:
+        return
+
+    segs = Segment.objects.filter(id__in=list(owner_ids))
+    for database_id, count in segs.values_list("audio_file__database").annotate(count=Count("id")).order_by():
+        cached = cache.get(_cache_key(database_id))
+        if cached is None:
+            continue
+        try:
+            cache.incr(_count_key(database_id, cached["generation"], user.id, attr.name), count)
+        except ValueError:
+            pass
+
+
+def invalidate_annotation_coverage(owner_ids=None):
+    """
+    Remove the cached counts of the databases of these segments, or of all databases if owner_ids is None
+    """
+    if owner_ids is None:
+        database_ids = Database.objects.values_list("id", flat=True)
+    else:
+        database_ids = Segment.objects.filter(id__in=list(owner_ids)).values_list("audio_file__database", flat=True)
+    cache.delete_many([_cache_key(x) for x in set(database_ids)])
@@ -0,0 +1,184 @@
+"""
+Size-bounded LRU cache for encoded audio (e.g. of segments being played)
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from root.utils import mkdirp
+
+
+class BytesLRUCache:
+    """
+    Keep the most recently used values (bytes) in memory, up to max_bytes in total.
+    If folder is given, values are also written there so that other processes (e.g. other uWSGI workers) can reuse
+    them. The folder is kept under folder_max_bytes by removing the least recently used files every now and then
+    """
+
+    def __init__(self, max_bytes, folder=None, folder_max_bytes=None, prune_every=100):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.folder_max_bytes = folder_max_bytes
+        self.prune_every = prune_every
+
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._nwrites = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if folder:
+            mkdirp(folder)
+
+    def _get_file_path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+    def _keep_in_memory(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            existing = self._items.pop(key, None)
+            if existing is not None:
+                self._nbytes -= len(existing)
+
+            self._items[key] = value
+            self._nbytes += len(value)
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._nbytes -= len(evicted)
+                self.evictions += 1
+
+    def _read_from_disk(self, key):
+        file_path = self._get_file_path(key)
+        try:
+            with open(file_path, "rb") as f:
+                value = f.read()
+            # Modification time is used to tell the least recently used files when pruning
+            os.utime(file_path)
+            return value
+        except OSError:
+            return None
+
+    def _write_to_disk(self, key, value):
+        file_path = self._get_file_path(key)
+        tmp_file_path = "{}.tmp.{}".format(file_path, uuid.uuid4().hex)
+        with open(tmp_file_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_file_path, file_path)
+
+        self._nwrites += 1
+        if self.folder_max_bytes is not None and self._nwrites % self.prune_every == 0:
+            self.prune_folder()
+
+    def prune_folder(self):
+        """
+        Remove the least recently used files until the folder is under folder_max_bytes
+        :return: number of files removed
+        """
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or ".tmp." in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        nremoved = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.folder_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            nremoved += 1
+        return nremoved
+
+    def get(self, key):
+        """
+        :return: the cached value or None
+        """
+        with self._lock:
+            value = self._items.get(key, None)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.folder:
+            value = self._read_from_disk(key)
+            if value is not None:
+                self.disk_hits += 1
+                self._keep_in_memory(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._keep_in_memory(key, value)
+        if self.folder:
+            self._write_to_disk(key, value)
+
+    def get_or_compute(self, key, compute, *args, **kwargs):
+        """
+        Return the cached value of key, or compute it by calling compute(*args, **kwargs), cache and return it
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute(*args, **kwargs)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            nitems = len(self._items)
+            nbytes = self._nbytes
+        return dict(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            items=nitems,
+            bytes=nbytes,
+            max_bytes=self.max_bytes,
+        )
+
+
+_segment_audio_cache = None
+
+
+def get_segment_audio_cache():
+    """
+    :return: the cache of encoded segment audio of this process, created on first use from the settings
+    """
+    global _segment_audio_cache
+    if _segment_audio_cache is None:
+        _segment_audio_cache = BytesLRUCache(
+            settings.SEGMENT_AUDIO_CACHE_MAX_BYTES,
+            settings.SEGMENT_AUDIO_CACHE_FOLDER,
+            settings.SEGMENT_AUDIO_CACHE_FOLDER_MAX_BYTES,
+        )
+    return _segment_audio_cache
@@ -0,0 +1,143 @@
+"""
+Store of pre-encoded audio clips of segments (volume normalised and compressed, ready to be played by the browser).
+Clips are addressed by a hash of everything that determines their content, so a clip never needs to be invalidated:
+a segment whose boundaries have changed simply gets a new clip.
+"""
+
+import hashlib
+import io
+import os
+import uuid
+
+from django.conf import settings
+
+import pydub
+from celery.utils.log import get_task_logger
+
+from koe import wavfile
+from koe.celery_init import app
+from koe.models import Segment
+from root.utils import data_path, ensure_parent_folder_exists
+
+
+celerylogger = get_task_logger(__name__)
+
+CLIP_LOUDNESS = -10
+CLIPS_FOLDER = "audio/clips"
+
+
+def match_target_amplitude(sound, loudness=CLIP_LOUDNESS):
+    """
+    Set the volume of an AudioSegment object to be a certain loudness
+    :param sound: an AudioSegment object
+    :param loudness: usually -10db is a good number
+    :return: the modified sound
+    """
+    change_in_dBFS = loudness - sound.dBFS
+    if change_in_dBFS > 0:
+        return sound.apply_gain(change_in_dBFS)
+    return sound
+
+
+def encode_segment_audio(audio_file_name, database_id, fs, start, end):
+    """
+    Read the segment from the original wav file, normalise its volume and compress it
+    :return: the encoded audio (bytes)
+    """
+    wav_file_path = data_path("audio/wav/{}".format(database_id), "{}.wav".format(audio_file_name))
+    chunk = wavfile.read_segment(wav_file_path, start, end, normalised=False, mono=True)
+
+    audio_segment = pydub.AudioSegment(chunk.tobytes(), frame_rate=fs, sample_width=chunk.dtype.itemsize, channels=1)
+
+    audio_segment = match_target_amplitude(audio_segment)
+
+    out = io.BytesIO()
+    audio_segment.export(out, format=settings.AUDIO_COMPRESSED_FORMAT)
+    binary_content = out.getvalue()
+    out.close()
+    return binary_content
+
+
+def get_clip_key(audio_file_name, database_id, fs, start, end):
+    return audio_file_name, database_id, fs, start, end, CLIP_LOUDNESS, settings.AUDIO_COMPRESSED_FORMAT
+
+
+def get_clip_path(clip_key):
+    digest = hashlib.sha1(repr(clip_key).encode("utf-8")).hexdigest()
+    clip_name = "{}.{}".format(digest, settings.AUDIO_COMPRESSED_FORMAT)
+    return data_path("{}/{}".format(CLIPS_FOLDER, digest[:2]), clip_name)
+
+
+def get_segments_clip_info(segments):
+    """
+    :param segments: a queryset of Segment
+    :return: a list of (segment id, (audio_file_name, database_id, fs, start, end)) - the arguments of
+             encode_segment_audio(). Audio of segments of a copied file is read from the original file
+    """
+    values = segments.values_list(
+        "id",
+        "audio_file__name",
+        "audio_file__database",
+        "audio_file__original__name",
+        "audio_file__original__database",
+        "audio_file__fs",
+        "start_time_ms",
+        "end_time_ms",
+    )
+
+    clips_info = []
+    for sid, name, database_id, original_name, original_database_id, fs, start, end in values:
+        if original_name is not None:
+            name = original_name
+            database_id = original_database_id
+        clips_info.append((sid, (name, database_id, fs, start, end)))
+    return clips_info
+
+
+def read_or_encode_clip(audio_file_name, database_id, fs, start, end):
+    """
+    Return the pre-encoded clip if it exists, otherwise encode it on the fly (without storing)
+    """
+    clip_path = get_clip_path(get_clip_key(audio_file_name, database_id, fs, start, end))
+    try:
+        with open(clip_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return encode_segment_audio(audio_file_name, database_id, fs, start, end)
+
+
+def store_clip(clip_path, binary_content):
+    ensure_parent_folder_exists(clip_path)
+    tmp_clip_path = "{}.tmp.{}".format(clip_path, uuid.uuid4().hex)
+    with open(tmp_clip_path, "wb") as f:
+        f.write(binary_content)
+    os.replace(tmp_clip_path, clip_path)
+
+
+def encode_clips(clips_info, force=False, bar=None):
+    """
+    Encode and store clips of many segments
+    :param clips_info: as returned by get_segments_clip_info()
+    :param force: re-encode clips that already exist
+    :param bar: a progress bar, optional
+    :return: number of clips encoded
+    """
+    nencoded = 0
+    for sid, clip_args in clips_info:
+        clip_path = get_clip_path(get_clip_key(*clip_args))
+        if force or not os.path.isfile(clip_path):
+            try:
+                store_clip(clip_path, encode_segment_audio(*clip_args))
+                nencoded += 1
+            except Exception as e:
+                celerylogger.warning("Unable to encode clip of segment #{}: {}".format(sid, e))
+        if bar:
+            bar.next()
+    return nencoded
+
+
+@app.task(bind=False)
+def encode_clips_async(segment_ids, *args, **kwargs):
+    segments = Segment.objects.filter(id__in=segment_ids)
+    nencoded = encode_clips(get_segments_clip_info(segments))
+    celerylogger.info("{} clips encoded".format(nencoded))
@@ -1,8 +1,7 @@
 """Provides an inteface to store and retrieve numpy arrays in binary file"""
 
-import datetime
 import os
-from shutil import copyfile
+from collections import OrderedDict
 
 import numpy as np
 
@@ -13,6 +12,15 @@ BATCH_SIZE = 1000
 INDEX_PREFIX = "index."
 VALUE_PREFIX = "value."
 
+# Prefixes of files being written by _write_atomically() and by compact(), before they are swapped into place
+TMP_PREFIX = "tmp."
+COMPACT_PREFIX = "compact."
+
+# Maximum number of parsed index files kept in memory (per process) by _read_index. Each is at most 20KB
+INDEX_CACHE_SIZE = 4096
+
+_index_cache = OrderedDict()
+
 
 def get_dim(arr):
     if np.isscalar(arr):
@@ -31,6 +39,28 @@ def reshape(dim0, dim1, arr):
     return arr.reshape((dim0, dim1))
 
 
+def _prefixed_filename(filename, prefix):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, prefix + basename)
+
+
+def _write_file(arr, filename, mode="wb"):
+    with open(filename, mode) as f:
+        arr.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_atomically(arr, filename):
+    """
+    Write arr to a temporary file then swap it in place of filename, so that readers - and the file left behind by a
+    crash - are always either the complete old or the complete new version
+    """
+    tmp_filename = _prefixed_filename(filename, TMP_PREFIX)
+    _write_file(arr, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
 def _store_anew(ids, arrs, index_filename, value_filename):
     assert isinstance(ids, np.ndarray)
     assert len(ids) > 0, "lists must be non-empty"
@@ -66,20 +96,17 @@ def _store_anew(ids, arrs, index_filename, value_filename):
     index_arr = np.array(index_arr, dtype=np.int32)
     value_arr = np.concatenate(value_arr).astype(np.float32)
 
-    with open(index_filename, "wb") as f:
-        index_arr.tofile(f)
-
-    with open(value_filename, "wb") as f:
-        value_arr.tofile(f)
+    # The index file is written last, so its existence guarantees that the value file is complete
+    _write_file(value_arr, value_filename)
+    _write_atomically(index_arr, index_filename)
 
     return index_filename, value_filename
 
 
 def _store(new_ids, new_arrs, index_filename, value_filename):
     """
-    If files don't exit, create new. Otherwise update existing
-    Append or update ids and array values in given files.
-    For now, just reload the file, add new ids, then rewrite it again
+    If files don't exit, create new. Otherwise append the arrays to the value file and swap in an updated index.
+    A value file without index is what's left by an interrupted creation, it is simply overwritten.
     :param new_ids: np.ndarray of IDs to append
     :param new_arrs: list of arrays to append
     :param index_filename:
@@ -88,17 +115,14 @@ def _store(new_ids, new_arrs, index_filename, value_filename):
     """
     index_file_exists = os.path.isfile(index_filename)
     value_file_exists = os.path.isfile(value_filename)
-    if index_file_exists and value_file_exists:
-        is_creating = False
-    elif not index_file_exists and not value_file_exists:
-        is_creating = True
-    else:
-        raise RuntimeError("Index and value files must either both exist or both not exist")
 
-    if is_creating:
+    if not index_file_exists:
         return _store_anew(new_ids, new_arrs, index_filename, value_filename)
 
-    return _update_by_modification(new_ids, new_arrs, index_filename, value_filename)
+    if not value_file_exists:
+        raise RuntimeError("Index file {} exists but its value file doesn't".format(index_filename))
+
+    return _update_by_appending(new_ids, new_arrs, index_filename, value_filename)
 
 
 def store(ids, arrs, loc):
@@ -148,25 +172,28 @@ def store(ids, arrs, loc):
         _store(ids_batch, arrs_batch, index_filename, value_filename)
 
 
-def _update_by_modification(new_ids, new_arrs, index_filename, value_filename):
-    with open(index_filename, "rb") as f:
-        index_arr = np.fromfile(f, dtype=np.int32)
-    index_arr = index_arr.reshape((-1, INDEX_FILE_NCOLS))
+def _update_by_appending(new_ids, new_arrs, index_filename, value_filename):
+    """
+    Values are only ever appended to the value file, even those that replace existing ones, then the index is
+    swapped atomically. Indexed values are therefore never overwritten: a crash leaves at most some unreferenced
+    bytes at the end of the value file, and memory-mapped readers keep seeing consistent data.
+    The space taken by replaced values and interrupted appends is reclaimed by compact()
+    """
+    index_arr, _, _ = _read_index(index_filename)
     index_arr = index_arr.tolist()
 
-    with open(value_filename, "rb") as f:
-        value_bin = np.fromfile(f, dtype=np.float32)
-
-    id2info = {}
     id2row_idx = {}
     for idx, (id, start, end, dim0, dim1) in enumerate(index_arr):
-        id2info[id] = (start, end, dim0, dim1)
         id2row_idx[id] = idx
 
-    to_update = {}
-    to_append = {}
+    # An interrupted append might have left a partial float at the end
+    value_file_size = os.path.getsize(value_filename)
+    padding = (-value_file_size) % 4
+    new_start = (value_file_size + padding) // 4
 
-    new_start = len(value_bin)
+    to_append = []
+    if padding:
+        to_append.append(np.zeros(padding, dtype=np.uint8))
 
     for new_id, new_arr in zip(new_ids, new_arrs):
         new_dim0, new_dim1 = get_dim(new_arr)
@@ -176,63 +203,58 @@ def _update_by_modification(new_ids, new_arrs, index_filename, value_filename):
             new_arr = np.array(new_arr, dtype=np.float32)
         new_len = np.size(new_arr)
 
-        if new_id in id2info:
-            start, end, dim0, dim1 = id2info[new_id]
-            old_len = end - start
-
-            # If the new array is smaller or same size: replace the data, not append
-            # In case it is smaller, there will be left-over, untrimmed freespace, which is fine
-            if new_len <= old_len:
-                end = start + new_len
-                to_update[new_id] = (start, end, new_dim0, new_dim1, new_arr)
-
-            # Otherwise we must append the updated data, leaving the old data unreferenced and untrimmed
-            else:
-                start = new_start
-                end = start + new_len
-                new_start += new_len
-                to_append[new_id] = (start, end, new_dim0, new_dim1, new_arr)
-
-            idx = id2row_idx[new_id]
-            index_arr[idx] = [new_id, start, end, new_dim0, new_dim1]
+        start = new_start
+        end = start + new_len
+        new_start = end
+        to_append.append(new_arr.ravel().view(np.uint8))
 
+        if new_id in id2row_idx:
+            index_arr[id2row_idx[new_id]] = [new_id, start, end, new_dim0, new_dim1]
         else:
-            start = new_start
-            end = start + new_len
-            new_start += new_len
-            to_append[new_id] = (start, end, new_dim0, new_dim1, new_arr)
             index_arr.append([new_id, start, end, new_dim0, new_dim1])
 
     index_arr = np.array(index_arr, dtype=np.int32)
 
-    # Make a backup before overwriting the file, then delete the backup if anything happens
-    time_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    bak_index_file = "{}.bak_{}".format(index_filename, time_str)
-    bak_value_file = "{}.bak_{}".format(value_filename, time_str)
+    _write_file(np.concatenate(to_append), value_filename, mode="ab")
+    _write_atomically(index_arr, index_filename)
 
-    copyfile(index_filename, bak_index_file)
-    copyfile(value_filename, bak_value_file)
 
-    try:
-        with open(index_filename, "wb") as f:
-            index_arr.tofile(f)
+def _read_index(index_filename):
+    """
+    Read and parse an index file, reusing the parsed arrays from a previous call if the file hasn't changed since
+    (same inode, modification time and size). The returned arrays are read-only as they are shared between calls
+    :param index_filename: path to the index file
+    :return: index_arr (N x INDEX_FILE_NCOLS), sorted_ids and sort_order (as returned by np.unique on the ids column)
+    """
+    stat = os.stat(index_filename)
+    signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    cached = _index_cache.get(index_filename, None)
+    if cached is not None and cached[0] == signature:
+        _index_cache.move_to_end(index_filename)
+        return cached[1:]
+
+    index_arr = np.fromfile(index_filename, dtype=np.int32).reshape((-1, INDEX_FILE_NCOLS))
+    sorted_ids, sort_order = np.unique(index_arr[:, 0], return_index=True)
+    for arr in (index_arr, sorted_ids, sort_order):
+        arr.flags.writeable = False
 
-        with open(value_filename, "r+b") as fid:
-            for id, (start, end, dim0, dim1, new_arr) in to_update.items():
-                fid.seek(start * 4)
-                new_arr.tofile(fid)
+    _index_cache[index_filename] = (signature, index_arr, sorted_ids, sort_order)
+    _index_cache.move_to_end(index_filename)
+    if len(_index_cache) > INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
 
-        with open(value_filename, "ab") as fid:
-            for id, (start, end, dim0, dim1, new_arr) in to_append.items():
-                new_arr.tofile(fid)
+    return index_arr, sorted_ids, sort_order
 
-    except Exception as e:
-        os.replace(bak_index_file, index_filename)
-        os.replace(bak_value_file, value_filename)
-        raise e
 
-    os.remove(bak_index_file)
-    os.remove(bak_value_file)
+def _read_values(value_filename, mmap):
+    """
+    :param mmap: True to memory-map the value file, so that only the pages that are actually accessed are read and
+                 slices of the returned array are views into the page cache. False to read the whole file to memory
+    """
+    if mmap and os.path.getsize(value_filename) > 0:
+        return np.memmap(value_filename, dtype=np.float32, mode="r")
+    return np.fromfile(value_filename, dtype=np.float32)
 
 
 def retrieve_ids(loc, limit=None):
@@ -275,7 +297,7 @@ def retrieve_ids(loc, limit=None):
         batch_begin, batch_end, index_file = batches[batch_begin]
 
         index_file_full_path = os.path.join(loc, index_file)
-        index_arr = np.fromfile(index_file_full_path, dtype=np.int32).reshape((-1, INDEX_FILE_NCOLS))
+        index_arr, _, _ = _read_index(index_file_full_path)
         ids_cols.append(index_arr[:, 0])
 
     if len(ids_cols):
@@ -284,14 +306,8 @@ def retrieve_ids(loc, limit=None):
         return np.array([], dtype=np.int32)
 
 
-def _retrieve(lookup_ids, index_filename, value_filename, flat=False):
-    with open(index_filename, "rb") as f:
-        index_arr = np.fromfile(f, dtype=np.int32)
-
-    index_arr = index_arr.reshape((-1, INDEX_FILE_NCOLS))
-
-    ids_cols = index_arr[:, 0]
-    sorted_ids, sort_order = np.unique(ids_cols, return_index=True)
+def _retrieve(lookup_ids, index_filename, value_filename, flat=False, mmap=False):
+    index_arr, sorted_ids, sort_order = _read_index(index_filename)
 
     non_existing_idx = np.where(np.logical_not(np.isin(lookup_ids, sorted_ids)))
     non_existing_ids = lookup_ids[non_existing_idx]
@@ -308,7 +324,7 @@ def _retrieve(lookup_ids, index_filename, value_filename, flat=False):
     sort_order_by_start = np.argsort(index_arr[lookup_ids_rows, 1])
     retval = [None] * len(lookup_ids)
 
-    value_arr = np.fromfile(value_filename, dtype=np.float32)
+    value_arr = _read_values(value_filename, mmap)
 
     for sorted_i in sort_order_by_start:
         lookup_row_ind = sort_order[lookup_ids_rows[sorted_i]]
@@ -323,7 +339,16 @@ def _retrieve(lookup_ids, index_filename, value_filename, flat=False):
     return retval
 
 
-def retrieve(lookup_ids, loc, flat=False):
+def retrieve(lookup_ids, loc, flat=False, mmap=False):
+    """
+    Retrieve the arrays of given IDs
+    :param lookup_ids: IDs to retrieve
+    :param loc: path to the storage folder
+    :param flat: True to return the arrays flattened, False to reshape them to their original shape
+    :param mmap: True to memory-map the value files and return read-only views instead of copies. Use this when only
+                 a few IDs of each batch are needed, or when the arrays are consumed (e.g. stacked) straight away
+    :return: list of arrays in the same order as lookup_ids
+    """
     if len(lookup_ids) == 0:
         return []
 
@@ -367,7 +392,7 @@ def retrieve(lookup_ids, loc, flat=False):
         value_filename = os.path.join(loc, "{}{}-{}".format(VALUE_PREFIX, batch_begin, batch_end))
 
         ids_batch = np.array(ids_batch, dtype=np.int32)
-        arr = _retrieve(ids_batch, index_filename, value_filename, flat)
+        arr = _retrieve(ids_batch, index_filename, value_filename, flat, mmap)
 
         for ind, value in zip(inds_batch, arr):
             arrs[ind] = value
@@ -404,3 +429,86 @@ def retrieve_raw(loc):
 
     ids = np.array(ids, dtype=np.int32)
     return ids, arrs
+
+
+def _compact_batch(index_filename, value_filename):
+    """
+    Rewrite one value file with only the values referenced by its index, then swap in the new value file and index
+    :return: number of bytes reclaimed
+    """
+    index_arr = np.fromfile(index_filename, dtype=np.int32).reshape((-1, INDEX_FILE_NCOLS))
+    value_file_size = os.path.getsize(value_filename)
+
+    # Keep the values in their current order on disk
+    index_arr = index_arr[np.argsort(index_arr[:, 1], kind="stable")]
+    lengths = index_arr[:, 2] - index_arr[:, 1]
+    used_size = int(np.sum(lengths)) * 4
+
+    if used_size == value_file_size:
+        return 0
+
+    value_arr = np.fromfile(value_filename, dtype=np.float32)
+    new_index_arr = index_arr.copy()
+    new_index_arr[:, 2] = np.cumsum(lengths)
+    new_index_arr[:, 1] = new_index_arr[:, 2] - lengths
+
+    if len(index_arr):
+        new_value_arr = np.concatenate([value_arr[begin:end] for _, begin, end, _, _ in index_arr])
+    else:
+        new_value_arr = np.empty((0,), dtype=np.float32)
+
+    compact_value_filename = _prefixed_filename(value_filename, COMPACT_PREFIX)
+    compact_index_filename = _prefixed_filename(index_filename, COMPACT_PREFIX)
+    _write_file(new_value_arr, compact_value_filename)
+    _write_file(new_index_arr, compact_index_filename)
+
+    # If interrupted between these two, the next compact() finishes the swap (see _finish_interrupted_compaction)
+    os.replace(compact_value_filename, value_filename)
+    os.replace(compact_index_filename, index_filename)
+
+    return value_file_size - used_size
+
+
+def _finish_interrupted_compaction(loc):
+    """
+    A compacted index without its compacted value file means the value file has already been swapped in place,
+    so the index must be swapped too. Any other leftover of compact() or _write_atomically() is discarded.
+    :return: number of bytes reclaimed by deleting leftovers
+    """
+    reclaimed = 0
+    filenames = os.listdir(loc)
+    for filename in filenames:
+        if not filename.startswith(COMPACT_PREFIX + INDEX_PREFIX):
+            continue
+        batch_part = filename[len(COMPACT_PREFIX + INDEX_PREFIX) :]
+        if COMPACT_PREFIX + VALUE_PREFIX + batch_part not in filenames:
+            os.replace(os.path.join(loc, filename), os.path.join(loc, INDEX_PREFIX + batch_part))
+
+    for filename in os.listdir(loc):
+        # .bak_ files are backups left by older versions of this module, which copied both files before each update
+        if filename.startswith(COMPACT_PREFIX) or filename.startswith(TMP_PREFIX) or ".bak_" in filename:
+            filepath = os.path.join(loc, filename)
+            if os.path.isfile(filepath):
+                reclaimed += os.path.getsize(filepath)
+                os.remove(filepath)
+
+    return reclaimed
+
+
+def compact(loc):
+    """
+    Reclaim the space of a storage folder that is taken by replaced values, interrupted writes and leftover files.
+    Must not run while the same folder is being written to.
+    :param loc: path to the storage folder
+    :return: number of bytes reclaimed
+    """
+    reclaimed = _finish_interrupted_compaction(loc)
+
+    index_files = [x for x in os.listdir(loc) if x.startswith(INDEX_PREFIX)]
+    for index_file in index_files:
+        batch_part = index_file[len(INDEX_PREFIX) :]
+        index_filename = os.path.join(loc, index_file)
+        value_filename = os.path.join(loc, VALUE_PREFIX + batch_part)
+        reclaimed += _compact_batch(index_filename, value_filename)
+
+    return reclaimed
@@ -73,7 +73,6 @@ def merge_labels(clusters, classes_info, sids, enum2label, class_name_merge_func
                                     of all its constituent class labels
     """
     sid_to_cluster_base_1 = {}
-    merged_enum2label_base1 = {}
     for current_class_idx, merged_class_idx in enumerate(clusters):
         merged_class_idx_base_1 = merged_class_idx + 1
 
@@ -82,6 +81,19 @@ def merge_labels(clusters, classes_info, sids, enum2label, class_name_merge_func
             sid = sids[sind]
             sid_to_cluster_base_1[sid] = merged_class_idx_base_1
 
+    merged_enum2label_base1 = merge_label_names(clusters, enum2label, class_name_merge_func)
+    return sid_to_cluster_base_1, merged_enum2label_base1
+
+
+def merge_label_names(clusters, enum2label, class_name_merge_func):
+    """
+    The label part of merge_labels
+    :return: merged_enum2label_base1 (see merge_labels)
+    """
+    merged_enum2label_base1 = {}
+    for current_class_idx, merged_class_idx in enumerate(clusters):
+        merged_class_idx_base_1 = merged_class_idx + 1
+
         current_class_label = enum2label[current_class_idx]
         if merged_class_idx_base_1 in merged_enum2label_base1:
             merged_enum2label_base1[merged_class_idx_base_1].append(current_class_label)
@@ -92,7 +104,31 @@ def merge_labels(clusters, classes_info, sids, enum2label, class_name_merge_func
         class_labels = merged_enum2label_base1[merged_class_idx]
         merged_enum2label_base1[merged_class_idx] = class_name_merge_func(class_labels)
 
-    return sid_to_cluster_base_1, merged_enum2label_base1
+    return merged_enum2label_base1
+
+
+def get_class_of_sids(sids, classes_info, nclasses, lookup_sids):
+    """
+    Vectorised version of the syllable part of merge_labels: rather than mapping sids to clusters again for each
+    clustering, find the class of each sid once, then the cluster of each sid is clusters[classes] + 1
+    :param lookup_sids: syllable IDs to find the class of
+    :return: int array of the class index of each of lookup_sids, -1 for those that are not in sids
+    """
+    sids = np.asarray(sids)
+    sid_classes = np.full(len(sids), -1, dtype=np.int64)
+    for class_idx in range(nclasses):
+        sid_classes[np.asarray(classes_info[class_idx], dtype=np.int64)] = class_idx
+
+    sort_order = np.argsort(sids)
+    sorted_sids = sids[sort_order]
+    lookup_sids = np.asarray(lookup_sids)
+    positions = np.searchsorted(sorted_sids, lookup_sids)
+    positions[positions == len(sorted_sids)] = 0
+    found = sorted_sids[positions] == lookup_sids if len(sorted_sids) else np.zeros(len(lookup_sids), dtype=bool)
+
+    retval = np.full(len(lookup_sids), -1, dtype=np.int64)
+    retval[found] = sid_classes[sort_order[positions[found]]]
+    return retval
 
 
 def get_syllable_labels(annotator, label_level, sids, on_no_label="warning"):
@@ -14,7 +14,7 @@ from sklearn.decomposition import PCA, FastICA
 from sklearn.manifold import MDS, TSNE
 
 from koe import binstorage3 as bs
-from koe.aggregator import aggregator_map
+from koe.aggregator import aggregator_map, make_ragged_batch
 from koe.celery_init import app
 from koe.features.feature_extract import feature_extractors
 from koe.model_utils import natural_order
@@ -30,14 +30,28 @@ from koe.models import (
 )
 from koe.storage_utils import get_storage_loc_template
 from koe.task import TaskRunner
-from koe.ts_utils import bytes_to_ndarray, get_rawdata_from_binary, ndarray_to_bytes
-from koe.utils import wav_path
+from koe.ts_utils import (
+    bytes_to_ndarray,
+    get_column_group_names,
+    get_rawdata_from_binary,
+    ndarray_to_bytes,
+)
+from koe.utils import wav_path, worker_pool
 from koe.wavfile import get_wav_info
 from root.exceptions import CustomAssertionError
 from root.utils import mkdirp
 
 
-def extract_segment_feature_for_audio_file(wav_file_path, segs_info, feature, **kwargs):
+def extract_segment_features_for_audio_file(wav_file_path, segs_info, features, **kwargs):
+    """
+    Extract all given features from the segments of one audio file, segment by segment.
+    Each segment is read once and its intermediates (signal, filtered signal, STFTs, filterbank...) are computed
+    once, then shared by all features of that segment (see koe.features.utils.cached_intermediate)
+    :param wav_file_path: path to the audio file
+    :param segs_info: list of (tid, start, end, nfft, noverlap, lpf, hpf)
+    :param features: list of Feature objects
+    :return: tids and a list of feature value lists (one per feature, each aligned with tids)
+    """
     fs, length = get_wav_info(wav_file_path)
 
     args = dict(wav_file_path=wav_file_path, fs=fs, start=0, end=None, center=False, order=44)
@@ -45,27 +59,64 @@ def extract_segment_feature_for_audio_file(wav_file_path, segs_info, feature, **
     for v, k in kwargs.items():
         args[v] = k
 
-    extractor = feature_extractors[feature.name]
+    extractors = [feature_extractors[feature.name] for feature in features]
     tids = []
-    fvals = []
+    fvalss = [[] for _ in features]
 
     for tid, beg, end, nfft, noverlap, lpf, hpf in segs_info:
-        args["start"] = beg
-        args["end"] = end
-        args["nfft"] = nfft
-        args["noverlap"] = noverlap
-        args["lpf"] = lpf
-        args["hpf"] = hpf
-        args["win_length"] = nfft
-
-        feature_value = extractor(args)
+        seg_args = dict(args)
+        seg_args["start"] = beg
+        seg_args["end"] = end
+        seg_args["nfft"] = nfft
+        seg_args["noverlap"] = noverlap
+        seg_args["lpf"] = lpf
+        seg_args["hpf"] = hpf
+        seg_args["win_length"] = nfft
+        seg_args["intermediates"] = {}
+
+        for extractor, fvals in zip(extractors, fvalss):
+            fvals.append(extractor(seg_args))
         tids.append(tid)
-        fvals.append(feature_value)
 
-    return tids, fvals
+    return tids, fvalss
+
+
+def extract_segment_feature_for_audio_file(wav_file_path, segs_info, feature, **kwargs):
+    tids, fvalss = extract_segment_features_for_audio_file(wav_file_path, segs_info, [feature], **kwargs)
+    return tids, fvalss[0]
+
+
+def run_work_items(func, work_items):
+    """
+    Run func on each work item and yield the results in the calling process, which stays the only one writing to
+    the storage. If settings.FEATURE_EXTRACTION_WORKERS > 1 the work items are spread over a pool of processes and
+    the results are yielded in order of completion.
+    :param func: a picklable, module-level function taking one work item
+    :param work_items: list of picklable work items
+    """
+    with worker_pool(min(settings.FEATURE_EXTRACTION_WORKERS, len(work_items))) as imap:
+        yield from imap(func, work_items)
+
+
+def _extract_work_item(work_item):
+    af_name, wav_file_path, segs_info, features = work_item
+    try:
+        tids, fvalss = extract_segment_features_for_audio_file(wav_file_path, segs_info, features)
+    except Exception as e:
+        raise Exception(
+            "Error extracting [{}] for file {}. Error message: {}".format(
+                ", ".join(x.name for x in features), af_name, str(e)
+            )
+        )
+    return tids, fvalss, features
 
 
 def extract_segment_features_for_segments(runner, sids, features, force=False):
+    """
+    Extract (missing) feature values of the given segments and store them in binstorage3.
+    Segments are visited one at a time, and all features missing from each segment are extracted together,
+    so that the audio is read and the intermediates computed only once per segment rather than once per feature.
+    """
     segments = Segment.objects.filter(id__in=sids)
     tids = np.array(segments.values_list("tid", flat=True), dtype=np.int32)
 
@@ -77,7 +128,7 @@ def extract_segment_features_for_segments(runner, sids, features, force=False):
 
     storage_loc_template = get_storage_loc_template()
 
-    f2af2segments = {}
+    tid2features = {}
     n_calculations = 0
 
     for feature in features:
@@ -94,63 +145,77 @@ def extract_segment_features_for_segments(runner, sids, features, force=False):
             missing_tids = tids[non_existing_idx]
             tids_target = missing_tids
 
-        af_to_segments = {}
-
-        vl = (
-            segments.filter(tid__in=tids_target)
-            .order_by("audio_file", "start_time_ms")
-            .values_list(
-                "tid",
-                "audio_file",
-                "start_time_ms",
-                "end_time_ms",
-                "audio_file__database__nfft",
-                "audio_file__database__noverlap",
-                "audio_file__database__lpf",
-                "audio_file__database__hpf",
-            )
+        for tid in tids_target:
+            tid = int(tid)
+            if tid not in tid2features:
+                tid2features[tid] = []
+            tid2features[tid].append(feature)
+
+        n_calculations += len(tids_target)
+
+    if not n_calculations:
+        return
+
+    # Group segments by audio file, then by the set of features they are missing (usually just one set)
+    af_to_segments = {}
+
+    vl = (
+        segments.filter(tid__in=list(tid2features.keys()))
+        .order_by("audio_file", "start_time_ms")
+        .values_list(
+            "tid",
+            "audio_file",
+            "start_time_ms",
+            "end_time_ms",
+            "audio_file__database__nfft",
+            "audio_file__database__noverlap",
+            "audio_file__database__lpf",
+            "audio_file__database__hpf",
         )
+    )
+
+    for tid, afid, start_time_ms, end_time_ms, nfft, noverlap, lpf, hpf in vl:
+        if afid not in af_to_segments:
+            af_to_segments[afid] = {}
+        fs_to_segments = af_to_segments[afid]
+        missing_features = tuple(tid2features[tid])
+        if missing_features not in fs_to_segments:
+            fs_to_segments[missing_features] = []
+        fs_to_segments[missing_features].append((tid, start_time_ms, end_time_ms, nfft, noverlap, lpf, hpf))
 
-        if len(vl):
-            for tid, afid, start_time_ms, end_time_ms, nfft, noverlap, lpf, hpf in vl:
-                if afid not in af_to_segments:
-                    af_to_segments[afid] = []
-                af_to_segments[afid].append((tid, start_time_ms, end_time_ms, nfft, noverlap, lpf, hpf))
+    runner.start(limit=n_calculations)
 
-            f2af2segments[feature] = af_to_segments
-            n_calculations += len(tids_target)
+    f2tids = {feature: [] for feature in features}
+    f2fvals = {feature: [] for feature in features}
 
-    if n_calculations:
-        runner.start(limit=n_calculations)
-        for ind, (feature, af_to_segments) in enumerate(f2af2segments.items()):
-            _tids = []
-            _fvals = []
+    def flush(feature):
+        _tids = f2tids[feature]
+        if len(_tids):
             storage_loc = storage_loc_template.format(feature.name)
+            bs.store(_tids, f2fvals[feature], storage_loc)
+            runner.tick(len(_tids))
+            f2tids[feature] = []
+            f2fvals[feature] = []
 
-            afids = list(af_to_segments.keys())
-            af_lookup = {x.id: x for x in AudioFile.objects.filter(id__in=afids)}
-            for afid, segs_info in af_to_segments.items():
-                af = af_lookup[afid]
-                wav_file_path = wav_path(af)
-                try:
-                    __tids, __fvals = extract_segment_feature_for_audio_file(wav_file_path, segs_info, feature)
-                except Exception as e:
-                    raise Exception(
-                        "Error extracting [{}] for file {}. Error message: {}".format(feature.name, af.name, str(e))
-                    )
-                #
-                _tids += __tids
-                _fvals += __fvals
-
-                if len(_tids) >= 100:
-                    bs.store(_tids, _fvals, storage_loc)
-                    runner.tick(len(_tids))
-                    _tids = []
-                    _fvals = []
-
-            if len(_tids):
-                bs.store(_tids, _fvals, storage_loc)
-                runner.tick(len(_tids))
+    afids = list(af_to_segments.keys())
+    af_lookup = {x.id: x for x in AudioFile.objects.filter(id__in=afids)}
+
+    work_items = []
+    for afid, fs_to_segments in af_to_segments.items():
+        af = af_lookup[afid]
+        for missing_features, segs_info in fs_to_segments.items():
+            work_items.append((af.name, wav_path(af), segs_info, missing_features))
+
+    for __tids, __fvalss, missing_features in run_work_items(_extract_work_item, work_items):
+        for feature, __fvals in zip(missing_features, __fvalss):
+            f2tids[feature] += __tids
+            f2fvals[feature] += __fvals
+
+            if len(f2tids[feature]) >= 100:
+                flush(feature)
+
+    for feature in features:
+        flush(feature)
 
 
 def get_batches(items, batch_size=100):
@@ -207,7 +272,7 @@ def aggregate_feature_values(runner, tids, features, aggregators, force=False):
             mkdirp(fa_storage_loc)
 
             if force:
-                tids_target = tids
+                tids_target = np.sort(tids)
             else:
                 existing_tids = bs.retrieve_ids(fa_storage_loc, (tid_min, tid_max))
                 sorted_ids, sort_order = np.unique(existing_tids, return_index=True)
@@ -233,31 +298,57 @@ def aggregate_feature_values(runner, tids, features, aggregators, force=False):
 
     runner.start(limit=n_calculations)
 
+    work_items = []
     for combined_tids, storage_loc, jobs in jobss:
         batches = get_batches(combined_tids, batch_size=100)
         for batch_tids in batches:
-            batch_size = len(batch_tids)
-            batch_arrs = bs.retrieve(batch_tids, storage_loc)
+            batch_jobs = []
             for tids_target, aggregator, fa_storage_loc in jobs:
-                aggregateds = []
-                aggregated_ids = []
-                target_batch_ind = np.searchsorted(batch_tids, tids_target)
-                batch_id_within_range = np.where(target_batch_ind < batch_size)
-                target_batch_ind = target_batch_ind[batch_id_within_range]
-                tids_within_range = tids_target[batch_id_within_range]
-
-                for batch_ind, tid in zip(target_batch_ind, tids_within_range):
-                    if batch_ind == 0 and batch_tids[0] != tid:
-                        continue
-                    aggregated_ids.append(tid)
-                    arr = batch_arrs[batch_ind]
-                    aggregated = aggregator.process(arr)
-                    aggregateds.append(aggregated)
-
-                if len(aggregated_ids):
-                    aggregated_ids = np.array(aggregated_ids)
-                    bs.store(aggregated_ids, aggregateds, fa_storage_loc)
-                    runner.tick(len(aggregated_ids))
+                batch_start = np.searchsorted(tids_target, batch_tids[0])
+                batch_end = np.searchsorted(tids_target, batch_tids[-1], side="right")
+                if batch_end > batch_start:
+                    batch_jobs.append((tids_target[batch_start:batch_end], aggregator, fa_storage_loc))
+            work_items.append((batch_tids, storage_loc, batch_jobs))
+
+    for results in run_work_items(_aggregate_work_item, work_items):
+        for fa_storage_loc, aggregated_ids, aggregateds in results:
+            bs.store(aggregated_ids, aggregateds, fa_storage_loc)
+            runner.tick(len(aggregated_ids))
+
+
+def _aggregate_work_item(work_item):
+    batch_tids, storage_loc, batch_jobs = work_item
+    batch_arrs = bs.retrieve(batch_tids, storage_loc, mmap=True)
+    full_batch = None
+    results = []
+    for tids_target, aggregator, fa_storage_loc in batch_jobs:
+        if len(tids_target) == len(batch_tids):
+            if full_batch is None:
+                full_batch = _make_batch(batch_arrs)
+            batch = full_batch
+            arrs = batch_arrs
+        else:
+            batch_inds = np.searchsorted(batch_tids, tids_target)
+            arrs = [batch_arrs[batch_ind] for batch_ind in batch_inds]
+            batch = _make_batch(arrs)
+
+        if batch is None:
+            aggregateds = [aggregator.process(arr) for arr in arrs]
+        else:
+            aggregateds = list(aggregator.process_batch(*batch))
+        results.append((fa_storage_loc, tids_target, aggregateds))
+    return results
+
+
+def _make_batch(arrs):
+    """
+    :return: (values, offsets) of the ragged batch, or None if the arrays can't be concatenated
+             (e.g. they don't have the same number of rows)
+    """
+    try:
+        return make_ragged_batch(arrs)
+    except ValueError:
+        return None
 
 
 def get_segment_ids_and_labels(csv_file):
@@ -295,7 +386,7 @@ def extract_rawdata(ids, features, aggregators):
     for feature in features:
         storage_loc = storage_loc_template.format(feature.name)
         if feature.is_fixed_length:
-            rawdata_ = bs.retrieve(ids, storage_loc, flat=True)
+            rawdata_ = bs.retrieve(ids, storage_loc, flat=True, mmap=True)
             rawdata_stacked = np.stack(rawdata_)
             rawdata.append(rawdata_stacked)
             ncols = rawdata_stacked.shape[1]
@@ -305,7 +396,7 @@ def extract_rawdata(ids, features, aggregators):
             fa_storage_loc_template = os.path.join(storage_loc, "{}")
             for aggregator in aggregators:
                 fa_storage_loc = fa_storage_loc_template.format(aggregator.name)
-                rawdata_ = bs.retrieve(ids, fa_storage_loc, flat=True)
+                rawdata_ = bs.retrieve(ids, fa_storage_loc, flat=True, mmap=True)
                 try:
                     rawdata_stacked = np.stack(rawdata_)
                 except ValueError:
@@ -337,8 +428,98 @@ def get_or_wait(task_id):
     return task
 
 
+def _can_update_datamatrix(dm, features, aggregators):
+    """
+    A DataMatrix can be updated in place only if it has been fully written before with the same column groups
+    """
+    paths = [dm.get_sids_path(), dm.get_bytes_path(), dm.get_cols_path()]
+    if not all(os.path.isfile(x) for x in paths):
+        return False
+
+    with open(dm.get_cols_path(), "r", encoding="utf-8") as f:
+        col_inds = json.load(f)
+
+    return set(col_inds.keys()) == set(get_column_group_names(features, aggregators))
+
+
+def _update_datamatrix(dm, sids, new_sids, new_tids, features, aggregators):
+    """
+    Drop the rows of segments that are no longer in sids and append rows for new segments. Only the rows that change
+    are written: new rows are appended, and removed rows are overwritten by the last rows of the matrix, which is then
+    truncated. The feature values of the other rows are not read again
+    :param dm: the DataMatrix
+    :param sids: all ids of the segments that the matrix should contain
+    :param new_sids: ids of the segments that are not yet in the matrix
+    :param new_tids: tids of the same segments
+    :return: True if the matrix has changed
+    """
+    sids_path = dm.get_sids_path()
+    bytes_path = dm.get_bytes_path()
+    cols_path = dm.get_cols_path()
+
+    existing_sids = bytes_to_ndarray(sids_path, np.int32)
+    with open(cols_path, "r", encoding="utf-8") as f:
+        col_inds = json.load(f)
+    ncols = max(end for start, end in col_inds.values())
+
+    is_kept = np.isin(existing_sids, sids)
+    nkept = np.count_nonzero(is_kept)
+    if nkept == len(existing_sids) and len(new_sids) == 0:
+        return False
+
+    if nkept < len(existing_sids):
+        # Rows to remove that are among the first nkept rows are filled with the kept rows from after them
+        holes = np.flatnonzero(np.logical_not(is_kept[:nkept]))
+        fillers = nkept + np.flatnonzero(is_kept[nkept:])
+        if len(holes):
+            data = np.memmap(bytes_path, dtype=np.float32, mode="r+", shape=(len(existing_sids), ncols))
+            data[holes, :] = data[fillers, :]
+            data.flush()
+            del data
+            existing_sids[holes] = existing_sids[fillers]
+
+        os.truncate(bytes_path, nkept * ncols * np.dtype(np.float32).itemsize)
+        existing_sids = existing_sids[:nkept]
+
+    if len(new_sids):
+        new_data, new_col_inds = extract_rawdata(new_tids, features, aggregators)
+        new_data = new_data[:, _reorder_columns(new_col_inds, col_inds)]
+        with open(bytes_path, "ab") as f:
+            new_data.astype(np.float32).tofile(f)
+
+    sids = np.concatenate((existing_sids, new_sids)).astype(np.int32)
+    ndarray_to_bytes(sids, sids_path)
+    return True
+
+
+def _reorder_columns(from_col_inds, to_col_inds):
+    """
+    :return: indices to rearrange the columns of a matrix laid out by from_col_inds into the layout of to_col_inds
+    """
+    ncols = max(end for start, end in to_col_inds.values())
+    col_order = np.empty((ncols,), dtype=np.int32)
+    for name, (start, end) in to_col_inds.items():
+        from_start, from_end = from_col_inds[name]
+        assert from_end - from_start == end - start, "Column group {} has changed its width".format(name)
+        col_order[start:end] = np.arange(from_start, from_end)
+    return col_order
+
+
 @app.task(bind=False)
-def extract_database_measurements(arg=None, force=False, send_email="always", raise_err=False, *args, **kwargs):
+def extract_database_measurements(
+    arg=None, force=False, incremental=False, send_email="always", raise_err=False, *args, **kwargs
+):
+    """
+    Extract feature values of all segments of a DataMatrix (or of task.sids) and write the matrix
+    :param arg: a task or a task id
+    :param force: re-extract feature values even if they are already stored
+    :param incremental: if the DataMatrix has been extracted before with the same features and aggregations, only
+                        extract the segments that have been added to the database since, and drop the rows of the
+                        segments that have been deleted. Ordinations and similarity indices of the DataMatrix are
+                        then marked as stale. Ignored if force is True.
+                        Whenever the matrix changes, its stale ordinations and similarity indices are reconstructed
+                        once it is complete
+    """
     if isinstance(arg, int):
         task = get_or_wait(arg)
     else:
@@ -372,9 +553,6 @@ def extract_database_measurements(arg=None, force=False, send_email="always", ra
                 "Measurement cannot be extracted because your database doesn't contain any segments."
             )
 
-        segments = Segment.objects.filter(id__in=sids)
-        tids = np.array(segments.values_list("tid", flat=True), dtype=np.int32)
-
         features = Feature.objects.filter(id__in=features_hash.split("-"))
         aggregations = Aggregation.objects.filter(id__in=aggregations_hash.split("-"))
 
@@ -394,7 +572,21 @@ def extract_database_measurements(arg=None, force=False, send_email="always", ra
 
         aggregators = [aggregator_map[x.name] for x in aggregations]
 
-        extract_segment_features_for_segments(runner, sids, features, force=force)
+        is_updating = (
+            incremental and not force and isinstance(task, Task) and _can_update_datamatrix(dm, features, aggregators)
+        )
+        if is_updating:
+            existing_sids = bytes_to_ndarray(dm.get_sids_path(), np.int32)
+            sids = np.array(sids, dtype=np.int32)
+            sids_to_extract = sids[np.logical_not(np.isin(sids, existing_sids))]
+        else:
+            sids_to_extract = sids
+
+        sids_tids = Segment.objects.filter(id__in=sids_to_extract).values_list("id", "tid")
+        sids_to_extract = np.array([x[0] for x in sids_tids], dtype=np.int32)
+        tids = np.array([x[1] for x in sids_tids], dtype=np.int32)
+
+        extract_segment_features_for_segments(runner, sids_to_extract, features, force=force)
 
         runner.wrapping_up()
         child_task = task.__class__(user=task.user, parent=task)
@@ -405,7 +597,14 @@ def extract_database_measurements(arg=None, force=False, send_email="always", ra
         aggregate_feature_values(child_runner, tids, features, aggregators, force=force)
         child_runner.complete()
 
-        if isinstance(task, Task):
+        is_changed = False
+        if is_updating:
+            is_changed = _update_datamatrix(dm, sids, sids_to_extract, tids, features, aggregators)
+            if is_changed:
+                Ordination.objects.filter(dm=dm).update(stale=True)
+                SimilarityIndex.objects.filter(dm=dm).update(stale=True)
+
+        elif isinstance(task, Task):
             full_sids_path = dm.get_sids_path()
             full_bytes_path = dm.get_bytes_path()
             full_cols_path = dm.get_cols_path()
@@ -413,15 +612,22 @@ def extract_database_measurements(arg=None, force=False, send_email="always", ra
             data, col_inds = extract_rawdata(tids, features, aggregators)
 
             ndarray_to_bytes(data, full_bytes_path)
-            ndarray_to_bytes(np.array(sids, dtype=np.int32), full_sids_path)
+            ndarray_to_bytes(sids_to_extract, full_sids_path)
 
             with open(full_cols_path, "w", encoding="utf-8") as f:
                 json.dump(col_inds, f)
 
             dm.ndims = data.shape[1]
             dm.save()
+
+            Ordination.objects.filter(dm=dm).update(stale=True)
+            SimilarityIndex.objects.filter(dm=dm).update(stale=True)
+            is_changed = True
         runner.complete()
 
+        if is_changed:
+            reconstruct_stale_dependants(dm, task.user, send_email=send_email, raise_err=raise_err)
+
     except Exception as e:
         if raise_err:
             raise e
@@ -534,6 +740,10 @@ def _construct_ordination(ord, runner):
     ndarray_to_bytes(result, ord_bytes_path)
     ndarray_to_bytes(sids, ord_sids_path)
 
+    if ord.stale:
+        ord.stale = False
+        ord.save()
+
 
 @app.task(bind=False)
 def construct_ordination(task_id, send_email="always", raise_err=False, *args, **kwargs):
@@ -593,6 +803,10 @@ def _calculate_similarity(sim, runner):
     ndarray_to_bytes(sorted_order, sim_bytes_path)
     ndarray_to_bytes(sids, sim_sids_path)
 
+    if sim.stale:
+        sim.stale = False
+        sim.save()
+
 
 @app.task(bind=False)
 def calculate_similarity(task_id, send_email="always", raise_err=False, *args, **kwargs):
@@ -620,6 +834,36 @@ def calculate_similarity(task_id, send_email="always", raise_err=False, *args, *
         runner.error(e)
 
 
+def _get_dependant_task(obj, user):
+    """
+    Reuse the task of an ordination or similarity index if it belongs to this user, otherwise give it a new one
+    """
+    task = obj.task
+    if task is None or task.user != user:
+        task = Task(user=user, target="{}:{}".format(obj.__class__.__name__, obj.id))
+        task.save()
+        obj.task = task
+        obj.save()
+    return task
+
+
+def reconstruct_stale_dependants(dm, user, send_email="always", raise_err=False):
+    """
+    Reconstruct the stale ordinations of a DataMatrix, then its stale similarity indices. They run one after another
+    in this process, because a similarity index built on an ordination can only be calculated once that ordination
+    is complete
+    :param dm: the DataMatrix, which must be complete
+    :param user: the user who recreated the DataMatrix, owner of the new tasks
+    """
+    for ord in Ordination.objects.filter(dm=dm, stale=True):
+        task = _get_dependant_task(ord, user)
+        construct_ordination(task.id, send_email=send_email, raise_err=raise_err)
+
+    for sim in SimilarityIndex.objects.filter(dm=dm, stale=True):
+        task = _get_dependant_task(sim, user)
+        calculate_similarity(task.id, send_email=send_email, raise_err=raise_err)
+
+
 def drop_useless_columns(mat):
     colmin = np.min(mat, axis=0)
     colmax = np.max(mat, axis=0)
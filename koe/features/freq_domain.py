@@ -1,9 +1,8 @@
 import numpy as np
 from librosa import feature as rosaft
-from memoize import memoize
 from scipy.stats import kurtosis, skew
 
-from koe.features.utils import get_psd, get_psddb, get_sig, unroll_args
+from koe.features.utils import cached_intermediate, get_psd, get_psddb, get_sig, unroll_args
 from koe.utils import split_segments
 
 
@@ -116,7 +115,6 @@ def frame_zcr(frame):
     return countZ / float(count - 1)
 
 
-@memoize(timeout=60)
 def _harmonic_and_pitch(args):
     """
     Computes harmonic ratio and pitch
@@ -177,12 +175,12 @@ def _harmonic_and_pitch(args):
 
 
 def harmonic_ratio(args):
-    hrs, f0s = _harmonic_and_pitch(args)
+    hrs, f0s = cached_intermediate(args, "harmonic_and_pitch", _harmonic_and_pitch, args)
     return hrs
 
 
 def fundamental_frequency(args):
-    hrs, f0s = _harmonic_and_pitch(args)
+    hrs, f0s = cached_intermediate(args, "harmonic_and_pitch", _harmonic_and_pitch, args)
     return f0s
 
 
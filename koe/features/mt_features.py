@@ -2,7 +2,7 @@ import numpy as np
 from scipy.fftpack import ifft
 from skimage.measure import label, regionprops
 
-from koe.features.utils import maybe_cached_stft, unroll_args
+from koe.features.utils import cached_intermediate, maybe_cached_stft, unroll_args
 
 
 def find_zc(arr):
@@ -10,8 +10,7 @@ def find_zc(arr):
     return np.where((v_ < 0) & (arr < 0))
 
 
-# @memoize(timeout=60)
-def cached_tf_derivatives(args):
+def _tf_derivatives(args):
     tapered1 = maybe_cached_stft(args, "dpss1")
     tapered2 = maybe_cached_stft(args, "dpss2")
 
@@ -26,6 +25,10 @@ def cached_tf_derivatives(args):
     return time_deriv, freq_deriv
 
 
+def cached_tf_derivatives(args):
+    return cached_intermediate(args, "tf_derivatives", _tf_derivatives, args)
+
+
 def time_derivative(args):
     time_deriv, _ = cached_tf_derivatives(args)
     return time_deriv
@@ -59,12 +62,16 @@ def goodness_of_pitch(args):
     return np.max(tmp, axis=0)
 
 
-def mtspect(args):
+def _mtspect(args):
     tapered1 = maybe_cached_stft(args, "dpss1")
     tapered2 = maybe_cached_stft(args, "dpss2")
     return (np.abs(tapered1) ** 2 + np.abs(tapered2) ** 2) / 2
 
 
+def mtspect(args):
+    return cached_intermediate(args, "mtspect", _mtspect, args)
+
+
 def amplitude(args):
     s = mtspect(args)
     m_LogSum = np.sum(s[3:, :], axis=0)
@@ -2,7 +2,7 @@ import numpy as np
 from librosa import filters, power_to_db
 from memoize import memoize
 
-from koe.features.utils import get_psd, unroll_args
+from koe.features.utils import cached_intermediate, get_psd, unroll_args
 
 
 def dct(n_filters, n_input):
@@ -26,7 +26,7 @@ def _cached_get_mel_filter(sr, n_fft, n_mels, fmin, fmax):
     return filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
 
 
-def mfc(args):
+def _mfc(args):
     psd = get_psd(args) ** 2
     fs, nfft, ncep, fmin, fmax = unroll_args(args, ["fs", "nfft", ("ncep", 20), ("fmin", 0.0), ("fmax", None)])
     if fmax is None:
@@ -38,13 +38,21 @@ def mfc(args):
     return power_to_db(melspect)
 
 
-def mfcc(args):
+def mfc(args):
+    return cached_intermediate(args, "mfc", _mfc, args)
+
+
+def _mfcc(args):
     ncep = unroll_args(args, [("ncep", 20)])
     S = mfc(args)
     librosa_dct = dct(ncep, S.shape[0])
     return np.dot(librosa_dct, S)
 
 
+def mfcc(args):
+    return cached_intermediate(args, "mfcc", _mfcc, args)
+
+
 def mfcc_delta(args):
     cc = mfcc(args)
     diff = np.pad(np.diff(cc), ((0, 0), (1, 0)), "constant", constant_values=0)
@@ -88,6 +88,39 @@ def stft_from_sig(sig, nfft, noverlap, win_length, window_name, center):
     )
 
 
+def cached_intermediate(args, name, func, *func_args, **func_kwargs):
+    """
+    Compute an intermediate value (e.g. the segment's signal or one of its STFTs) that several features depend on.
+    If args carries a per-segment cache under 'intermediates', the value is computed only once and then shared by
+    every feature extracted with the same args. Otherwise it is simply computed.
+    :param args: arguments of the feature extractor
+    :param name: name of the intermediate - must identify func and its arguments uniquely within one segment
+    :param func: function that computes the intermediate
+    :return: the intermediate value
+    """
+    intermediates = args.get("intermediates", None)
+    if intermediates is None:
+        return func(*func_args, **func_kwargs)
+
+    if name not in intermediates:
+        intermediates[name] = func(*func_args, **func_kwargs)
+    return intermediates[name]
+
+
+def read_chunk(args):
+    """
+    Read the unfiltered mono signal of the segment, as used by the STFT-based features
+    """
+    wav_file_path, start, end = unroll_args(args, ["wav_file_path", "start", "end"])
+    return cached_intermediate(
+        args, "chunk", wavfile.read_segment, wav_file_path, start, end, normalised=True, mono=True
+    )
+
+
+def psd_from_sig(sig, nfft, noverlap, win_length, center):
+    return np.abs(stft_from_sig(sig, nfft, noverlap, win_length, "hann", center))
+
+
 def get_psd(args):
     wav_file_path, fs, start, end, nfft, noverlap, win_length, center = unroll_args(
         args,
@@ -104,10 +137,11 @@ def get_psd(args):
     )
 
     if wav_file_path:
-        psd = get_spectrogram(wav_file_path, fs, start, end, nfft, noverlap, nfft, center)
+        chunk = read_chunk(args)
+        psd = cached_intermediate(args, "psd", psd_from_sig, chunk, nfft, noverlap, nfft, center)
     else:
         sig = args["sig"]
-        psd = np.abs(stft_from_sig(sig, nfft, noverlap, win_length, "hann", center))
+        psd = cached_intermediate(args, "psd", psd_from_sig, sig, nfft, noverlap, win_length, center)
     return psd
 
 
@@ -117,11 +151,21 @@ def get_sig(args):
     )
 
     if wav_file_path:
-        sig = wavfile.read_segment(wav_file_path, start, end, mono=True, normalised=True, winlen=win_length)
+        sig = cached_intermediate(
+            args,
+            "unfiltered_sig",
+            wavfile.read_segment,
+            wav_file_path,
+            start,
+            end,
+            mono=True,
+            normalised=True,
+            winlen=win_length,
+        )
     else:
         sig = args["sig"]
 
-    return butter_bandpass_filter(sig, lpf, hpf, fs)
+    return cached_intermediate(args, "sig", butter_bandpass_filter, sig, lpf, hpf, fs)
 
 
 def maybe_cached_stft(args, window_name):
@@ -139,17 +183,23 @@ def maybe_cached_stft(args, window_name):
         ],
     )
     if wav_file_path:
-        tapered = cached_stft(wav_file_path, start, end, nfft, noverlap, win_length, window_name, center)
+        sig = read_chunk(args)
     else:
         sig = args["sig"]
-        tapered = stft_from_sig(sig, nfft, noverlap, win_length, window_name, center)
 
-    return tapered
+    intermediate_name = "stft_{}".format(window_name)
+    return cached_intermediate(
+        args, intermediate_name, stft_from_sig, sig, nfft, noverlap, win_length, window_name, center
+    )
+
+
+def _psddb_from_psd(spect):
+    return np.log10(spect) * 10.0
 
 
 def get_psddb(args):
     spect = get_psd(args)
-    return np.log10(spect) * 10.0
+    return cached_intermediate(args, "psddb", _psddb_from_psd, spect)
 
 
 # @memoize(timeout=60)
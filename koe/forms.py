@@ -44,6 +44,9 @@ class FeatureExtrationForm(ErrorMixin, forms.Form):
         error_messages={"required": "At least one aggregation method must be chosen"},
     )
 
+    # Only used when recreating an existing data matrix
+    force = forms.BooleanField(required=False)
+
     def __init__(self, *args, **kwargs):
         super(FeatureExtrationForm, self).__init__(*args, **kwargs)
         if "feature_choices" in cached:
@@ -1,3 +1,4 @@
+import time
 from collections import OrderedDict
 
 import networkx as nx
@@ -6,6 +7,7 @@ from networkx.algorithms import approximation, assortativity, centrality, vitali
 from nltk.util import ngrams
 
 from koe.sequence_utils import songs_to_syl_seqs
+from koe.trial_utils import run_trials
 from root.exceptions import CustomAssertionError
 
 
@@ -237,25 +239,116 @@ def extract_graph_properties(songs, enum2label):
     return edges, node_dict
 
 
-def _get_small_world_measures(graph, meas, **kwargs):
-    # Compute the mean clustering coefficient and average shortest path length
-    # for an equivalent random graph
-    nrand = kwargs["nrand"]
-    niter = kwargs["niter"]
-    C = meas["C"]
-    L = meas["L"]
+def count_bigrams(labels, song_starts, nlabels):
+    """
+    Count the transitions between consecutive syllables of the same song
+    :param labels: int array of the label (enumerated) of every syllable of every song, songs one after another.
+                   Syllables with a negative label are not part of any transition
+    :param song_starts: the syllables of song i are labels[song_starts[i]:song_starts[i + 1]]
+    :param nlabels: labels must be < nlabels
+    :return: counts, link_codes. counts[x, y] is the number of times x is followed by y. link_codes are (x * nlabels +
+             y) of all transitions that happen at least once, in order of their first occurrence
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    sources = labels[:-1]
+    targets = labels[1:]
+
+    within_song = np.ones(len(sources), dtype=bool)
+    song_ends = np.asarray(song_starts[1:-1], dtype=np.int64) - 1
+    within_song[song_ends[song_ends >= 0]] = False
+    valid = within_song & (sources >= 0) & (targets >= 0)
+
+    codes = sources[valid] * nlabels + targets[valid]
+    counts = np.bincount(codes, minlength=nlabels * nlabels).reshape((nlabels, nlabels))
+
+    unique_codes, first_inds = np.unique(codes, return_index=True)
+    link_codes = unique_codes[np.argsort(first_inds)]
+    return counts, link_codes
+
+
+def extract_graph_edges(counts, link_codes):
+    """
+    Same edges and nodes as extract_graph_properties, from the transition counts
+    :param counts: see count_bigrams
+    :param link_codes: see count_bigrams
+    :return: edges, nodes. edges are (source, target, {distance, weight}), nodes are those that have at least one link
+    """
+    nlabels = counts.shape[0]
+    in_counts = counts.sum(axis=0)
+    out_counts = counts.sum(axis=1)
+    individual_link_counts = np.where(in_counts > 0, in_counts, out_counts)
+
+    sources = link_codes // nlabels
+    targets = link_codes % nlabels
+    link_counts = counts[sources, targets]
+
+    # See calc_distances()
+    distances = individual_link_counts[sources] / link_counts
+    normalised_distances = distances / distances.sum()
+
+    edges = [
+        (source, target, {"distance": distance, "weight": weight})
+        for source, target, distance, weight in zip(
+            sources.tolist(), targets.tolist(), normalised_distances.tolist(), link_counts.tolist()
+        )
+    ]
+    nodes = np.flatnonzero(in_counts + out_counts).tolist()
+    return edges, nodes
+
+
+# Same defaults as nx.sigma()
+DEFAULT_NRAND = 10
+DEFAULT_NITER = 100
+
+# Statistics of the reference graphs, by (degree sequence, nrand, niter, seed). The references are rewirings that keep
+# the degree sequence and nothing else of the graph, so graphs with the same degree sequence can share them
+_reference_stats_cache = {}
+
+
+def _make_reference_stats(work_item, shared):
+    graph = shared["graph"]
+    niter = shared["niter"]
+    Gr = nx.random_reference(graph, niter=niter, seed=work_item)
+    Gl = nx.lattice_reference(graph, niter=niter, seed=work_item)
+    return nx.transitivity(Gr), nx.transitivity(Gl), nx.average_shortest_path_length(Gr)
+
+
+def get_reference_stats(graph, nrand, niter, seed=None):
+    """
+    Generate nrand random and lattice reference graphs of graph - in parallel if settings.EVALUATION_WORKERS > 1.
+    The result is memoised by degree sequence
+    :param graph: a connected, undirected graph of at least 4 nodes
+    :param seed: if given, the references are the same every time
+    :return: mean transitivity of the random references, mean transitivity of the lattice references and mean shortest
+             path length of the random references
+    """
+    degrees = tuple(sorted(degree for _, degree in graph.degree()))
+    key = (degrees, nrand, niter, seed)
+    if key not in _reference_stats_cache:
+        if seed is None:
+            seeds = [None] * nrand
+        else:
+            seeds = np.random.RandomState(seed).randint(2**31, size=nrand).tolist()
+
+        work_items = list(enumerate(seeds))
+        results = dict(run_trials(_make_reference_stats, work_items, dict(graph=graph, niter=niter)))
+        Cr, Cl, Lr = np.mean([results[i] for i in range(nrand)], axis=0)
+        _reference_stats_cache[key] = Cr, Cl, Lr
+
+    return _reference_stats_cache[key]
 
-    randMetrics = {"Cr": [], "Cl": [], "L": []}
-    for _ in range(nrand):
-        Gr = nx.random_reference(graph, niter=niter)
-        Gl = nx.lattice_reference(graph, niter=niter)
-        randMetrics["Cl"].append(nx.transitivity(Gl))
-        randMetrics["Cr"].append(nx.transitivity(Gr))
-        randMetrics["L"].append(nx.average_shortest_path_length(Gr))
 
-    Cl = np.mean(randMetrics["Cl"])
-    Cr = np.mean(randMetrics["Cr"])
-    Lr = np.mean(randMetrics["L"])
+def _get_small_world_measures(graph, digraph, meas, nrand=None, niter=None, seed=None, **kwargs):
+    # Compare the mean clustering coefficient and average shortest path length
+    # with those of equivalent random and lattice graphs
+    if nrand is None:
+        nrand = DEFAULT_NRAND
+    if niter is None:
+        niter = DEFAULT_NITER
+
+    C = nx.transitivity(graph)
+    L = nx.average_shortest_path_length(graph)
+    Cr, Cl, Lr = get_reference_stats(graph, nrand, niter, seed)
 
     omega = (Lr / L) - (C / Cl)
     sigma = (C / Cr) / (L / Lr)
@@ -298,21 +391,20 @@ def make_func(name, func_desc, return_stats=True):
         except Exception as e:
             raise Exception("Error running function {}: {}".format(name, str(e)))
 
+    func.__name__ = name
     return func
 
 
-meas_dependencies = {
-    "small_world_measures": ["clustering_coefficient", "average_shortest_path_length"],
-}
+meas_dependencies = {}
 
 
 def make_stats_output(base):
     return [base + "_" + x for x in stats_funcs.keys()]
 
 
+# Not part of "all" because it's still slow, even with the reference graphs generated in parallel
 meas_funcs_and_outputs = {
-    # Disable for now because it's very slow
-    # 'small_world_measures': (_get_small_world_measures, ['Omega', 'Sigma']),
+    "small_world_measures": (_get_small_world_measures, ["Omega", "Sigma"]),
 }
 
 node_funcs_and_outputs = {}
@@ -499,12 +591,10 @@ def resolve_meas(measurements_str):
     return list(measurements_order.values()), measurements_outputs
 
 
-def extract_graph_feature(songs, sid_to_cluster, enum2label, measurements_order, **extra_args):
-    song_sequences = songs_to_syl_seqs(songs, sid_to_cluster, enum2label, use_pseudo=False)
-
-    edges, node_dict = extract_graph_properties(song_sequences, enum2label)
-    nodes = sorted(list(node_dict.keys()))
-
+def measure_graph(edges, nodes, measurements_order, timings=None, **extra_args):
+    """
+    :param timings: if given, the time (in seconds) spent on each measurement is added to timings[function name]
+    """
     graph = nx.Graph()
     graph.add_nodes_from(nodes)
     graph.add_edges_from(edges)
@@ -515,6 +605,31 @@ def extract_graph_feature(songs, sid_to_cluster, enum2label, measurements_order,
 
     measurements_values = {}
     for func in measurements_order:
+        start = time.time()
         func(graph, digraph, measurements_values, **extra_args)
+        if timings is not None:
+            timings[func.__name__] = timings.get(func.__name__, 0) + time.time() - start
 
     return measurements_values
+
+
+def extract_graph_feature_from_labels(labels, song_starts, nlabels, measurements_order, timings=None, **extra_args):
+    """
+    Same as extract_graph_feature, for songs that have been loaded by get_song_sid_sequences and labelled
+    :param labels: see count_bigrams
+    :param song_starts: see count_bigrams
+    :param nlabels: see count_bigrams
+    :param timings: see measure_graph
+    """
+    counts, link_codes = count_bigrams(labels, song_starts, nlabels)
+    edges, nodes = extract_graph_edges(counts, link_codes)
+    return measure_graph(edges, nodes, measurements_order, timings, **extra_args)
+
+
+def extract_graph_feature(songs, sid_to_cluster, enum2label, measurements_order, **extra_args):
+    song_sequences = songs_to_syl_seqs(songs, sid_to_cluster, enum2label, use_pseudo=False)
+
+    edges, node_dict = extract_graph_properties(song_sequences, enum2label)
+    nodes = sorted(list(node_dict.keys()))
+
+    return measure_graph(edges, nodes, measurements_order, **extra_args)
@@ -3,7 +3,6 @@ import os
 from collections import Counter
 
 from django.conf import settings
-from django.db.models.functions import Lower
 from django.db.models.query import QuerySet
 from django.urls import reverse
 
@@ -11,6 +10,7 @@ import numpy as np
 from pycspade import spade
 
 from koe.cluster_analysis_utils import get_syllable_labels
+from koe.label_store import get_label_column, get_sid_to_label
 from koe.model_utils import get_or_error, get_user_databases
 from koe.models import (
     AudioFile,
@@ -19,6 +19,7 @@ from koe.models import (
     DatabasePermission,
     Segment,
     SimilarityIndex,
+    TaskProgressStage,
     TemporaryDatabase,
 )
 from koe.sequence_utils import calc_class_ajacency
@@ -26,11 +27,12 @@ from koe.storage_utils import get_sids_tids
 from koe.ts_utils import bytes_to_ndarray, get_rawdata_from_binary
 from koe.utils import history_path
 from root.exceptions import CustomAssertionError
-from root.models import ExtraAttr, ExtraAttrValue
+from root.models import ExtraAttrValue, get_extra_attr_values
 
 
 __all__ = [
     "bulk_get_segment_info",
+    "get_segment_info_scope",
     "bulk_get_exemplars",
     "bulk_get_song_sequences",
     "bulk_get_segments_for_audio",
@@ -57,25 +59,15 @@ def bulk_get_concise_segment_info(segs, extras):
 
     segs = segs.filter(audio_file__database=current_database.id)
     values = list(segs.values_list("id", "tid", "start_time_ms", "end_time_ms", "audio_file__name"))
-    segids = [x[0] for x in values]
 
     label_attr = settings.ATTRS.segment.label
     family_attr = settings.ATTRS.segment.family
     subfamily_attr = settings.ATTRS.segment.subfamily
 
-    labels = ExtraAttrValue.objects.filter(user__username=user, attr=label_attr, owner_id__in=segids).values_list(
-        "owner_id", "value"
-    )
-    families = ExtraAttrValue.objects.filter(user__username=user, attr=family_attr, owner_id__in=segids).values_list(
-        "owner_id", "value"
-    )
-    subfamilies = ExtraAttrValue.objects.filter(
-        user__username=user, attr=subfamily_attr, owner_id__in=segids
-    ).values_list("owner_id", "value")
-
-    labels = {x: y for x, y in labels}
-    families = {x: y for x, y in families}
-    subfamilies = {x: y for x, y in subfamilies}
+    attr_values = get_extra_attr_values(Segment.__name__, segs, user, [label_attr, family_attr, subfamily_attr])
+    labels = attr_values[label_attr.name]
+    families = attr_values[family_attr.name]
+    subfamilies = attr_values[subfamily_attr.name]
 
     for id, tid, start, end, song_name in values:
         ids.append(id)
@@ -100,14 +92,14 @@ def bulk_get_concise_segment_info(segs, extras):
     return ids, rows
 
 
-def bulk_get_segment_info(segs, extras):
+def get_segment_info_scope(segs, extras):
     """
-    Return rows contains Segments' information to display in SlickGrid
-    :param segs: an array of segment object (or a QuerySet)
-    :param extras: Must specify the user to get the correct ExtraAttrValue columns
-    :return: [row]
+    Restrict segments to those displayed by bulk_get_segment_info: the held out segments, the segments of the
+    current temporary database or of the current database
+    :param segs: a QuerySet of segments
+    :param extras: must specify either database or tmpdb
+    :return: QuerySet
     """
-    viewas = extras.viewas
     holdout = extras.get("_holdout", "false") == "true"
     user = extras.user
 
@@ -118,16 +110,6 @@ def bulk_get_segment_info(segs, extras):
         database_id = extras.tmpdb
         current_database = get_or_error(TemporaryDatabase, dict(id=database_id))
 
-    similarity_id = extras.similarity
-    current_similarity = None
-    if similarity_id:
-        current_similarity = get_or_error(SimilarityIndex, dict(id=similarity_id))
-
-    rows = []
-    ids = []
-    if current_database is None:
-        return ids, rows
-
     if holdout:
         ids_holder = ExtraAttrValue.objects.filter(
             attr=settings.ATTRS.user.hold_ids_attr, owner_id=user.id, user=user
@@ -142,6 +124,25 @@ def bulk_get_segment_info(segs, extras):
     else:
         segs = segs.filter(audio_file__database=current_database.id)
 
+    return segs
+
+
+def bulk_get_segment_info(segs, extras):
+    """
+    Return rows contains Segments' information to display in SlickGrid
+    :param segs: an array of segment object (or a QuerySet)
+    :param extras: Must specify the user to get the correct ExtraAttrValue columns
+    :return: [row]
+    """
+    viewas = extras.viewas
+
+    similarity_id = extras.similarity
+    current_similarity = None
+    if similarity_id:
+        current_similarity = get_or_error(SimilarityIndex, dict(id=similarity_id))
+
+    segs = get_segment_info_scope(segs, extras)
+
     values = list(
         segs.values_list(
             "id",
@@ -159,30 +160,10 @@ def bulk_get_segment_info(segs, extras):
         )
     )
 
-    segids = [x[0] for x in values]
-    song_ids = [x[5] for x in values]
-
-    extra_attr_values_list = ExtraAttrValue.objects.filter(
-        user__username=viewas, attr__klass=Segment.__name__, owner_id__in=segids
-    ).values_list("owner_id", "attr__name", "value")
+    song_ids = list(set(x[5] for x in values))
 
-    song_extra_attr_values_list = ExtraAttrValue.objects.filter(
-        user__username=viewas, attr__klass=AudioFile.__name__, owner_id__in=song_ids
-    ).values_list("owner_id", "attr__name", "value")
-
-    extra_attr_values_lookup = {}
-    for id, attr, value in extra_attr_values_list:
-        if id not in extra_attr_values_lookup:
-            extra_attr_values_lookup[id] = {}
-        extra_attr_dict = extra_attr_values_lookup[id]
-        extra_attr_dict[attr] = value
-
-    song_extra_attr_values_lookup = {}
-    for id, attr, value in song_extra_attr_values_list:
-        if id not in song_extra_attr_values_lookup:
-            song_extra_attr_values_lookup[id] = {}
-        extra_attr_dict = song_extra_attr_values_lookup[id]
-        extra_attr_dict[attr] = value
+    extra_attr_values = get_extra_attr_values(Segment.__name__, segs, viewas)
+    song_extra_attr_values = get_extra_attr_values(AudioFile.__name__, song_ids, viewas)
 
     ids = np.array([x[0] for x in values], dtype=np.int32)
 
@@ -196,6 +177,8 @@ def bulk_get_segment_info(segs, extras):
         sim_order = np.squeeze(get_rawdata_from_binary(sim_bytes_path, len(sim_sids), np.int32)).tolist()
         id2order = dict(zip(sim_sids, sim_order))
 
+    rows = []
+    song_urls = {}
     for (
         id,
         tid,
@@ -213,8 +196,11 @@ def bulk_get_segment_info(segs, extras):
         sim_index = id2order.get(id, None)
 
         duration = end - start
-        url = reverse("segmentation", kwargs={"file_id": song_id})
-        url = "[{}]({})".format(url, song_name)
+        url = song_urls.get(song_id, None)
+        if url is None:
+            url = reverse("segmentation", kwargs={"file_id": song_id})
+            url = "[{}]({})".format(url, song_name)
+            song_urls[song_id] = url
         row = dict(
             id=id,
             start_time_ms=start,
@@ -230,15 +216,13 @@ def bulk_get_segment_info(segs, extras):
             song_added=added.date(),
             spectrogram=tid,
         )
-        extra_attr_dict = extra_attr_values_lookup.get(id, {})
-        song_extra_attr_dict = song_extra_attr_values_lookup.get(song_id, {})
-
-        for attr in extra_attr_dict:
-            row[attr] = extra_attr_dict[attr]
+        for attr, owner_values in extra_attr_values.items():
+            if id in owner_values:
+                row[attr] = owner_values[id]
 
-        for song_attr in song_extra_attr_dict:
-            attr = "song_{}".format(song_attr)
-            row[attr] = song_extra_attr_dict[song_attr]
+        for song_attr, owner_values in song_extra_attr_values.items():
+            if song_id in owner_values:
+                row["song_{}".format(song_attr)] = owner_values[song_id]
 
         rows.append(row)
 
@@ -270,16 +254,8 @@ def bulk_get_exemplars(objs, extras):
         segs = Segment.objects.filter(id__in=ids)
         id2tid = {x: y for x, y in segs.values_list("id", "tid")}
 
-    values = (
-        ExtraAttrValue.objects.filter(
-            attr__klass=Segment.__name__,
-            attr__name=granularity,
-            owner_id__in=ids,
-            user__username=viewas,
-        )
-        .order_by(Lower("value"), "owner_id")
-        .values_list("value", "owner_id")
-    )
+    owner_values = get_extra_attr_values(Segment.__name__, ids, viewas, [granularity]).get(granularity, {})
+    values = sorted(((y, x) for x, y in owner_values.items()), key=lambda x: (x[0].lower(), x[1]))
 
     class_to_exemplars = []
     current_class = ""
@@ -412,16 +388,16 @@ def bulk_get_song_sequences(all_songs, extras):
     if isinstance(current_database, Database):
         if isinstance(all_songs, QuerySet):
             all_songs = all_songs.filter(database=current_database)
-            song_ids = all_songs.values_list("id", flat=True)
         else:
             all_songs = [x.id for x in all_songs if x.database == current_database]
-            song_ids = all_songs
         segs = Segment.objects.filter(audio_file__in=all_songs).order_by("audio_file__name", "start_time_ms")
+        seg_id_to_label = get_sid_to_label(current_database, viewas, granularity)
     else:
         seg_ids = current_database.ids
         segs = Segment.objects.filter(id__in=seg_ids)
         song_ids = segs.values_list("audio_file").distinct()
         all_songs = AudioFile.objects.filter(id__in=song_ids)
+        seg_id_to_label = get_extra_attr_values(Segment.__name__, segs, viewas, [granularity])[granularity]
 
     values = segs.values_list(
         "id",
@@ -440,14 +416,6 @@ def bulk_get_song_sequences(all_songs, extras):
         "audio_file__individual__gender",
         "audio_file__individual__species__name",
     )
-    seg_ids = segs.values_list("id", flat=True)
-
-    label_attr = ExtraAttr.objects.get(klass=Segment.__name__, name=granularity)
-    labels = ExtraAttrValue.objects.filter(attr=label_attr, owner_id__in=seg_ids, user__username=viewas).values_list(
-        "owner_id", "value"
-    )
-
-    seg_id_to_label = {x: y for x, y in labels}
 
     ids = []
     rows = []
@@ -530,22 +498,12 @@ def bulk_get_song_sequences(all_songs, extras):
     ids += _ids
     rows += _rows
 
-    extra_attrs = ExtraAttr.objects.filter(klass=AudioFile.__name__)
-    extra_attr_values_list = ExtraAttrValue.objects.filter(
-        user__username=viewas, attr__in=extra_attrs, owner_id__in=song_ids
-    ).values_list("owner_id", "attr__name", "value")
-
-    extra_attr_values_lookup = {}
-    for id, attr, value in extra_attr_values_list:
-        if id not in extra_attr_values_lookup:
-            extra_attr_values_lookup[id] = {}
-        extra_attr_dict = extra_attr_values_lookup[id]
-        extra_attr_dict[attr] = value
+    extra_attr_values = get_extra_attr_values(AudioFile.__name__, all_songs, viewas)
 
     for song_id, row in zip(ids, rows):
-        extra_attr_dict = extra_attr_values_lookup.get(song_id, {})
-        for attr in extra_attr_dict:
-            row[attr] = extra_attr_dict[attr]
+        for attr, owner_values in extra_attr_values.items():
+            if song_id in owner_values:
+                row[attr] = owner_values[song_id]
 
     return ids, rows
 
@@ -571,16 +529,7 @@ def bulk_get_segments_for_audio(segs, extras):
     ids = []
     rows = []
 
-    extra_attr_values_list = ExtraAttrValue.objects.filter(
-        user__username=viewas, attr__klass=Segment.__name__, owner_id__in=segids
-    ).values_list("owner_id", "attr__name", "value")
-
-    extra_attr_values_lookup = {}
-    for id, attr, value in extra_attr_values_list:
-        if id not in extra_attr_values_lookup:
-            extra_attr_values_lookup[id] = {}
-        extra_attr_dict = extra_attr_values_lookup[id]
-        extra_attr_dict[attr] = value
+    extra_attr_values = get_extra_attr_values(Segment.__name__, segids, viewas)
 
     for id, start, end in values:
         # start = start * 44100 / 44000
@@ -590,10 +539,9 @@ def bulk_get_segments_for_audio(segs, extras):
         duration = end - start
         row = dict(id=id, start=start, end=end, duration=duration)
 
-        extra_attr_dict = extra_attr_values_lookup.get(id, {})
-
-        for attr in extra_attr_dict:
-            row[attr] = extra_attr_dict[attr]
+        for attr, owner_values in extra_attr_values.items():
+            if id in owner_values:
+                row[attr] = owner_values[id]
 
         rows.append(row)
 
@@ -631,6 +579,8 @@ def bulk_get_history_entries(hes, extras):
             "note",
             "version",
             "type",
+            "task__stage",
+            "task__pc_complete",
         )
     else:
         values = [
@@ -645,6 +595,8 @@ def bulk_get_history_entries(hes, extras):
                 x.note,
                 x.version,
                 x.type,
+                None if x.task is None else x.task.stage,
+                None if x.task is None else x.task.pc_complete,
             )
             for x in hes
         ]
@@ -662,6 +614,8 @@ def bulk_get_history_entries(hes, extras):
         note,
         version,
         type,
+        task_stage,
+        task_pc_complete,
     ) in values:
         ids.append(id)
         tztime = time.astimezone(tz)
@@ -669,7 +623,15 @@ def bulk_get_history_entries(hes, extras):
         user_is_creator = user.id == creator_id
         can_import = user_is_creator or has_import_permission(user.id, database_id)
 
-        if can_import:
+        # The zip file is still being written (or failed to be) in the background
+        if task_stage is not None and task_stage != TaskProgressStage.COMPLETED:
+            if task_stage == TaskProgressStage.ERROR:
+                url = "Failed to save"
+            else:
+                url = "Pending ({:.0f}%)".format(task_pc_complete)
+            file_size = 0
+            can_import = False
+        elif can_import:
             url_path = history_path(filename, for_url=True)
             local_file_path = url_path[1:]
             if os.path.isfile(local_file_path):
@@ -718,22 +680,16 @@ def bulk_get_song_sequence_associations(all_songs, extras):
         else:
             all_songs = [x.id for x in all_songs if x.database == current_database]
         segs = Segment.objects.filter(audio_file__in=all_songs).order_by("audio_file__name", "start_time_ms")
+        seg_id_to_label = get_sid_to_label(current_database, viewas, granularity)
     else:
         segs = Segment.objects.filter(id__in=current_database.ids)
+        seg_id_to_label = get_extra_attr_values(Segment.__name__, segs, viewas, [granularity])[granularity]
 
     if use_gap:
         values = segs.values_list("id", "audio_file__id", "start_time_ms", "end_time_ms")
     else:
         values = segs.values_list("id", "audio_file__id")
 
-    seg_ids = segs.values_list("id", flat=True)
-
-    label_attr = ExtraAttr.objects.get(klass=Segment.__name__, name=granularity)
-    labels = ExtraAttrValue.objects.filter(attr=label_attr, owner_id__in=seg_ids, user__username=viewas).values_list(
-        "owner_id", "value"
-    )
-
-    seg_id_to_label = {x: y for x, y in labels}
     label_set = set(seg_id_to_label.values())
     labels2enums = {y: x + 1 for x, y in enumerate(label_set)}
 
@@ -945,9 +901,12 @@ def get_syntactically_similar_pairs(request):
     if permission < DatabasePermission.ANNOTATE:
         raise CustomAssertionError("You don't have permission to annotate this database")
 
-    sids, tids = get_sids_tids(database)
-
-    label_arr = get_syllable_labels(user, granularity, sids, on_no_label="set_blank")
+    if isinstance(database, Database):
+        sids, enums, names = get_label_column(database, user, granularity)
+        label_arr = np.array([""] + [x.lower() for x in names])[enums]
+    else:
+        sids, tids = get_sids_tids(database)
+        label_arr = get_syllable_labels(user, granularity, sids, on_no_label="set_blank")
     cls_labels, syl_label_enum_arr = np.unique(label_arr, return_inverse=True)
 
     enum2label = {enum: label for enum, label in enumerate(cls_labels)}
@@ -4,6 +4,7 @@ tables = {
     "segment-info": {
         "class": "koe.Segment",
         "getter": "koe.bulk_get_segment_info",
+        "scoper": "koe.get_segment_info_scope",
         "columns": [
             {
                 "slug": "_sel",
@@ -27,11 +28,12 @@ tables = {
                 "is_attribute": True,
             },
             {"name": "Duration", "slug": "duration", "type": "FLOAT"},
-            {"name": "Song", "slug": "song", "type": "URL"},
+            {"name": "Song", "slug": "song", "type": "URL", "sql": "audio_file__name"},
             {
                 "name": "Spectrogram",
                 "slug": "spectrogram",
                 "type": "IMAGE",
+                "sql": "tid",
                 "formatter": "Spect",
                 "css_class": "has-image",
             },
@@ -75,12 +77,18 @@ tables = {
                 "name": "Song added",
                 "slug": "song_added",
                 "type": "DATE",
+                "sql": "audio_file__added",
             },
-            {"name": "Date of record", "slug": "record_date", "type": "DATE"},
-            {"name": "Sex", "slug": "sex", "type": "SHORT_TEXT"},
-            {"name": "Quality", "slug": "song_quality", "type": "SHORT_TEXT"},
-            {"name": "Individual", "slug": "song_individual", "type": "SHORT_TEXT"},
-            {"name": "Track", "slug": "song_track", "type": "SHORT_TEXT"},
+            {"name": "Date of record", "slug": "record_date", "type": "DATE", "sql": "audio_file__track__date"},
+            {"name": "Sex", "slug": "sex", "type": "SHORT_TEXT", "sql": "audio_file__individual__gender"},
+            {"name": "Quality", "slug": "song_quality", "type": "SHORT_TEXT", "sql": "audio_file__quality"},
+            {
+                "name": "Individual",
+                "slug": "song_individual",
+                "type": "SHORT_TEXT",
+                "sql": "audio_file__individual__name",
+            },
+            {"name": "Track", "slug": "song_track", "type": "SHORT_TEXT", "sql": "audio_file__track__name"},
         ],
     },
     "version-grid": {
@@ -0,0 +1,227 @@
+"""
+Denormalised labels of the syllables of a database, one column per (database, annotator, label level).
+A column is stored as an int array of label enums aligned to the sorted segment IDs of the database, so that grids,
+sequence mining and tensor metadata don't have to rebuild segment->label maps from ExtraAttrValue rows every time.
+
+Columns are updated in place when labels are changed through the setters (see koe.signals), removed when a single
+value is saved, and rebuilt on read if the segments of the database have changed or values of the label have been
+created or deleted since the column was saved. A value changed in place without going through the setters or save()
+(e.g. with QuerySet.update()) is NOT detected: call remove_label_columns() after doing that.
+Reading (and rebuilding) and updating a column hold an exclusive lock on it, so that overlapping requests can't
+overwrite each other's changes.
+"""
+
+import contextlib
+import fcntl
+import os
+
+from django.db.models import Count, Max
+
+import numpy as np
+
+from koe.models import Segment
+from root.models import ExtraAttr, ExtraAttrValue, User, get_extra_attr_values
+from root.utils import data_path, ensure_parent_folder_exists
+
+
+LABEL_STORE_FOLDER = "binary/labels"
+
+
+def _get_column_path(database_id, annotator_id, level):
+    return data_path("{}/{}/{}".format(LABEL_STORE_FOLDER, database_id, annotator_id), "{}.npz".format(level))
+
+
+@contextlib.contextmanager
+def _lock_column(path):
+    """
+    Hold an exclusive lock on a column, using a lock file next to it that is never removed
+    """
+    ensure_parent_folder_exists(path)
+    with open("{}.lock".format(path), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_signature(attr, annotator):
+    """
+    Catch values created or deleted without going through the setters. This can't catch values changed in place
+    """
+    stats = ExtraAttrValue.objects.filter(attr=attr, user=annotator).aggregate(count=Count("id"), max_id=Max("id"))
+    return np.array([stats["count"], stats["max_id"] or 0], dtype=np.int64)
+
+
+def _get_database_sids(database):
+    sids = Segment.objects.filter(audio_file__database=database).values_list("id", flat=True)
+    return np.sort(np.array(list(sids), dtype=np.int32))
+
+
+def _save_column(path, sids, enums, names, signature):
+    ensure_parent_folder_exists(path)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, sids=sids, enums=enums, names=np.array(names, dtype=str), signature=signature)
+    os.replace(tmp_path, path)
+
+
+def _load_column(path):
+    with np.load(path) as data:
+        return data["sids"], data["enums"], data["names"].tolist(), data["signature"]
+
+
+def build_label_column(database, annotator, level, sids=None):
+    """
+    Read the labels of all segments of a database from ExtraAttrValue
+    :param sids: sorted IDs of all segments of the database, if already known
+    :return: sids, enums, names. sids are sorted, enums[i] is the label of sids[i], which is names[enums[i] - 1] or
+             no label if enums[i] == 0
+    """
+    if sids is None:
+        sids = _get_database_sids(database)
+    segs = Segment.objects.filter(audio_file__database=database)
+    sid_to_label = get_extra_attr_values(Segment.__name__, segs, annotator, [level]).get(level, {})
+
+    names = sorted(set(sid_to_label.values()))
+    name_to_enum = {name: enum + 1 for enum, name in enumerate(names)}
+    enums = np.array([name_to_enum.get(sid_to_label.get(sid, None), 0) for sid in sids.tolist()], dtype=np.int32)
+    return sids, enums, names
+
+
+def get_label_column(database, annotator, level):
+    """
+    Get the labels of all segments of a database, from the store if it's up to date, otherwise rebuild it
+    :param database: a Database
+    :param annotator: the User (or username) who labelled
+    :param level: name of the label attribute, e.g. label, label_family, label_subfamily
+    :return: sids, enums, names (see build_label_column)
+    """
+    if isinstance(annotator, str):
+        annotator = User.objects.get(username=annotator)
+    attr = ExtraAttr.objects.get(klass=Segment.__name__, name=level)
+    path = _get_column_path(database.id, annotator.id, level)
+
+    with _lock_column(path):
+        signature = _get_signature(attr, annotator)
+        sids = _get_database_sids(database)
+
+        if os.path.isfile(path):
+            stored_sids, enums, names, stored_signature = _load_column(path)
+            if np.array_equal(stored_signature, signature) and np.array_equal(stored_sids, sids):
+                return stored_sids, enums, names
+
+        sids, enums, names = build_label_column(database, annotator, level, sids)
+        _save_column(path, sids, enums, names, signature)
+        return sids, enums, names
+
+
+def get_label_column_version(database, annotator, level):
+    """
+    Return the modification time of the stored column, which changes whenever the column is updated through the
+    setters or removed and rebuilt, or None if the column doesn't exist (e.g. it has been removed and not rebuilt yet).
+    The column is neither built nor checked against the values and the segments: for that, combine this with their
+    counts (see koe.ts_utils.get_metadata_version)
+    """
+    if isinstance(annotator, str):
+        annotator = User.objects.get(username=annotator)
+    path = _get_column_path(database.id, annotator.id, level)
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_sid_to_label(database, annotator, level):
+    """
+    :return: dict {sid -> label} of all labelled segments of the database
+    """
+    sids, enums, names = get_label_column(database, annotator, level)
+    labelled = np.flatnonzero(enums)
+    return {sid: names[enum - 1] for sid, enum in zip(sids[labelled].tolist(), enums[labelled].tolist())}
+
+
+def lookup_labels(column, sids, default=""):
+    """
+    Get the labels of the given segments from a column
+    :param column: sids, enums, names as returned by get_label_column
+    :param sids: IDs of segments, in any order
+    :param default: label of segments that have no label or are not in the column
+    :return: an array of labels aligned to sids
+    """
+    column_sids, enums, names = column
+    sids = np.asarray(sids, dtype=np.int32)
+    labels = np.array([default] + list(names), dtype=object)
+
+    positions = np.searchsorted(column_sids, sids)
+    positions[positions == len(column_sids)] = 0
+    found = column_sids[positions] == sids if len(column_sids) else np.zeros(len(sids), dtype=bool)
+
+    sid_enums = np.zeros(len(sids), dtype=np.int32)
+    sid_enums[found] = enums[positions[found]]
+    return labels[sid_enums]
+
+
+def update_label_columns(attr, annotator, owner_ids, value):
+    """
+    Update the stored columns after value has been set to the label attr of these segments. Columns that can't be
+    updated (because they don't contain all the segments) are removed and will be rebuilt on the next read
+    :param attr: the ExtraAttr
+    :param owner_ids: IDs of the segments. If None (unknown), all columns of this annotator and level are removed
+    :param value: the new value. If None (unknown), all columns of this annotator and level are removed
+    """
+    if owner_ids is None or value is None:
+        remove_label_columns(annotator, attr.name)
+        return
+
+    owner_ids = np.unique(np.array(list(owner_ids), dtype=np.int32))
+    database_ids = (
+        Segment.objects.filter(id__in=owner_ids.tolist()).values_list("audio_file__database", flat=True).distinct()
+    )
+
+    signature = None
+    for database_id in database_ids:
+        path = _get_column_path(database_id, annotator.id, attr.name)
+        if not os.path.isfile(path):
+            continue
+
+        with _lock_column(path):
+            if not os.path.isfile(path):
+                continue
+
+            sids, enums, names, _ = _load_column(path)
+            positions = np.searchsorted(sids, owner_ids)
+            positions[positions == len(sids)] = 0
+            found = sids[positions] == owner_ids if len(sids) else np.zeros(len(owner_ids), dtype=bool)
+            nsegments = Segment.objects.filter(id__in=owner_ids.tolist(), audio_file__database=database_id).count()
+
+            if found.sum() != nsegments:
+                os.remove(path)
+                continue
+
+            if value not in names:
+                names.append(value)
+            enums[positions[found]] = names.index(value) + 1
+
+            if signature is None:
+                signature = _get_signature(attr, annotator)
+            _save_column(path, sids, enums, names, signature)
+
+
+def remove_label_columns(annotator, level=None):
+    """
+    Remove the stored columns of this annotator, in all databases. Their lock files are kept, as other processes
+    may be holding them
+    :param level: if given, only remove columns of this label level
+    """
+    store_folder = data_path(LABEL_STORE_FOLDER, "")
+    if not os.path.isdir(store_folder):
+        return
+
+    for database_folder in os.listdir(store_folder):
+        annotator_folder = os.path.join(store_folder, database_folder, str(annotator.id))
+        if not os.path.isdir(annotator_folder):
+            continue
+        for filename in os.listdir(annotator_folder):
+            if filename == "{}.npz".format(level) or (level is None and filename.endswith(".npz")):
+                os.remove(os.path.join(annotator_folder, filename))
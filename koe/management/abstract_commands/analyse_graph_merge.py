@@ -13,10 +13,11 @@ import numpy as np
 from progress.bar import Bar
 from scipy.cluster.hierarchy import cut_tree
 
-from koe.cluster_analysis_utils import NameMerger, merge_labels
-from koe.graph_utils import extract_graph_feature, resolve_meas
+from koe.cluster_analysis_utils import NameMerger, get_class_of_sids
+from koe.graph_utils import extract_graph_feature_from_labels, resolve_meas
 from koe.management.utils.parser_utils import read_cluster_range
 from koe.models import AudioFile, Database
+from koe.sequence_utils import get_song_sid_sequences
 
 
 class AnalyseGraphMergeCommand(BaseCommand):
@@ -24,6 +25,14 @@ class AnalyseGraphMergeCommand(BaseCommand):
         parser.add_argument("--profile", action="store", dest="profile", required=True, type=str)
         parser.add_argument("--niter", action="store", dest="niter", required=False, type=int)
         parser.add_argument("--nrand", action="store", dest="nrand", required=False, type=int)
+        parser.add_argument(
+            "--seed",
+            action="store",
+            dest="seed",
+            required=False,
+            type=int,
+            help="Seed of the random and lattice reference graphs, to make small world measures reproducible",
+        )
         parser.add_argument("--measurements", action="store", dest="measurements", required=True)
         parser.add_argument("--cluster-range", action="store", dest="cluster_range", default="0:-1")
 
@@ -39,16 +48,16 @@ class AnalyseGraphMergeCommand(BaseCommand):
         profile = options["profile"]
         niter = options["niter"]
         nrand = options["nrand"]
+        seed = options["seed"]
         measurements_str = options["measurements"]
         cluster_range = options["cluster_range"]
 
         tsv_filename = profile + ".tsv"
         pkl_filename = profile + ".pkl"
 
-        name_merger_class = self.get_name_merger_class(options)
-
         measurements_order, measurements_output = resolve_meas(measurements_str)
-        extra_args = dict(niter=niter, nrand=nrand)
+        extra_args = dict(niter=niter, nrand=nrand, seed=seed)
+        timings = {}
 
         if not os.path.isfile(pkl_filename):
             saved_dict = self.prepare_data_for_analysis(pkl_filename, options)
@@ -63,8 +72,6 @@ class AnalyseGraphMergeCommand(BaseCommand):
         database = Database.objects.get(id=saved_dict["dbid"])
         songs = AudioFile.objects.filter(database=database)
 
-        enum2label = {enum: label for enum, label in enumerate(unique_labels)}
-
         heights = tree[:, 2]
         clusters = cut_tree(tree, height=heights)
         clusters_sizes = np.max(clusters, axis=0)
@@ -82,23 +89,28 @@ class AnalyseGraphMergeCommand(BaseCommand):
         total_run = n_suitable_clusters
         bar = Bar("Running...", max=total_run, suffix="%(percent).1f%% - %(eta)ds")
 
+        # Load the song sequences once and find the class of every syllable in them. For each cut-off the syllables
+        # are then relabelled by indexing, without going back to the database
+        seq_sids, song_starts = get_song_sid_sequences(songs)
+        seq_classes = get_class_of_sids(sids, classes_info, len(unique_labels), seq_sids)
+        has_class = seq_classes >= 0
+
         with open(tsv_filename, "w") as f:
             f.write("Cutoff\tNum clusters\t" + "\t".join(measurements_output) + "\n")
 
         for i in range(n_suitable_clusters):
-            name_merger = name_merger_class()
-            merge_func = name_merger.merge
-
             cutoff = cutoffs[i]
             clustering = suitable_clusters[:, i]
             ncluster = np.max(clustering) + 1
-            sid_to_cluster, merged_enum2label = merge_labels(clustering, classes_info, sids, enum2label, merge_func)
+            seq_clusters = np.full(len(seq_sids), -1, dtype=np.int64)
+            seq_clusters[has_class] = clustering[seq_classes[has_class]] + 1
 
-            measurements_values = extract_graph_feature(
-                songs,
-                sid_to_cluster,
-                merged_enum2label,
+            measurements_values = extract_graph_feature_from_labels(
+                seq_clusters,
+                song_starts,
+                ncluster + 1,
                 measurements_order,
+                timings,
                 **extra_args,
             )
 
@@ -108,3 +120,7 @@ class AnalyseGraphMergeCommand(BaseCommand):
                 f.write("{}\t{}\t".format(cutoff, ncluster) + extractable_values_as_string + "\n")
             bar.next()
         bar.finish()
+
+        print("Time spent on each measurement:")
+        for name, elapsed in sorted(timings.items(), key=lambda x: -x[1]):
+            print("    {}: {:.2f} seconds".format(name, elapsed))
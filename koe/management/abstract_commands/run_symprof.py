@@ -31,6 +31,11 @@ from scipy.spatial.distance import pdist
 from scipy.stats import ttest_1samp, zscore
 
 from koe.feature_utils import pca_optimal
+from koe.trial_utils import run_trials
+
+
+# Maximum number of elements of the (trials x classes x classes) matrices computed at once by permuted_pdists
+MAX_BATCH_ELEMENTS = 10**7
 
 
 def calc_ranking(class_measures):
@@ -39,24 +44,77 @@ def calc_ranking(class_measures):
     return sorted_dist
 
 
+def batch_pdist(batch_measures):
+    """
+    Same as pdist() on each matrix of a batch, computed for the whole batch at once
+    :param batch_measures: (ntrials x nclasses x nfeatures) array
+    :return: (ntrials x nclasses * (nclasses - 1) / 2) array, row i is pdist(batch_measures[i])
+    """
+    nclasses = batch_measures.shape[1]
+    # The upper triangle, in the same (row-major) order as pdist()
+    triu_mask = np.triu(np.ones((nclasses, nclasses), dtype=bool), 1)
+
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab, computed in place on the Gram matrices
+    sq_norms = np.einsum("tij,tij->ti", batch_measures, batch_measures)
+    sq_dists = np.matmul(batch_measures, batch_measures.transpose(0, 2, 1))
+    sq_dists *= -2
+    sq_dists += sq_norms[:, :, None]
+    sq_dists += sq_norms[:, None, :]
+
+    dists = sq_dists[:, triu_mask]
+    np.maximum(dists, 0, out=dists)
+    return np.sqrt(dists, out=dists)
+
+
 class Permuter(object):
     @abstractmethod
     def __init__(self, *args):
         self.iterable_cols = None
 
-    def permute(self, class_measures):
+    def get_col_groups(self, nfeatures):
+        """
+        :return: array of nfeatures elements, the index of the group (in iterable_cols) of each column, or -1
+        """
+        col_groups = np.full(nfeatures, -1, dtype=np.int64)
+        for group_ind, cols in enumerate(self.iterable_cols):
+            col_groups[cols] = group_ind
+        return col_groups
+
+    def permute_batch(self, class_measures, ntrials):
+        """
+        For each trial and each feature (or group of features), randomly swap the measurements between classes.
+        All trials are done at once using a 3-D index array: the row to copy for each trial, class and column
+        :return: (ntrials x nclasses x nfeatures) array
+        """
         nclasses, nfeatures = class_measures.shape
-        # for each feature (each column), randomly swap the measurements between classes
-        # We do this by copying the data from the source column to another column using a random mapping
-        # e.g. destination[:, feature_index] = source[random_column_idx, feature_index]
-        new_class_measures = np.ndarray((nclasses, nfeatures), dtype=class_measures.dtype)
+        ngroups = len(self.iterable_cols)
+
+        # A random order of the rows for each trial and each group. The extra last group is for columns that are not
+        # in any group (col_groups = -1), these are not permuted
+        row_inds = np.empty((ntrials, nclasses, ngroups + 1), dtype=np.int64)
+        row_inds[:, :, :ngroups] = np.argsort(np.random.rand(ntrials, nclasses, ngroups), axis=1)
+        row_inds[:, :, ngroups] = np.arange(nclasses)
+
+        col_inds = np.arange(nfeatures)
+        return class_measures[row_inds[:, :, self.get_col_groups(nfeatures)], col_inds]
+
+    def permute(self, class_measures):
+        return self.permute_batch(class_measures, 1)[0]
 
-        for feature_index in self.iterable_cols:
-            random_row_inds = np.arange(nclasses)
-            np.random.shuffle(random_row_inds)
+    def permuted_pdists(self, class_measures, ntrials):
+        """
+        :return: (ntrials x nclasses * (nclasses - 1) / 2) array, the pdist() of ntrials permutations of class_measures
+        """
+        nclasses = class_measures.shape[0]
+        # Distances are not changed by translation, and batch_pdist is more precise on centred data
+        class_measures = class_measures - class_measures.mean(axis=0)
+        batch_size = max(1, MAX_BATCH_ELEMENTS // (nclasses * nclasses))
 
-            new_class_measures[:, feature_index] = class_measures[random_row_inds, :][:, feature_index]
-        return new_class_measures
+        dists = np.empty((ntrials, nclasses * (nclasses - 1) // 2))
+        for start in range(0, ntrials, batch_size):
+            end = min(start + batch_size, ntrials)
+            dists[start:end, :] = batch_pdist(self.permute_batch(class_measures, end - start))
+        return dists
 
 
 class PcaPermuter(Permuter):
@@ -75,10 +133,7 @@ def are_rankings_structural(measures, dist_triu, permuter, significance, ntrials
     if len(dist_triu) < 3:
         return False
     original_rankings = np.sort(dist_triu)
-    rankings = np.ndarray((ntrials, original_rankings.shape[0]))
-    for i in range(ntrials):
-        new_class_measures = permuter.permute(measures)
-        rankings[i, :] = calc_ranking(new_class_measures)
+    rankings = np.sort(permuter.permuted_pdists(measures, ntrials), axis=1)
 
     # Trial_mean is an array of len(dist_triu) elements, so is trial_std and random_deviations
     trial_mean = np.mean(rankings, axis=0)
@@ -102,13 +157,8 @@ def is_variance_structural(measures, dist_triu, permuter, significance, ntrials)
     if measures.shape[1] < 3:
         return False
 
-    dist_variances = np.ndarray((ntrials,))
     observed_dist_variance = np.var(dist_triu)
-
-    for i in range(ntrials):
-        new_class_measures = permuter.permute(measures)
-        class_dist_triu = pdist(new_class_measures)
-        dist_variances[i] = np.var(class_dist_triu)
+    dist_variances = np.var(permuter.permuted_pdists(measures, ntrials), axis=1)
 
     t_value, p_value = ttest_1samp(dist_variances, observed_dist_variance)
 
@@ -142,6 +192,46 @@ def cut_tree_get_leaves(tree, height):
     return leaves
 
 
+def split_if_structural(
+    global_measures, permuter, global_cls_inds, min_cluster_size, max_deviation, ntrials, is_structural
+):
+    """
+    :return: list of the global indices of the classes in each sub-cluster, or None if the classes are one cluster
+    """
+    print("Considering {} classes".format(len(global_cls_inds)))
+    if global_cls_inds.shape[0] < min_cluster_size:
+        return None
+
+    local_measures = global_measures[global_cls_inds, :]
+
+    dist_triu = pdist(local_measures)
+    local_tree = linkage(dist_triu, method="complete")
+    cutoff = local_tree[:, 2].max()
+
+    if not is_structural(local_measures, dist_triu, permuter, max_deviation, ntrials):
+        return None
+
+    leaves = cut_tree_get_leaves(local_tree, cutoff)
+    return [global_cls_inds[leaf_class_inds] for leaf_class_inds in leaves]
+
+
+def _recursive_simprof(global_measures, permuter, global_cls_inds, clusters, *args):
+    sub_clusters = split_if_structural(global_measures, permuter, global_cls_inds, *args)
+    if sub_clusters is None:
+        clusters.append(global_cls_inds)
+    else:
+        for leaf_class_global_inds in sub_clusters:
+            _recursive_simprof(global_measures, permuter, leaf_class_global_inds, clusters, *args)
+
+
+def _simprof_subtree(work_item, shared):
+    global_cls_inds, seed = work_item
+    np.random.seed(seed)
+    clusters = []
+    _recursive_simprof(shared["global_measures"], shared["permuter"], global_cls_inds, clusters, *shared["args"])
+    return clusters
+
+
 def recursive_simprof(
     global_measures,
     permuter,
@@ -152,34 +242,42 @@ def recursive_simprof(
     ntrials=100,
     is_structural=are_rankings_structural,
 ):
-    print("Considering {} classes".format(len(global_cls_inds)))
-    if global_cls_inds.shape[0] < min_cluster_size:
-        clusters.append(global_cls_inds)
+    """
+    Split the classes recursively for as long as they are structural, and append the resulting clusters to clusters.
+    If settings.EVALUATION_WORKERS > 1, the tree is first split breadth-first (largest cluster first) until there are
+    that many subtrees, then the subtrees are run in parallel. The clusters are in the same order either way
+    """
+    args = (min_cluster_size, max_deviation, ntrials, is_structural)
+    nworkers = settings.EVALUATION_WORKERS
+    if nworkers <= 1:
+        _recursive_simprof(global_measures, permuter, global_cls_inds, clusters, *args)
         return
 
-    local_measures = global_measures[global_cls_inds, :]
-    local_to_global_inds = {x: y for x, y in enumerate(global_cls_inds)}
+    # (class indices, is final) of each node of the tree cut so far, in depth-first order
+    nodes = [(global_cls_inds, False)]
+    while True:
+        unfinished = [i for i, (cls_inds, is_final) in enumerate(nodes) if not is_final]
+        if len(unfinished) == 0 or len(unfinished) >= nworkers:
+            break
+        node_ind = max(unfinished, key=lambda x: len(nodes[x][0]))
+        cls_inds = nodes[node_ind][0]
+        sub_clusters = split_if_structural(global_measures, permuter, cls_inds, *args)
+        if sub_clusters is None:
+            nodes[node_ind] = (cls_inds, True)
+        else:
+            nodes[node_ind : node_ind + 1] = [(x, False) for x in sub_clusters]
 
-    dist_triu = pdist(local_measures)
-    local_tree = linkage(dist_triu, method="complete")
-    cutoff = local_tree[:, 2].max()
+    # Each subtree gets its own seed, otherwise all workers would inherit the same random state
+    seeds = np.random.randint(2**31, size=len(nodes)).tolist()
+    work_items = [(i, (cls_inds, seeds[i])) for i, (cls_inds, is_final) in enumerate(nodes) if not is_final]
+    shared = dict(global_measures=global_measures, permuter=permuter, args=args)
+    subtree_clusters = dict(run_trials(_simprof_subtree, work_items, shared))
 
-    if is_structural(local_measures, dist_triu, permuter, max_deviation, ntrials):
-        leaves = cut_tree_get_leaves(local_tree, cutoff)
-        for leaf_class_inds in leaves:
-            leaf_class_global_inds = np.array([local_to_global_inds[i] for i in leaf_class_inds])
-            recursive_simprof(
-                global_measures,
-                permuter,
-                leaf_class_global_inds,
-                clusters,
-                min_cluster_size,
-                max_deviation,
-                ntrials,
-                is_structural,
-            )
-    else:
-        clusters.append(global_cls_inds)
+    for i, (cls_inds, is_final) in enumerate(nodes):
+        if is_final:
+            clusters.append(cls_inds)
+        else:
+            clusters.extend(subtree_clusters[i])
 
 
 def get_permuter(nfeatures, feature_grouper, dm) -> Permuter:
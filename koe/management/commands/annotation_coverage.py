@@ -0,0 +1,50 @@
+"""
+Report how much of each database has been labelled by each annotator, at each label level
+"""
+
+from django.core.management.base import BaseCommand
+
+from koe.annotation_coverage import get_annotation_coverage, label_levels
+from koe.models import Database
+from root.models import User
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database-name",
+            action="store",
+            dest="database_name",
+            required=False,
+            type=str,
+            help="Only report this database. Omit to report all databases",
+        )
+
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            dest="refresh",
+            default=False,
+            help="Recount instead of using the cached counts",
+        )
+
+    def handle(self, database_name, refresh, *args, **options):
+        databases = Database.objects.all().order_by("name")
+        if database_name:
+            databases = databases.filter(name__iexact=database_name)
+
+        user_id_to_name = {x: y for x, y in User.objects.values_list("id", "username")}
+
+        for database in databases:
+            nsyls, counts = get_annotation_coverage(database, list(user_id_to_name.keys()), refresh)
+            print("{}: {} syllables".format(database.name, nsyls))
+
+            for user_id, user_counts in sorted(counts.items(), key=lambda x: user_id_to_name.get(x[0], "")):
+                if not any(user_counts.values()):
+                    continue
+                percentages = []
+                for level in label_levels:
+                    count = user_counts.get(level, 0)
+                    percentage = count / nsyls * 100 if nsyls else 100
+                    percentages.append("{}: {} ({:.1f}%)".format(level, count, percentage))
+                print("    {}: {}".format(user_id_to_name.get(user_id, user_id), ", ".join(percentages)))
@@ -0,0 +1,58 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from progress.bar import Bar
+
+import koe.binstorage3 as bs3
+from koe.storage_utils import get_storage_loc_template
+
+
+def find_storage_folders(root_folder):
+    """
+    :return: all folders under root_folder (inclusive) that contain binstorage3 index files
+    """
+    storage_folders = []
+    for folder, _, filenames in os.walk(root_folder):
+        if any(x.startswith(bs3.INDEX_PREFIX) for x in filenames):
+            storage_folders.append(folder)
+    return storage_folders
+
+
+def humanise_bytes(nbytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if nbytes < 1024:
+            return "{:.1f}{}".format(nbytes, unit)
+        nbytes /= 1024
+    return "{:.1f}TB".format(nbytes)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--folder",
+            action="store",
+            dest="folder",
+            required=False,
+            type=str,
+            help="Storage folder to compact (recursively). Default: the feature storage folder",
+        )
+
+    def handle(self, *args, **options):
+        root_folder = options["folder"] or os.path.dirname(get_storage_loc_template())
+
+        storage_folders = find_storage_folders(root_folder)
+        bar = Bar("Compacting...", max=len(storage_folders))
+
+        reclaimeds = {}
+        for storage_folder in storage_folders:
+            reclaimeds[storage_folder] = bs3.compact(storage_folder)
+            bar.next()
+        bar.finish()
+
+        for storage_folder, reclaimed in reclaimeds.items():
+            if reclaimed:
+                relpath = os.path.relpath(storage_folder, root_folder)
+                print("{}: {} reclaimed".format(relpath, humanise_bytes(reclaimed)))
+
+        print("Total space reclaimed: {}".format(humanise_bytes(sum(reclaimeds.values()))))
@@ -0,0 +1,82 @@
+"""
+Pre-encode the audio clips of all segments, so that playing them doesn't require encoding in the web request
+"""
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from progress.bar import Bar
+
+from koe.audio_clips import CLIPS_FOLDER, encode_clips, get_clip_key, get_clip_path, get_segments_clip_info
+from koe.models import Database, Segment
+from root.utils import data_path
+
+
+def remove_unused_clips(used_clip_paths):
+    """
+    Remove clips that don't belong to any of the given paths (e.g. clips of segments that have been changed/deleted)
+    :return: number of clips removed
+    """
+    clips_dir = data_path(CLIPS_FOLDER, "")
+    nremoved = 0
+    for root, _, files in os.walk(clips_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if file_path not in used_clip_paths:
+                os.remove(file_path)
+                nremoved += 1
+    return nremoved
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            action="store",
+            dest="database_name",
+            required=False,
+            type=str,
+            help="Name of the database to encode clips. Omit to run for all databases",
+        )
+
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            dest="force",
+            default=False,
+            help="Re-encode clips that already exist",
+        )
+
+        parser.add_argument(
+            "--clean",
+            action="store_true",
+            dest="clean",
+            default=False,
+            help="Also remove clips that no longer belong to any segment. Only allowed when running for all databases",
+        )
+
+    def handle(self, database_name, force, clean, *args, **options):
+        if database_name is not None:
+            if clean:
+                raise Exception("--clean can only be used when running for all databases")
+
+            database = Database.objects.filter(name=database_name).first()
+            if database is None:
+                raise Exception("Database {} not found!".format(database_name))
+            segments = Segment.objects.filter(audio_file__database=database)
+        else:
+            segments = Segment.objects.all()
+
+        clips_info = get_segments_clip_info(segments)
+
+        bar = Bar("Encoding {} clips".format(settings.AUDIO_COMPRESSED_FORMAT), max=len(clips_info))
+        nencoded = encode_clips(clips_info, force=force, bar=bar)
+        bar.finish()
+        print("{} clips encoded out of {} segments".format(nencoded, len(clips_info)))
+
+        if clean:
+            used_clip_paths = set(get_clip_path(get_clip_key(*clip_args)) for _, clip_args in clips_info)
+            nremoved = remove_unused_clips(used_clip_paths)
+            print("{} unused clips removed".format(nremoved))
@@ -20,6 +20,7 @@ from koe.ts_utils import (
     bytes_to_ndarray,
     get_rawdata_from_binary,
     ndarray_to_bytes,
+    ndarray_to_columnar,
     reduce_funcs,
     write_config,
 )
@@ -57,11 +58,13 @@ def create_full_tensor(database, recreate):
     full_sids_path = full_tensor.get_sids_path()
     full_bytes_path = full_tensor.get_bytes_path()
     full_cols_path = full_tensor.get_cols_path()
+    full_columns_path = full_tensor.get_columns_path()
 
     sids, tids = get_sids_tids(database)
     data, col_inds = extract_rawdata(tids, features, aggregators)
 
     ndarray_to_bytes(data, full_bytes_path)
+    ndarray_to_columnar(data, col_inds, full_columns_path)
     ndarray_to_bytes(sids, full_sids_path)
 
     with open(full_cols_path, "w", encoding="utf-8") as f:
@@ -17,7 +17,13 @@ from sklearn.manifold import MDS, TSNE
 from koe.model_utils import get_or_error
 from koe.models import Aggregation, Database, Feature, FullTensorData
 from koe.storage_utils import get_sids_tids
-from koe.ts_utils import bytes_to_ndarray, cherrypick_tensor_data_by_sids, get_rawdata_from_binary
+from koe.ts_utils import (
+    bytes_to_ndarray,
+    cherrypick_tensor_data_by_sids,
+    columnar_to_ndarray,
+    get_rawdata_from_binary,
+    get_rows_by_sids,
+)
 
 
 class Command(BaseCommand):
@@ -86,9 +92,9 @@ class Command(BaseCommand):
 
         full_sids_path = full_tensor.get_sids_path()
         full_bytes_path = full_tensor.get_bytes_path()
+        full_columns_path = full_tensor.get_columns_path()
 
         full_sids = bytes_to_ndarray(full_sids_path, np.int32)
-        full_data = get_rawdata_from_binary(full_bytes_path, len(full_sids))
 
         sids, tids = get_sids_tids(database, population_name)
 
@@ -103,7 +109,12 @@ class Command(BaseCommand):
                 coordinate = saved["coordinate"]
                 stress = saved["stress"]
         else:
-            population_data = cherrypick_tensor_data_by_sids(full_data, full_sids, sids).astype(np.float64)
+            if os.path.isfile(full_columns_path):
+                rows = get_rows_by_sids(full_sids, sids)
+                population_data = columnar_to_ndarray(full_columns_path, rows=rows).astype(np.float64)
+            else:
+                full_data = get_rawdata_from_binary(full_bytes_path, len(full_sids))
+                population_data = cherrypick_tensor_data_by_sids(full_data, full_sids, sids).astype(np.float64)
 
             if normalised:
                 population_data = zscore(population_data)
@@ -14,7 +14,6 @@ import json
 import os
 
 from django.core.management.base import BaseCommand
-from django.db.models import Case, When
 
 import numpy as np
 from audeep.backend.data import data_set
@@ -23,6 +22,7 @@ from pathlib2 import Path
 from koe.model_utils import get_or_error
 from koe.models import Database, DataMatrix, Segment
 from koe.ts_utils import ndarray_to_bytes
+from root.models import get_ordered_values
 
 
 class Command(BaseCommand):
@@ -70,9 +70,7 @@ class Command(BaseCommand):
 
         nobs, ndims = dataset.features.shape
 
-        preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(sids)])
-        segments = Segment.objects.filter(id__in=sids).order_by(preserved)
-        tids = segments.values_list("tid", flat=True)
+        tids = get_ordered_values(Segment.objects, sids, ["tid"], flat=True)
 
         col_inds = {"s2s_autoencoded": [0, ndims]}
 
@@ -0,0 +1,35 @@
+"""
+(Re)build the spectrogram packs of all pages (or of the given pages) from the individual PNGs.
+Packs are kept up to date automatically when SPECT_PACKS is enabled, this is for packing existing spectrograms
+"""
+
+from django.core.management.base import BaseCommand
+
+from progress.bar import Bar
+
+from koe.spect_packs import get_spect_pages, pack_spectrograms
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--page",
+            action="append",
+            dest="pages",
+            required=False,
+            type=int,
+            help="Page to pack, can be given multiple times. Omit to pack all pages",
+        )
+
+    def handle(self, pages, *args, **options):
+        if pages is None:
+            pages = get_spect_pages()
+
+        npacked = 0
+        bar = Bar("Packing spectrograms", max=len(pages))
+        for page in pages:
+            npacked += pack_spectrograms(page)
+            bar.next()
+        bar.finish()
+
+        print("Packed {} spectrograms in {} pages".format(npacked, len(pages)))
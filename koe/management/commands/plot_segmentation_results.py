@@ -1,13 +1,13 @@
 import pickle
 
 from django.core.management import BaseCommand
-from django.db.models import Case, When
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 
 from koe.models import AudioFile
+from root.models import get_ordered_values
 
 
 class Command(BaseCommand):
@@ -75,8 +75,7 @@ class Command(BaseCommand):
                     result_by_type["Recall"][name].append(recall)
                     result_by_type["Elapsed"][name].append(elapsed)
 
-                preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(af_ids)])
-                af_vl = AudioFile.objects.filter(id__in=af_ids).order_by(preserved).values_list("length", "fs")
+                af_vl = get_ordered_values(AudioFile.objects, af_ids, ["length", "fs"])
                 result_by_type["Duration"][name] = [x / y for x, y in af_vl]
 
         def ps_to_sigs(ps):
@@ -20,13 +20,15 @@ from koe.feature_utils import (
     construct_ordination,
     extract_database_measurements,
 )
-from koe.models import DataMatrix, Ordination, SimilarityIndex, Task, TaskProgressStage
+from koe.models import DataMatrix, HistoryEntry, Ordination, SimilarityIndex, Task, TaskProgressStage
+from koe.request_handlers.history import save_history_async
 
 
 cls2func = {
     DataMatrix.__name__: extract_database_measurements,
     Ordination.__name__: construct_ordination,
     SimilarityIndex.__name__: calculate_similarity,
+    HistoryEntry.__name__: save_history_async,
 }
 
 
@@ -1,4 +1,5 @@
 import json
+import os
 import pickle
 
 from django.core.management.base import BaseCommand
@@ -11,39 +12,59 @@ from koe.aggregator import aggregator_map
 from koe.feature_utils import pca_optimal
 from koe.features.feature_extract import feature_map
 from koe.management.commands.lstm import exclude_no_labels, get_labels_by_sids
-from koe.ml_utils import classifiers, get_ratios
+from koe.ml_utils import classifiers, get_ratios, make_fold_work_items, run_fold
 from koe.model_utils import get_or_error
 from koe.models import Aggregation, Database, DataMatrix, Feature
 from koe.rnn_models import EnumDataProvider
 from koe.storage_utils import get_tids
+from koe.trial_utils import run_trials
 from koe.ts_utils import bytes_to_ndarray, get_rawdata_from_binary
 from root.models import User
 
 
-def perform_k_fold(classifier, tvset, nfolds, v2a_ratio, nlabels, **classifier_args):
+def perform_k_fold(classifier, tvset, nfolds, v2a_ratio, nlabels, seed=None, **classifier_args):
     """
-    Perform k-fold validation
+    Perform k-fold validation. The folds are run in parallel if settings.EVALUATION_WORKERS > 1
     :param v2a_ratio: ratio between validation set and (valid + train) set
     :param nfolds: number of folds
     :param tvset: data set for train+validation data. This should not contain the test set
-    :return:
+    :param seed: if given, the folds are split and the classifiers are seeded the same way every time
+    :return: mean score of all folds
     """
-    tvset.make_folds(nfolds, v2a_ratio)
-    scores = []
-    for i in range(nfolds):
-        trainset, validset = tvset.get_fold(i)
-        train_x = np.array(trainset.data)
-        train_y = np.array(trainset.labels, dtype=np.int32)
-        valid_x = np.array(validset.data)
-        valid_y = np.array(validset.labels, dtype=np.int32)
-
-        score, label_hits, label_misses, importances = classifier(
-            train_x, train_y, valid_x, valid_y, nlabels, **classifier_args
-        )
-        scores.append(score)
+    enum_labels = np.array(tvset.labels, dtype=np.int32)
+    work_items = make_fold_work_items(enum_labels, nfolds, 1, seed, v2a_ratio)
+    shared = dict(
+        data=np.array(tvset.data),
+        enum_labels=enum_labels,
+        nlabels=nlabels,
+        classifier=classifier,
+        classifier_args=classifier_args,
+    )
+
+    scores = [result[0] for _, result in run_trials(run_fold, work_items, shared)]
     return np.mean(scores)
 
 
+def load_trials(checkpoint_file, signature):
+    """
+    :return: the trials saved by save_trials() if they are of the same run, otherwise new Trials
+    """
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file, "rb") as f:
+            saved = pickle.load(f)
+        if saved["signature"] == signature:
+            return saved["trials"]
+        print("Checkpoint {} is of a different run, starting over".format(checkpoint_file))
+    return Trials()
+
+
+def save_trials(checkpoint_file, signature, trials):
+    tmp_file = "{}.tmp".format(checkpoint_file)
+    with open(tmp_file, "wb") as f:
+        pickle.dump(dict(signature=signature, trials=trials), f)
+    os.replace(tmp_file, checkpoint_file)
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
@@ -122,6 +143,16 @@ class Command(BaseCommand):
 
         parser.add_argument("--dm-name", dest="dm_name", action="store", required=False)
 
+        parser.add_argument(
+            "--seed",
+            action="store",
+            dest="seed",
+            default=0,
+            type=int,
+            help="Seed of the data split, the folds and the hyperparameter search. Runs are only resumed from the "
+            "checkpoint if the seed and all other arguments are the same",
+        )
+
     def handle(self, *args, **options):
         clsf_type = options["clsf_type"]
         database_name = options["database_name"]
@@ -133,6 +164,7 @@ class Command(BaseCommand):
         ratio_ = options["ratio"]
         profile = options["profile"]
         dm_name = options["dm_name"]
+        seed = options["seed"]
 
         tsv_file = profile + ".tsv"
         trials_file = profile + ".trials"
@@ -246,6 +278,7 @@ class Command(BaseCommand):
                 explained, data = pca_optimal(data, ndims, 0.9)
                 pca_dims = data.shape[1]
 
+            np.random.seed(seed)
             dp = EnumDataProvider(data, labels, balanced=True)
             trainvalidset, testset = dp.split(test_ratio, limits=(ipc_min, ipc_max))
 
@@ -271,6 +304,7 @@ class Command(BaseCommand):
                     nfolds,
                     v2t_ratio,
                     nlabels,
+                    seed,
                     **classifier_args,
                 )
                 return 1.0 - score
@@ -321,15 +355,36 @@ class Command(BaseCommand):
                 params_converters.append(converter)
                 params_count += 1
 
-            trials = Trials()
-            max_evals = params_count * 30
-            best = fmin(
-                fn=loss,
-                space=space,
-                algo=tpe.suggest,
-                max_evals=max_evals,
-                trials=trials,
+            # Completed trials are saved after each one, so that an interrupted run resumes from where it stopped
+            checkpoint_file = "{}.{}.checkpoint".format(profile, ftgroup_name)
+            signature = dict(
+                clsf_type=clsf_type,
+                dm=dm.id,
+                source=source,
+                annotator=annotator.id,
+                label_level=label_level,
+                min_occur=min_occur,
+                ipc=ipc,
+                ratio=ratio_,
+                seed=seed,
             )
+            trials = load_trials(checkpoint_file, signature)
+            max_evals = params_count * 30
+
+            while len(trials.trials) < max_evals:
+                # Seeding each trial by its index means a resumed run makes the same suggestions
+                fmin(
+                    fn=loss,
+                    space=space,
+                    algo=tpe.suggest,
+                    max_evals=len(trials.trials) + 1,
+                    trials=trials,
+                    rstate=np.random.default_rng(seed + len(trials.trials)),
+                    show_progressbar=False,
+                )
+                save_trials(checkpoint_file, signature, trials)
+
+            best = trials.argmin
             print(best)
 
             with open(trials_file, "wb") as f:
@@ -19,6 +19,7 @@ from scipy.io import loadmat
 from scipy.stats import zscore
 
 from koe.ml_utils import classifiers, run_nfolds
+from koe.trial_utils import TrialCheckpoint
 
 
 class Command(BaseCommand):
@@ -70,7 +71,18 @@ class Command(BaseCommand):
 
         parser.add_argument("--to-csv", dest="csv_filename", action="store", required=False)
 
-    def handle(self, clsf_type, matfile, source, nfolds, niters, csv_filename, *args, **options):
+        parser.add_argument(
+            "--seed",
+            action="store",
+            dest="seed",
+            required=False,
+            default=0,
+            type=int,
+            help="Seed of the folds and classifiers. Completed folds are only reused by a resumed run if the seed "
+            "and all other arguments are the same",
+        )
+
+    def handle(self, clsf_type, matfile, source, nfolds, niters, csv_filename, seed, *args, **options):
         assert clsf_type in classifiers.keys(), "Unknown _classify: {}".format(clsf_type)
         assert source in ["raw", "norm"]
 
@@ -103,9 +115,19 @@ class Command(BaseCommand):
         best_fts_ids = []
         best_fts_names = []
 
+        if csv_filename is None:
+            csv_filename = "marathon_{}_{}.csv".format(clsf_type, source)
+
+        # Every completed fold is saved here, so that an interrupted run skips them when started again
+        checkpoint_file = "{}.checkpoint".format(csv_filename)
+        signature = dict(clsf_type=clsf_type, matfile=matfile, source=source, nfolds=nfolds, niters=niters, seed=seed)
+        checkpoint = TrialCheckpoint(checkpoint_file, signature)
+
         # What is the recognition rate when all features are used?
         bar = Bar("Running {} on {} using all features ...".format(clsf_type, source))
-        label_prediction_scores, _, _ = run_nfolds(data, nsyls, nfolds, niters, enum_labels, nlabels, classifier, bar)
+        label_prediction_scores, _, _ = run_nfolds(
+            data, nsyls, nfolds, niters, enum_labels, nlabels, classifier, bar, seed, checkpoint, "all"
+        )
         mean_label_prediction_scores = np.nanmean(label_prediction_scores)
         std_label_prediction_scores = np.nanstd(label_prediction_scores)
 
@@ -113,8 +135,6 @@ class Command(BaseCommand):
         print("Cutoff value is {}".format(cutoff))
         i = 0
 
-        if csv_filename is None:
-            csv_filename = "marathon_{}_{}.csv".format(clsf_type, source)
         with open(csv_filename, "w", encoding="utf-8") as f:
             f.write("Feature name, Recognition rate\n")
             f.flush()
@@ -141,6 +161,9 @@ class Command(BaseCommand):
                         nlabels,
                         classifier,
                         None,
+                        seed,
+                        checkpoint,
+                        tuple(combined_ft_inds.tolist()),
                     )
                     rates[j] = np.nanmean(label_prediction_scores)
                     bar.next()
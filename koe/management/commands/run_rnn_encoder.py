@@ -14,14 +14,13 @@ from logging import info, warning
 from django.core.management.base import BaseCommand
 
 import numpy as np
-from ml.s2senc_utils import read_variables
 from progress.bar import Bar
 
 from koe.ml.nd_vl_s2s_autoencoder import NDS2SAEFactory
+from koe.ml.s2senc_utils import get_segs_info, iter_spects, read_variables
 from koe.model_utils import get_or_error
 from koe.models import Database, Segment
 from koe.spect_utils import extractors
-from koe.utils import wav_path
 from root.utils import mkdirp
 
 
@@ -34,33 +33,17 @@ def extract_syllables(database_name, spect_dir, format):
 
     extractor = extractors[format]
 
-    audio_file_dict = {}
-    for seg in segments:
-        af = seg.audio_file
-        if af in audio_file_dict:
-            info = audio_file_dict[af]
-        else:
-            info = []
-            audio_file_dict[af] = info
-        info.append((seg.id, seg.start_time_ms, seg.end_time_ms))
-
-    bar = Bar("Exporting segments ...", max=len(segments))
-
-    for af, info in audio_file_dict.items():
-        wav_file_path = wav_path(af)
-        fs = af.fs
-        database = af.database
-        nfft = database.nfft
-        noverlap = database.noverlap
+    def get_spect_path(sid):
+        return os.path.join(spect_dir, "{}.{}".format(sid, format))
 
-        for sid, start, end in info:
-            spect_name = "{}.{}".format(sid, format)
-            spect_path = os.path.join(spect_dir, spect_name)
+    segs_info = [x for x in get_segs_info(segments) if not os.path.isfile(get_spect_path(x[0]))]
 
-            if not os.path.isfile(spect_path):
-                extractor(wav_file_path, fs, start, end, nfft, noverlap, spect_path)
+    bar = Bar("Exporting segments ...", max=len(segs_info))
 
-            bar.next()
+    for seg_info, spect in iter_spects(segs_info, extractor):
+        with open(get_spect_path(seg_info[0]), "wb") as f:
+            pickle.dump(spect, f)
+        bar.next()
     bar.finish()
 
 
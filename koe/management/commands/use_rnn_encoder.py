@@ -10,17 +10,24 @@ import os
 from collections import OrderedDict
 
 from django.core.management.base import BaseCommand
-from django.db.models import Case, F, When
+from django.db.models import F
 
 import numpy as np
-from ml.s2senc_utils import encode_syllables, read_variables, spect_from_seg
 
 from koe.features.feature_extract import feature_map
 from koe.ml.nd_vl_s2s_autoencoder import NDS2SAEFactory
+from koe.ml.s2senc_utils import (
+    encode_syllables,
+    get_segs_info,
+    get_spect_transform,
+    iter_spect_batches,
+    read_variables,
+)
 from koe.model_utils import get_or_error
 from koe.models import AudioFile, Database, DataMatrix, Segment
 from koe.spect_utils import extractors, load_global_min_max, psd2img
 from koe.ts_utils import ndarray_to_bytes
+from root.models import get_ordered_values
 from root.utils import mkdirp
 
 
@@ -31,43 +38,23 @@ def reconstruct_syllables(variables, encoder, session, segs):
     global_max = variables.get("global_max", None)
     global_min = variables.get("global_min", None)
     global_range = global_max - global_min
-    num_segs = len(segs)
+    use_cache = variables.get("cache_spects", False)
+    transform = get_spect_transform(variables)
     batch_size = 200
 
     is_log_psd = variables["is_log_psd"]
 
-    num_batches = num_segs // batch_size
-    if num_segs / batch_size > num_batches:
-        num_batches += 1
-
-    seg_idx = -1
+    segs_info = get_segs_info(segs)
     reconstruction_result = {}
 
-    for batch_idx in range(num_batches):
-        if batch_idx == num_batches - 1:
-            batch_size = num_segs - (batch_size * batch_idx)
-
-        print("Batch #{}/#{} batch size {}".format(batch_idx, num_batches, batch_size))
-
-        lengths = []
-        batch_segs = []
-        spects = []
-        for idx in range(batch_size):
-            seg_idx += 1
-            seg = segs[seg_idx]
-            batch_segs.append(seg)
-            spect = spect_from_seg(seg, extractor)
-            if denormalised:
-                spect = (spect - global_min) / global_range
-
-            dims, length = spect.shape
-            lengths.append(length)
-            spects.append(spect.T)
+    batches = iter_spect_batches(segs_info, extractor, batch_size, transform, encoder.proprocess_samples, use_cache)
+    for batch_segs_info, spects, lengths, preprocessed in batches:
+        print("Batch size {}".format(len(spects)))
 
-        reconstructed = encoder.predict(spects, session=session)
+        reconstructed = encoder.predict(spects, session=session, preprocessed=preprocessed)
 
-        for spect, recon, seg, length in zip(spects, reconstructed, batch_segs, lengths):
-            sid = seg.id
+        for spect, recon, seg_info, length in zip(spects, reconstructed, batch_segs_info, lengths):
+            sid = seg_info[0]
             spect = spect[:length, :].T
             recon = recon[:length, :].T
 
@@ -104,18 +91,15 @@ def encode_into_datamatrix(variables, encoder, session, database_name, kernel_on
     sids = sids[sid_sorted_inds]
     features_value = features_value[sid_sorted_inds]
 
-    preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(sids)])
-    segments = segments.order_by(preserved)
-    tids = segments.values_list("tid", flat=True)
+    tids = get_ordered_values(segments, sids, ["tid"], flat=True)
 
     features = [feature_map["s2s_autoencoded"]]
     col_inds = {"s2s_autoencoded": [0, ndims]}
     if with_duration:
         features.append(feature_map["duration"])
         col_inds["duration"] = [ndims, ndims + 1]
-        durations = list(
-            segments.annotate(duration=F("end_time_ms") - F("start_time_ms")).values_list("duration", flat=True)
-        )
+        segments = segments.annotate(duration=F("end_time_ms") - F("start_time_ms"))
+        durations = get_ordered_values(segments, sids, ["duration"], flat=True)
         durations = np.array(durations)
         assert len(durations) == len(sids)
         features_value = np.concatenate((features_value, durations.reshape(-1, 1)), axis=1)
@@ -228,6 +212,13 @@ class Command(BaseCommand):
         parser.add_argument("--with-duration", action="store_true", dest="with_duration", default=False)
         parser.add_argument("--denormalised", action="store_true", dest="denormalised", default=False)
         parser.add_argument("--min-max-loc", action="store", dest="min_max_loc", default=False)
+        parser.add_argument(
+            "--cache-spects",
+            action="store_true",
+            dest="cache_spects",
+            default=False,
+            help="Keep the spectrograms in binary storage to not recompute them next time",
+        )
 
     def handle(self, *args, **options):
         mode = options["mode"]
@@ -241,6 +232,7 @@ class Command(BaseCommand):
         with_duration = options["with_duration"]
         min_max_loc = options["min_max_loc"]
         denormalised = options["denormalised"]
+        cache_spects = options["cache_spects"]
 
         extractor = extractors[format]
 
@@ -275,6 +267,7 @@ class Command(BaseCommand):
         variables["extractor"] = extractor
         variables["with_duration"] = with_duration
         variables["denormalised"] = denormalised
+        variables["cache_spects"] = cache_spects
 
         if denormalised:
             global_min, global_max = load_global_min_max(min_max_loc)
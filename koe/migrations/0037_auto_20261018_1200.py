@@ -0,0 +1,22 @@
+# Generated by Django 2.0.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("koe", "0036_auto_20200524_2123"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ordination",
+            name="stale",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="similarityindex",
+            name="stale",
+            field=models.BooleanField(default=False),
+        ),
+    ]
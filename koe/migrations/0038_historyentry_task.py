@@ -0,0 +1,20 @@
+# Generated by Django 2.0.4 on 2026-10-18 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("koe", "0037_auto_20261018_1200"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="historyentry",
+            name="task",
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="koe.Task"
+            ),
+        ),
+    ]
@@ -592,7 +592,10 @@ class _NDS2SAE:
         saver.restore(session, tf.train.latest_checkpoint(self.tmp_folder))
         return session
 
-    def _predict_or_encode(self, mode, test_seq, session=None):
+    def _predict_or_encode(self, mode, test_seq, session=None, preprocessed=None):
+        """
+        :param preprocessed: result of proprocess_samples(test_seq) if already computed
+        """
         if mode == "predict":
             ops = self.inference_decoder_output
         elif mode == "encode":
@@ -601,7 +604,9 @@ class _NDS2SAE:
             ops = self.enc_state_centre
 
         batch_size = len(test_seq)
-        X_batch, source_sequence_lens, target_sequence_lens = self.proprocess_samples(test_seq)
+        if preprocessed is None:
+            preprocessed = self.proprocess_samples(test_seq)
+        X_batch, source_sequence_lens, target_sequence_lens = preprocessed
 
         actual_start_tokens = np.full((batch_size, self.output_dim), self.go_token, dtype=np.float32)
         feed_dict = {
@@ -622,8 +627,8 @@ class _NDS2SAE:
 
         return result
 
-    def predict(self, test_seq, session=None, res_len=None):
-        decoder_output = self._predict_or_encode("predict", test_seq, session)
+    def predict(self, test_seq, session=None, res_len=None, preprocessed=None):
+        decoder_output = self._predict_or_encode("predict", test_seq, session, preprocessed)
         padded_output = decoder_output.rnn_output
         if res_len is None:
             return padded_output
@@ -633,10 +638,10 @@ class _NDS2SAE:
             retval.append(y[:leny])
         return retval
 
-    def encode(self, test_seq, session=None, kernel_only=False):
+    def encode(self, test_seq, session=None, kernel_only=False, preprocessed=None):
         if kernel_only:
-            states = self._predict_or_encode("encode-centre", test_seq, session)
+            states = self._predict_or_encode("encode-centre", test_seq, session, preprocessed)
             return states
         else:
-            states = self._predict_or_encode("encode", test_seq, session)
+            states = self._predict_or_encode("encode", test_seq, session, preprocessed)
             return np.concatenate(states, axis=1)
@@ -1,9 +1,22 @@
 import json
+import os
+import queue
+import threading
 import zipfile
 
+from django.conf import settings
+
+import numpy as np
 from progress.bar import Bar
 
-from koe.utils import wav_path
+from koe import binstorage3 as bs
+from koe.models import AudioFile
+from koe.utils import wav_path, worker_pool
+from root.utils import data_path, mkdirp
+
+
+# Number of batches kept ready ahead of the one being consumed by the encoder
+PREFETCH_BATCHES = 2
 
 
 def read_variables(save_to):
@@ -31,49 +44,211 @@ def spect_from_seg(seg, extractor):
     )
 
 
+def get_segs_info(segs):
+    """
+    Get everything needed to extract the spectrograms of these segments, with two queries instead of two per segment
+    :param segs: a QuerySet of Segment
+    :return: list of (sid, tid, wav_file_path, fs, start, end, nfft, noverlap), in the same order as segs
+    """
+    values = list(segs.values_list("id", "tid", "audio_file", "start_time_ms", "end_time_ms"))
+    af_ids = list(set(x[2] for x in values))
+    audio_files = AudioFile.objects.filter(id__in=af_ids).select_related("database", "original__database")
+
+    af_info = {}
+    for af in audio_files:
+        af_info[af.id] = (wav_path(af), af.fs, af.database.nfft, af.database.noverlap)
+
+    segs_info = []
+    for sid, tid, af_id, start, end in values:
+        wav_file_path, fs, nfft, noverlap = af_info[af_id]
+        segs_info.append((sid, tid, wav_file_path, fs, start, end, nfft, noverlap))
+    return segs_info
+
+
+def get_spect_cache_loc(extractor, nfft, noverlap):
+    return data_path("binary/s2senc_spects", "{}/{}-{}".format(extractor.__name__, nfft, noverlap))
+
+
+def _extract_spect(work_item):
+    seg_info, extractor = work_item
+    sid, tid, wav_file_path, fs, start, end, nfft, noverlap = seg_info
+    return seg_info, extractor(wav_file_path, fs=fs, start=start, end=end, nfft=nfft, noverlap=noverlap)
+
+
+def _read_cached_spects(segs_info, extractor):
+    """
+    :return: dict {sid -> spect} of the segments whose spectrograms are in the cache
+    """
+    retval = {}
+    loc_to_segs_info = {}
+    for seg_info in segs_info:
+        loc = get_spect_cache_loc(extractor, seg_info[6], seg_info[7])
+        loc_to_segs_info.setdefault(loc, []).append(seg_info)
+
+    for loc, loc_segs_info in loc_to_segs_info.items():
+        if not os.path.isdir(loc):
+            continue
+        tids = np.array([x[1] for x in loc_segs_info], dtype=np.int32)
+        cached_tids = bs.retrieve_ids(loc, (tids.min(), tids.max()))
+        cached_segs_info = [x for x, cached in zip(loc_segs_info, np.isin(tids, cached_tids)) if cached]
+        if len(cached_segs_info) == 0:
+            continue
+        spects = bs.retrieve([x[1] for x in cached_segs_info], loc)
+        for seg_info, spect in zip(cached_segs_info, spects):
+            retval[seg_info[0]] = spect
+    return retval
+
+
+def _cache_spects(extracted, extractor):
+    """
+    :param extracted: list of (seg_info, spect) to add to the cache
+    """
+    loc_to_extracted = {}
+    for seg_info, spect in extracted:
+        loc = get_spect_cache_loc(extractor, seg_info[6], seg_info[7])
+        loc_to_extracted.setdefault(loc, {})[seg_info[1]] = spect
+
+    for loc, tid_to_spect in loc_to_extracted.items():
+        mkdirp(loc)
+        tids = list(tid_to_spect.keys())
+        bs.store(tids, [tid_to_spect[x] for x in tids], loc)
+
+
+def iter_spects(segs_info, extractor, use_cache=False, window_size=1000):
+    """
+    Extract the spectrograms of the segments in a pool of settings.FEATURE_EXTRACTION_WORKERS processes, reading
+    them from (and adding them to) the cache if use_cache is True.
+    Segments are sent to the pool window_size at a time, so that not much more than that many spectrograms are ever
+    held in memory
+    :param segs_info: as returned by get_segs_info
+    :param extractor: one of koe.spect_utils.extractors
+    :return: generator of (seg_info, spect), not necessarily in the same order as segs_info
+    """
+    with worker_pool(min(settings.FEATURE_EXTRACTION_WORKERS, len(segs_info))) as imap:
+        for window_start in range(0, len(segs_info), window_size):
+            window = segs_info[window_start : window_start + window_size]
+            cached = _read_cached_spects(window, extractor) if use_cache else {}
+            for seg_info in window:
+                spect = cached.get(seg_info[0], None)
+                if spect is not None:
+                    yield seg_info, spect
+
+            work_items = [(x, extractor) for x in window if x[0] not in cached]
+            extracted = []
+            for seg_info, spect in imap(_extract_spect, work_items):
+                if use_cache:
+                    extracted.append((seg_info, spect))
+                yield seg_info, spect
+
+            if len(extracted):
+                _cache_spects(extracted, extractor)
+
+
+def iter_spect_batches(segs_info, extractor, batch_size, transform=None, preprocess=None, use_cache=False):
+    """
+    Load spectrograms in batches ready to be given to the encoder. Batches are prepared in a background thread
+    (with the spectrograms extracted by iter_spects) and kept PREFETCH_BATCHES ahead, so that the encoder doesn't
+    wait for them
+    :param transform: a function applied to each spectrogram, e.g. to normalise it
+    :param preprocess: a function applied to each batch of spectrograms, e.g. to pad them. Its result is the last
+                       element of each batch
+    :return: generator of (batch_segs_info, spects, lengths, preprocessed), each spect is transposed to be
+             (length x dims). Batches are not in any particular order
+    """
+    batches = queue.Queue(maxsize=PREFETCH_BATCHES)
+    finished = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def make_batch(batch):
+        batch_segs_info = []
+        spects = []
+        lengths = []
+        for seg_info, spect in batch:
+            if transform is not None:
+                spect = transform(spect)
+            batch_segs_info.append(seg_info)
+            lengths.append(spect.shape[1])
+            spects.append(spect.T)
+        preprocessed = None if preprocess is None else preprocess(spects)
+        return batch_segs_info, spects, lengths, preprocessed
+
+    def produce():
+        spects = iter_spects(segs_info, extractor, use_cache)
+        try:
+            batch = []
+            for item in spects:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    if not put(make_batch(batch)):
+                        return
+                    batch = []
+            if len(batch):
+                put(make_batch(batch))
+            put(finished)
+        except Exception as e:
+            put(e)
+        finally:
+            spects.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def get_spect_transform(variables):
+    """
+    :return: the function to normalise spectrograms if variables say that they are denormalised, otherwise None
+    """
+    if not variables["denormalised"]:
+        return None
+
+    global_min = variables["global_min"]
+    global_range = variables["global_max"] - global_min
+
+    def transform(spect):
+        return (spect - global_min) / global_range
+
+    return transform
+
+
 def encode_syllables(variables, encoder, session, segs, kernel_only):
     num_segs = len(segs)
     batch_size = 200
     extractor = variables["extractor"]
-    denormalised = variables["denormalised"]
-    global_max = variables.get("global_max", None)
-    global_min = variables.get("global_min", None)
-    global_range = global_max - global_min
+    use_cache = variables.get("cache_spects", False)
+    transform = get_spect_transform(variables)
 
-    num_batches = num_segs // batch_size
-    if num_segs / batch_size > num_batches:
-        num_batches += 1
-
-    seg_idx = -1
+    segs_info = get_segs_info(segs)
     encoding_result = {}
 
     bar = Bar("", max=num_segs)
+    batches = iter_spect_batches(segs_info, extractor, batch_size, transform, encoder.proprocess_samples, use_cache)
+    for batch_segs_info, spects, lengths, preprocessed in batches:
+        bar.message = "Batch size {}".format(len(spects))
+        encoded = encoder.encode(spects, session=session, kernel_only=kernel_only, preprocessed=preprocessed)
 
-    for batch_idx in range(num_batches):
-        if batch_idx == num_batches - 1:
-            batch_size = num_segs - (batch_size * batch_idx)
-
-        bar.message = "Batch #{}/#{} batch size {}".format(batch_idx, num_batches, batch_size)
-
-        lengths = []
-        batch_segs = []
-        spects = []
-        for idx in range(batch_size):
-            seg_idx += 1
-            seg = segs[seg_idx]
-            batch_segs.append(seg)
-            spect = spect_from_seg(seg, extractor)
-            if denormalised:
-                spect = (spect - global_min) / global_range
-
-            dims, length = spect.shape
-            lengths.append(length)
-            spects.append(spect.T)
-            bar.next()
-        encoded = encoder.encode(spects, session=session, kernel_only=kernel_only)
-
-        for encod, seg, length in zip(encoded, batch_segs, lengths):
-            encoding_result[seg.id] = encod
+        for encod, seg_info in zip(encoded, batch_segs_info):
+            encoding_result[seg_info[0]] = encod
+        bar.next(len(spects))
 
-        bar.finish()
+    bar.finish()
     return encoding_result
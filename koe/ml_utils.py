@@ -1,3 +1,4 @@
+import random
 import sys
 import time
 from random import shuffle
@@ -13,6 +14,7 @@ from sklearn.neighbors import KNeighborsClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.svm import SVC
 
+from koe.trial_utils import run_trials
 from koe.utils import accum, split_classwise
 
 
@@ -182,48 +184,97 @@ def run_clustering(dataset, dim_reduce, n_components, n_dims=3):
     return tsne_results
 
 
-def run_nfolds(data, nsyls, nfolds, niters, enum_labels, nlabels, classifier, bar):
+def run_fold(work_item, shared):
+    """
+    Train the classifier on the training indices of one fold and score it on the test indices
+    """
+    train_syl_idx, test_syl_idx, seed = work_item
+    data = shared["data"]
+    enum_labels = shared["enum_labels"]
+
+    if seed is not None:
+        np.random.seed(seed)
+        random.seed(seed)
+
+    train_y = enum_labels[train_syl_idx]
+    test_y = enum_labels[test_syl_idx]
+
+    train_x = data[train_syl_idx, :]
+    test_x = data[test_syl_idx, :]
+
+    classifier = shared["classifier"]
+    return classifier(train_x, train_y, test_x, test_y, shared["nlabels"], **shared["classifier_args"])
+
+
+def make_fold_work_items(enum_labels, nfolds, niters, seed=None, ratio=None):
+    """
+    Split the data into folds, niters times
+    :param seed: if given, the folds and the seed of each fold are the same every time
+    :param ratio: ratio of the test set in each fold, default 1 / nfolds
+    :return: list of (trial index, (train indices, test indices, seed)), as work items of run_fold
+    """
+    if ratio is None:
+        ratio = 1.0 / nfolds
+    work_items = []
+    for i in range(niters):
+        if seed is not None:
+            np.random.seed(seed + i)
+        folds = split_classwise(enum_labels, ratio, nfolds)
+        fold_seeds = [None] * nfolds if seed is None else np.random.randint(2**31, size=nfolds).tolist()
+
+        for k, fold in enumerate(folds):
+            work_items.append((i * nfolds + k, (fold["train"], fold["test"], fold_seeds[k])))
+    return work_items
+
+
+def run_nfolds(
+    data,
+    nsyls,
+    nfolds,
+    niters,
+    enum_labels,
+    nlabels,
+    classifier,
+    bar,
+    seed=None,
+    checkpoint=None,
+    checkpoint_key=None,
+    **classifier_args,
+):
+    """
+    Run k-fold validation niters times. The folds are run in parallel if settings.EVALUATION_WORKERS > 1
+    :param seed: if given, the folds are split and the classifiers are seeded the same way every time
+    :param checkpoint: a TrialCheckpoint to resume from / save the completed folds to. Only makes sense with a seed
+    :param checkpoint_key: identifies this run among the others saved to the same checkpoint
+    :return: label_prediction_scores, label_hitrates, importancess (one row per fold)
+    """
     ntrials = nfolds * niters
     if bar:
         bar.max = ntrials
 
     label_prediction_scores = [0] * ntrials
-    label_hitss = [0] * ntrials
-    label_missess = [0] * ntrials
     label_hitrates = np.empty((ntrials, nlabels))
     label_hitrates[:] = np.nan
     importancess = np.empty((ntrials, data.shape[1]))
 
-    ind = 0
-
-    for i in range(niters):
-        folds = split_classwise(enum_labels, nfolds)
-
-        for fold in folds:
-            test_syl_idx = fold["test"]
-            train_syl_idx = fold["train"]
-
-            train_y = enum_labels[train_syl_idx]
-            test_y = enum_labels[test_syl_idx]
-
-            train_x = data[train_syl_idx, :]
-            test_x = data[test_syl_idx, :]
-
-            score, label_hits, label_misses, importances = classifier(train_x, train_y, test_x, test_y, nlabels)
-
-            label_prediction_scores[ind] = score
-            label_hitss[ind] = label_hits
-            label_missess[ind] = label_misses
-
-            label_hitrate = label_hits / (label_hits + label_misses).astype(np.float)
+    work_items = [((checkpoint_key, ind), x) for ind, x in make_fold_work_items(enum_labels, nfolds, niters, seed)]
+    shared = dict(
+        data=data,
+        enum_labels=enum_labels,
+        nlabels=nlabels,
+        classifier=classifier,
+        classifier_args=classifier_args,
+    )
 
-            label_hitrates[ind, :] = label_hitrate
-            importancess[ind, :] = importances
+    for (_, ind), result in run_trials(run_fold, work_items, shared, checkpoint):
+        score, label_hits, label_misses, importances = result
 
-            ind += 1
+        label_prediction_scores[ind] = score
+        label_hitrates[ind, :] = label_hits / (label_hits + label_misses).astype(float)
+        importancess[ind, :] = importances
 
-            if bar:
-                bar.next()
+        if bar:
+            bar.next()
     if bar:
         bar.finish()
 
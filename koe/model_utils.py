@@ -1,7 +1,9 @@
 import os
+import uuid
 from collections import Counter
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 
 import numpy as np
@@ -10,7 +12,7 @@ from PIL import Image
 from scipy import signal
 from scipy.cluster.hierarchy import linkage
 
-from koe.celery_init import app
+from koe.celery_init import app, celery_is_up
 from koe.colourmap import cm_blue, cm_green, cm_red
 from koe.models import (
     AudioFile,
@@ -21,6 +23,7 @@ from koe.models import (
     Segment,
     TemporaryDatabase,
 )
+from koe.spect_packs import update_spect_packs
 from koe.utils import audio_path, get_abs_spect_path, mat2triu, triu2mat, wav_path
 from koe.wavfile import get_wav_info, read_segment
 from root.exceptions import CustomAssertionError
@@ -40,6 +43,11 @@ global_max_spect_pixel = 2.8522987365722656
 global_spect_pixel_range = global_max_spect_pixel - global_min_spect_pixel
 interval64 = global_spect_pixel_range / 63
 
+# Segments are rendered from STFTs of at most this much audio at a time
+SPECT_MAX_SPAN_MS = 60000
+# Wait for this long before rendering spectrograms in the background, to merge repeated saves of the same file
+SPECT_DEBOUNCE_SECONDS = 3
+
 
 def add_node(node, idx_2_seg_id, parent, root_triu):
     """
@@ -248,26 +256,73 @@ def get_user_databases(user):
     return current_database
 
 
+def _spect_to_image(spect):
+    """
+    Convert a magnitude spectrogram into a colour image, low frequencies at the bottom
+    :param spect: magnitude spectrogram (nfreqs x nframes)
+    :return: a PIL Image
+    """
+    height, width = np.shape(spect)
+    spect = np.flipud(spect)
+
+    with np.errstate(divide="ignore"):
+        spect = np.log10(spect)
+    spect = (spect - global_min_spect_pixel) / interval64
+    spect[np.isinf(spect)] = 0
+    spect = spect.astype(int)
+
+    spect = spect.reshape((width * height,), order="C")
+    spect[spect >= 64] = 63
+    spect_rgb = np.empty((height, width, 3), dtype=np.uint8)
+    spect_rgb[:, :, 0] = cm_red[spect].reshape((height, width)) * 255
+    spect_rgb[:, :, 1] = cm_green[spect].reshape((height, width)) * 255
+    spect_rgb[:, :, 2] = cm_blue[spect].reshape((height, width)) * 255
+
+    return Image.fromarray(spect_rgb)
+
+
+def _group_segments_by_span(segs_info, max_span_ms):
+    """
+    Group segments (sorted by start) such that each group spans no longer than max_span_ms (unless one segment alone
+    is longer than that)
+    """
+    groups = []
+    for tid, start, end in sorted(segs_info, key=lambda x: x[1]):
+        if groups and end - groups[-1][0][1] <= max_span_ms:
+            groups[-1].append((tid, start, end))
+        else:
+            groups.append([(tid, start, end)])
+    return groups
+
+
 def extract_spectrogram(audio_file, segs_info):
     """
     Extract raw sepectrograms for all segments (Not the masked spectrogram from Luscinia) of an audio file
+    Instead of one STFT per segment, the audio covering many segments is read and transformed once, then each
+    segment's image is cut out of it. The images have the same size as those of the STFT of each segment alone, and
+    approximately the same frames: the first frame starts at the nearest multiple of the hop from the start of the
+    span rather than exactly at the segment's start, and the frames at the edges cover the neighbouring audio instead
+    of the STFT's zero padding.
     :param audio_file:
+    :param segs_info: list of (tid, start, end)
     :return:
     """
     filepath = wav_path(audio_file)
 
-    fs, duration = get_wav_info(filepath)
     if not os.path.isfile(filepath):
         raise CustomAssertionError("File {} not found".format(audio_file.name))
+    fs, duration = get_wav_info(filepath)
+
+    hop = int(window_size - noverlap)
 
-    for tid, start, end in segs_info:
-        seg_spect_path = get_abs_spect_path(tid)
-        ensure_parent_folder_exists(seg_spect_path)
+    for group in _group_segments_by_span(segs_info, SPECT_MAX_SPAN_MS):
+        span_start = min(x[1] for x in group)
+        span_end = max(x[2] for x in group)
 
         sig = read_segment(
             filepath,
-            beg_ms=start,
-            end_ms=end,
+            beg_ms=span_start,
+            end_ms=span_end,
             mono=True,
             normalised=True,
             return_fs=False,
@@ -282,31 +337,78 @@ def extract_spectrogram(audio_file, segs_info):
             nfft=window_size,
             return_onesided=True,
         )
-        spect = np.abs(s * scale)
+        span_spect = np.abs(s * scale)
+        nframes = span_spect.shape[1]
 
-        height, width = np.shape(spect)
-        spect = np.flipud(spect)
+        for tid, start, end in group:
+            seg_spect_path = get_abs_spect_path(tid)
+            ensure_parent_folder_exists(seg_spect_path)
+
+            # Same number of frames as the STFT of the segment alone, which is read in multiples of window_size
+            seg_nsamples = int(np.ceil(float(end - start) * fs / 1000 / window_size)) * window_size
+            width = seg_nsamples // hop + 1
+            first_frame = int(round(float(start - span_start) * fs / 1000 / hop))
+            last_frame = min(first_frame + width, nframes)
+
+            spect = np.zeros((span_spect.shape[0], width), dtype=span_spect.dtype)
+            spect[:, : last_frame - first_frame] = span_spect[:, first_frame:last_frame]
+
+            seg_spect_img = _spect_to_image(spect)
+            seg_spect_img.save(seg_spect_path, format="PNG")
+            celerylogger.info("spectrogram {} created".format(seg_spect_path))
+
+    update_spect_packs([x[0] for x in segs_info])
 
-        spect = np.log10(spect)
-        spect = (spect - global_min_spect_pixel) / interval64
-        spect[np.isinf(spect)] = 0
-        spect = spect.astype(int)
 
-        spect = spect.reshape((width * height,), order="C")
-        spect[spect >= 64] = 63
-        spect_rgb = np.empty((height, width, 3), dtype=np.uint8)
-        spect_rgb[:, :, 0] = cm_red[spect].reshape((height, width)) * 255
-        spect_rgb[:, :, 1] = cm_green[spect].reshape((height, width)) * 255
-        spect_rgb[:, :, 2] = cm_blue[spect].reshape((height, width)) * 255
+def _spect_debounce_key(audio_file_id):
+    return "spect-extraction-{}".format(audio_file_id)
 
-        # roi_start = int(start / duration_ms * width)
-        # roi_end = int(np.ceil(end / duration_ms * width))
 
-        # seg_spect_rgb = file_spect_rgb[:, roi_start:roi_end, :]
-        seg_spect_img = Image.fromarray(spect_rgb)
+@app.task(bind=False)
+def extract_missing_spectrograms_async(audio_file_id, token=None, *args, **kwargs):
+    """
+    Render the spectrograms of all segments of an audio file that don't have one.
+    :param token: if given and another extraction has been queued for the same file after this one, do nothing and
+                  let the later one render all missing spectrograms.
+    """
+    if token is not None:
+        latest_token = cache.get(_spect_debounce_key(audio_file_id))
+        if latest_token is not None and latest_token != token:
+            return
+
+    audio_file = AudioFile.objects.filter(id=audio_file_id).first()
+    if audio_file is None:
+        return
+
+    segs_info = Segment.objects.filter(audio_file=audio_file).values_list("tid", "start_time_ms", "end_time_ms")
+    segs_info = [x for x in segs_info if not os.path.isfile(get_abs_spect_path(x[0]))]
+    if len(segs_info):
+        extract_spectrogram(audio_file, segs_info)
+
+
+def queue_spectrogram_extraction(audio_file, segs_info):
+    """
+    Extract spectrograms of the segments off the request, in the background.
+    Existing images of these segments are removed straight away so that they are shown as pending (and not as the
+    old image). Saving the same file again within SPECT_DEBOUNCE_SECONDS replaces the queued extraction instead
+    of adding another one.
+    If celery is not running (or in DEBUG) the spectrograms are extracted synchronously
+    :param audio_file:
+    :param segs_info: list of (tid, start, end)
+    :return: None
+    """
+    if settings.DEBUG or not celery_is_up():
+        extract_spectrogram(audio_file, segs_info)
+        return
+
+    for tid, _, _ in segs_info:
+        spect_path = get_abs_spect_path(tid)
+        if os.path.isfile(spect_path):
+            os.remove(spect_path)
 
-        seg_spect_img.save(seg_spect_path, format="PNG")
-        celerylogger.info("spectrogram {} created".format(seg_spect_path))
+    token = uuid.uuid4().hex
+    cache.set(_spect_debounce_key(audio_file.id), token, SPECT_DEBOUNCE_SECONDS * 10)
+    extract_missing_spectrograms_async.apply_async(args=(audio_file.id, token), countdown=SPECT_DEBOUNCE_SECONDS)
 
 
 def assert_permission(user, database, required_level):
@@ -383,12 +485,15 @@ def delete_segments_async(*args, **kwargs):
 
     # These segmnents might share the same spectrogram with other segments. Only delete the spectrogramn
     # if there is only one segment (ID) associated with the syllable's TID
+    deleted_tids = []
     for tid, ids in tid2ids.items():
         if len(ids) == 1:
             spect_path = get_abs_spect_path(tid)
             if os.path.isfile(spect_path):
                 os.remove(spect_path)
+                deleted_tids.append(tid)
                 celerylogger.info("Spectrogram {} deleted.".format(spect_path))
+    update_spect_packs(deleted_tids)
 
     ExtraAttrValue.objects.filter(attr__klass=Segment.__name__, owner_id__in=this_sids).delete()
     segments.delete()
@@ -433,6 +433,10 @@ class Segment(SimpleModel):
     def get_table_editability(cls, *args, **kwargs):
         return set_editable_for_real_db(*args, **kwargs)
 
+    @classmethod
+    def get_sql_duration(cls):
+        return models.F("end_time_ms") - models.F("start_time_ms")
+
 
 options.DEFAULT_NAMES += ("attrs",)
 
@@ -615,6 +619,9 @@ class HistoryEntry(SimpleModel):
     database = models.ForeignKey(Database, on_delete=models.SET_NULL, null=True, blank=False)
     type = models.CharField(max_length=32, default="labels")
 
+    # The task writing the zip file in the background. None for entries saved before this was done in background
+    task = models.ForeignKey("Task", on_delete=models.SET_NULL, null=True, blank=True)
+
     class Meta:
         ordering = ["-time", "user", "database"]
 
@@ -791,6 +798,9 @@ class Ordination(SimpleModel, BinaryStoredMixin):
     params = models.CharField(max_length=255, default="")
     task = models.ForeignKey(Task, on_delete=models.SET_NULL, null=True, blank=True)
 
+    # True when the DataMatrix has gained or lost rows since this ordination was constructed
+    stale = models.BooleanField(default=False)
+
     def _get_path(self, ext):
         return os.path.join(settings.MEDIA_URL, "ordination", str(self.id), "{}.{}".format(self.id, ext))[1:]
 
@@ -830,6 +840,9 @@ class SimilarityIndex(SimpleModel, BinaryStoredMixin):
     ord = models.ForeignKey(Ordination, on_delete=models.CASCADE, null=True, blank=True)
     task = models.ForeignKey(Task, on_delete=models.SET_NULL, null=True, blank=True)
 
+    # True when the DataMatrix has gained or lost rows since this index was calculated
+    stale = models.BooleanField(default=False)
+
     def _get_path(self, ext):
         return os.path.join(settings.MEDIA_URL, "similarity", str(self.id), "{}.{}".format(self.id, ext))[1:]
 
@@ -857,6 +870,9 @@ class FullTensorData(TensorData, BinaryStoredMixin):
     def get_cols_path(self):
         return self._get_path("cols")
 
+    def get_columns_path(self):
+        return self._get_path("columns")
+
 
 class DerivedTensorData(TensorData):
     full_tensor = models.ForeignKey(FullTensorData, on_delete=models.CASCADE, null=True, blank=True)
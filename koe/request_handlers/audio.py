@@ -1,6 +1,7 @@
-import io
 import json
 import os
+import shutil
+import subprocess
 from io import BufferedWriter
 from logging import warning
 
@@ -9,16 +10,15 @@ from django.core.files import File
 from django.http import HttpResponse
 from django.utils import timezone
 
-import numpy as np
 import pydub
-from memoize import memoize
 
-from koe import wavfile
+from koe.audio_cache import get_segment_audio_cache
+from koe.audio_clips import get_clip_key, read_or_encode_clip
 from koe.grid_getters import get_sequence_info_empty_songs
 from koe.model_utils import assert_permission, get_or_error
 from koe.models import AudioFile, AudioTrack, Database, DatabasePermission, Individual, Segment
 from koe.utils import audio_path
-from koe.wavfile import get_wav_info, read_segment, read_wav_info, write, write_24b
+from koe.wavfile import STREAM_BUFFER_SIZE, change_rate, float_to_pcm, get_wav_info, read_wav_info
 from root.exceptions import CustomAssertionError
 from root.models import ExtraAttrValue
 from root.utils import data_path, ensure_parent_folder_exists
@@ -26,6 +26,7 @@ from root.utils import data_path, ensure_parent_folder_exists
 
 __all__ = [
     "get_segment_audio_data",
+    "get_segment_audio_cache_stats",
     "import_audio_chunk",
     "get_audio_file_url",
     "import_audio_file",
@@ -34,32 +35,11 @@ __all__ = [
 ]
 
 
-def _match_target_amplitude(sound, loudness=-10):
-    """
-    Set the volume of an AudioSegment object to be a certain loudness
-    :param sound: an AudioSegment object
-    :param loudness: usually -10db is a good number
-    :return: the modified sound
-    """
-    change_in_dBFS = loudness - sound.dBFS
-    if change_in_dBFS > 0:
-        return sound.apply_gain(change_in_dBFS)
-    return sound
-
-
-@memoize(timeout=None)
 def _cached_get_segment_audio_data(audio_file_name, database_id, fs, start, end):
-    wav_file_path = data_path("audio/wav/{}".format(database_id), "{}.wav".format(audio_file_name))
-    chunk = wavfile.read_segment(wav_file_path, start, end, normalised=False, mono=True)
-
-    audio_segment = pydub.AudioSegment(chunk.tobytes(), frame_rate=fs, sample_width=chunk.dtype.itemsize, channels=1)
-
-    audio_segment = _match_target_amplitude(audio_segment)
-
-    out = io.BytesIO()
-    audio_segment.export(out, format=settings.AUDIO_COMPRESSED_FORMAT)
-    binary_content = out.getvalue()
-    out.close()
+    key = get_clip_key(audio_file_name, database_id, fs, start, end)
+    binary_content = get_segment_audio_cache().get_or_compute(
+        key, read_or_encode_clip, audio_file_name, database_id, fs, start, end
+    )
 
     response = HttpResponse()
     response.write(binary_content)
@@ -94,6 +74,17 @@ def get_segment_audio_data(request):
     return _cached_get_segment_audio_data(audio_file_name, database_id, audio_file.fs, start, end)
 
 
+def get_segment_audio_cache_stats(request):
+    """
+    Hit/miss counters and size of the segment audio cache of the process that handles this request
+    :param request: only superusers are allowed
+    :return: a dict of counters, see BytesLRUCache.stats()
+    """
+    if not request.user.is_superuser:
+        raise CustomAssertionError("Only superusers can see the cache statistics")
+    return get_segment_audio_cache().stats()
+
+
 def _import_and_convert_audio_file(
     database,
     file,
@@ -134,7 +125,8 @@ def _import_and_convert_audio_file(
 
     if not file_already_exists:
         with open(wav_name, "wb") as wav_file:
-            wav_file.write(file.read())
+            for chunk in file.chunks():
+                wav_file.write(chunk)
 
     _fs, length, noc = get_wav_info(wav_name, return_noc=True)
 
@@ -148,22 +140,19 @@ def _import_and_convert_audio_file(
     # back to the original and store the original file as .wav
     if real_fs != _fs:
         os.rename(wav_name, fake_wav_name)
-        _change_fs_without_resampling(fake_wav_name, real_fs, wav_name)
-        audio = pydub.AudioSegment.from_file(fake_wav_name)
+        change_rate(fake_wav_name, real_fs, wav_name)
+        _export_compressed(fake_wav_name, name_compressed)
         os.remove(fake_wav_name)
 
     # Otherwise, if real_fs is more than max_fs, we must create a fake file for the sake of converting to mp3:
     elif real_fs > max_fs:
         fake_fs = max_fs
-        _change_fs_without_resampling(wav_name, fake_fs, fake_wav_name)
-        audio = pydub.AudioSegment.from_file(fake_wav_name)
+        change_rate(wav_name, fake_fs, fake_wav_name)
+        _export_compressed(fake_wav_name, name_compressed)
         os.remove(fake_wav_name)
     # Otherwise the file is ordinary - no need to fake it
     else:
-        audio = pydub.AudioSegment.from_file(wav_name)
-
-    ensure_parent_folder_exists(name_compressed)
-    audio.export(name_compressed, format=settings.AUDIO_COMPRESSED_FORMAT)
+        _export_compressed(wav_name, name_compressed)
 
     if audio_file is None:
         if track is None:
@@ -229,7 +218,8 @@ def import_audio_chunk(request):
 
     chunk_file_path = wav_file_path + "__" + str(chunk_index)
     with open(chunk_file_path, "wb") as f:
-        f.write(file.read())
+        for chunk in file.chunks():
+            f.write(chunk)
 
     return dict(origin="import_audio_chunk", success=True, warning=None, payload=None)
 
@@ -261,7 +251,7 @@ def merge_audio_chunks(request):
         for i in range(chunk_count):
             chunk_file_path = wav_file_path + "__" + str(i)
             with open(chunk_file_path, "rb") as chunk_file:
-                combined_file.write(chunk_file.read())
+                shutil.copyfileobj(chunk_file, combined_file, STREAM_BUFFER_SIZE)
 
     (
         size,
@@ -276,8 +266,9 @@ def merge_audio_chunks(request):
     ) = read_wav_info(wav_file_path)
     if comp == 3:
         warning("File is IEEE format. Convert to standard WAV")
-        audio = pydub.AudioSegment.from_file(wav_file_path)
-        audio.export(wav_file_path, format="wav")
+        pcm_file_path = wav_file_path + ".pcm"
+        float_to_pcm(wav_file_path, pcm_file_path)
+        os.replace(pcm_file_path, wav_file_path)
 
     audio_file = _import_and_convert_audio_file(database, combined_file, max_fs)
 
@@ -290,36 +281,30 @@ def merge_audio_chunks(request):
     return dict(origin="merge_audio_chunks", success=True, warning=None, payload=rows)
 
 
-def _change_fs_without_resampling(wav_file, new_fs, new_name):
+def _export_compressed(wav_file, compressed_file):
     """
-    Create a new wav file with the a new (fake) sample rate, without changing the actual data.
-    This is necessary if the frequency of the wav file is higher than the maximum sample rate that the browser supports
-    :param wav_file: path to the original wav file
-    :param new_fs: the new sample rate
-    :return: the path of the faked wav file
+    Convert a wav file to the compressed format by letting ffmpeg stream it, rather than loading it entirely
+    into an AudioSegment first
+    :param wav_file: path to the wav file
+    :param compressed_file: path to the compressed file
+    :return: None
     """
-    (
-        size,
-        comp,
-        num_channels,
-        rate,
-        sbytes,
-        block_align,
-        bitrate,
-        bytes,
-        dtype,
-    ) = read_wav_info(wav_file)
-    ubyte_data = read_segment(wav_file, 0, None, normalised=False, retype=False)
-    byte_length = ubyte_data.size
-    nframes_per_channel = byte_length // block_align
-    byte_per_frame = bitrate // 8
-
-    uint8_data = ubyte_data.reshape((nframes_per_channel, num_channels, byte_per_frame)).astype(np.uint8)
-
-    if bitrate == 24:
-        write_24b(new_name, new_fs, uint8_data)
-    else:
-        write(new_name, new_fs, uint8_data, bitrate=bitrate)
+    ensure_parent_folder_exists(compressed_file)
+    command = [
+        pydub.AudioSegment.converter,
+        "-y",
+        "-v",
+        "error",
+        "-i",
+        wav_file,
+        "-f",
+        settings.AUDIO_COMPRESSED_FORMAT,
+        compressed_file,
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error_message = result.stderr.decode("utf-8", errors="replace")
+        raise CustomAssertionError("Unable to convert {}: {}".format(os.path.basename(wav_file), error_message))
 
 
 def import_audio_file(request):
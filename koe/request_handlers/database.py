@@ -15,6 +15,7 @@ from django.utils import timezone
 import numpy as np
 from dotmap import DotMap
 
+from koe.audio_clips import encode_clips_async
 from koe.celery_init import delay_in_production
 from koe.grid_getters import bulk_get_database_assignment, bulk_get_segments_for_audio
 from koe.model_utils import (
@@ -22,8 +23,8 @@ from koe.model_utils import (
     delete_audio_files_async,
     delete_database_async,
     delete_segments_async,
-    extract_spectrogram,
     get_or_error,
+    queue_spectrogram_extraction,
 )
 from koe.models import (
     AccessRequest,
@@ -41,7 +42,7 @@ from koe.models import (
     TemporaryDatabase,
 )
 from root.exceptions import CustomAssertionError
-from root.models import ExtraAttr, ExtraAttrValue, User
+from root.models import ExtraAttr, ExtraAttrValue, User, extra_attr_values_changed
 from root.utils import ensure_parent_folder_exists
 from root.views import _change_properties_table
 
@@ -400,7 +401,11 @@ def save_segmentation(request):
     _, rows = bulk_get_segments_for_audio(segments, DotMap(file_id=file_id, user=user))
 
     delay_in_production(delete_segments_async)
-    extract_spectrogram(audio_file, segs_info_for_spectrogram)
+    queue_spectrogram_extraction(audio_file, segs_info_for_spectrogram)
+
+    if settings.ENCODE_SEGMENT_CLIPS:
+        clip_segment_ids = [x.id for x in to_update] + [x[0].id for x in new_segments]
+        delay_in_production(encode_clips_async, clip_segment_ids)
 
     return dict(origin="request_database_access", success=True, warning=None, payload=rows)
 
@@ -823,7 +828,17 @@ def bulk_merge_classes(request):
     label_attr = settings.ATTRS.segment.label
     with transaction.atomic():
         for new_class, sids in new_classes.items():
-            ExtraAttrValue.objects.filter(user=user, owner_id__in=sids, attr=label_attr).update(value=new_class)
+            values = ExtraAttrValue.objects.filter(user=user, owner_id__in=sids, attr=label_attr)
+            owner_ids = list(values.values_list("owner_id", flat=True))
+            values.update(value=new_class)
+            extra_attr_values_changed.send(
+                sender=Segment,
+                attr=label_attr,
+                user=user,
+                owner_ids=owner_ids,
+                created_owner_ids=[],
+                value=new_class,
+            )
 
     return dict(origin="bulk_merge_classes", success=True, warning=None, payload=None)
 
@@ -928,10 +943,7 @@ def update_segments_from_csv(request):
         if len(song_info) > 0:
             segs_info = [(tid, start, end) for song, tid, start, end in song_info]
             song = song_info[0][0]
-            try:
-                extract_spectrogram(song, segs_info)
-            except Exception as e:
-                raise e
+            queue_spectrogram_extraction(song, segs_info)
 
     # Finally to change all other properties (label, family, note...)
     retval = _change_properties_table(rows, grid_type, missing_attrs, attrs, user)
@@ -1,10 +1,9 @@
-from django.db.models import Case, When
-
 import numpy as np
 
 from koe.model_utils import get_or_error
 from koe.models import DataMatrix, Segment
 from koe.ts_utils import bytes_to_ndarray
+from root.models import get_ordered_values
 
 
 __all__ = ["get_datamatrix_file_paths", "get_sid_info"]
@@ -15,9 +14,9 @@ def get_sid_info(request):
     if sids_path.startswith("/"):
         sids_path = sids_path[1:]
     sids = bytes_to_ndarray(sids_path, np.int32)
-    preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(sids)])
-    ordered_segs = Segment.objects.filter(id__in=sids).order_by(preserved)
-    value_list = ordered_segs.values_list("audio_file__id", "audio_file__name", "start_time_ms", "end_time_ms")
+    value_list = get_ordered_values(
+        Segment.objects, sids, ["audio_file__id", "audio_file__name", "start_time_ms", "end_time_ms"]
+    )
     seg_info = []
     song_info = {}
 
@@ -1,101 +1,192 @@
-import io
 import json
+import os
 import zipfile
 
 from django.core.files import File
 from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 
 from django_bulk_update.helper import bulk_update
 from dotmap import DotMap
 from tz_detect.utils import offset_to_timezone
 
+from koe.celery_init import app, delay_in_production
+from koe.feature_utils import get_or_wait
 from koe.grid_getters import bulk_get_history_entries
 from koe.model_utils import assert_permission, assert_values, get_or_error, get_user_databases
-from koe.models import AudioFile, Database, DatabasePermission, HistoryEntry, Segment
+from koe.models import AudioFile, Database, DatabasePermission, HistoryEntry, Segment, Task
+from koe.task import TaskRunner
 from koe.utils import history_path
 from root.exceptions import CustomAssertionError
-from root.models import ExtraAttr, ExtraAttrValue
+from root.models import BULK_ATTR_MAX_IN_LIST, ExtraAttr, ExtraAttrValue, extra_attr_values_changed
 from root.utils import ensure_parent_folder_exists
 
 
 __all__ = ["save_history", "import_history", "delete_history"]
 
 
-def save_label_history(database, user, zip_file, segments_ids=None, song_ids=None):
-    if segments_ids is None:
-        segments_ids = frozenset(Segment.objects.filter(audio_file__database=database).values_list("id", flat=True))
-    if song_ids is None:
-        song_ids = frozenset(AudioFile.objects.filter(database=database).values_list("id", flat=True))
+# Deflate is much faster than BZIP2 to write and still shrinks the JSON several times. Archives written with BZIP2
+# can still be imported
+HISTORY_COMPRESSION = zipfile.ZIP_DEFLATED
 
-    seg_extra_attr_values = list(
-        ExtraAttrValue.objects.filter(user=user, owner_id__in=segments_ids, attr__klass=Segment.__name__).values_list(
-            "owner_id", "attr__id", "value"
+
+def write_json_rows(zip_file, name, rows, tick=None):
+    """
+    Write rows as a JSON list to a new entry of the zip file, one row at a time, so that the rows (e.g. from a DB
+    cursor) are never all in memory
+    :param rows: iterable of JSON-serialisable rows
+    :param tick: if given, called after each row is written
+    """
+    with zip_file.open(name, "w", force_zip64=True) as f:
+        f.write(b"[")
+        for i, row in enumerate(rows):
+            if i > 0:
+                f.write(b",")
+            f.write(json.dumps(row).encode("utf-8"))
+            if tick is not None:
+                tick()
+        f.write(b"]")
+
+
+def write_song_info(zip_file, segment_values, tick=None):
+    """
+    Write {song name -> [song id, [segments info]]} to songinfo.json, one song at a time
+    :param segment_values: (id, song name, song id, start, end, mean_ff, min_ff, max_ff, tid) of all segments, ordered
+                           by song name. Songs with the same name are merged under the ID of the first one
+    """
+    with zip_file.open("songinfo.json", "w", force_zip64=True) as f:
+        f.write(b"{")
+        current_song_name = None
+        for seg_id, song_name, song_id, start, end, mean_ff, min_ff, max_ff, tid in segment_values:
+            seg_info = json.dumps([seg_id, start, end, mean_ff, min_ff, max_ff, tid]).encode("utf-8")
+            if song_name == current_song_name:
+                f.write(b"," + seg_info)
+            else:
+                if current_song_name is not None:
+                    f.write(b"]],")
+                f.write("{}:[{},[".format(json.dumps(song_name), song_id).encode("utf-8") + seg_info)
+                current_song_name = song_name
+            if tick is not None:
+                tick()
+        if current_song_name is not None:
+            f.write(b"]]")
+        f.write(b"}")
+
+
+def _get_history_values(database, user):
+    seg_values = ExtraAttrValue.objects.filter(
+        user=user,
+        owner_id__in=Segment.objects.filter(audio_file__database=database).values("id"),
+        attr__klass=Segment.__name__,
+    ).values_list("owner_id", "attr__id", "value")
+
+    song_values = ExtraAttrValue.objects.filter(
+        user=user,
+        owner_id__in=AudioFile.objects.filter(database=database).values("id"),
+        attr__klass=AudioFile.__name__,
+    ).values_list("owner_id", "attr__id", "value")
+
+    return seg_values, song_values
+
+
+def _get_history_segments(database):
+    return (
+        Segment.objects.filter(audio_file__database=database)
+        .order_by("audio_file__name", "audio_file", "start_time_ms")
+        .values_list(
+            "id",
+            "audio_file__name",
+            "audio_file",
+            "start_time_ms",
+            "end_time_ms",
+            "mean_ff",
+            "min_ff",
+            "max_ff",
+            "tid",
         )
     )
 
-    song_extra_attr_values = list(
-        ExtraAttrValue.objects.filter(user=user, owner_id__in=song_ids, attr__klass=AudioFile.__name__).values_list(
-            "owner_id", "attr__id", "value"
-        )
+
+def write_history(he, zip_file, runner=None):
+    """
+    Write the content of a HistoryEntry: the user's ExtraAttrValue of the database's segments and songs, and also the
+    segmentation scheme of all songs if it's a segmentation backup. Songs are referenced BY NAME.
+    Rows are streamed from the database into the zip entries
+    :param he: the HistoryEntry
+    :param runner: a TaskRunner to report progress to
+    """
+    database = he.database
+    user = he.user
+    meta = dict(
+        database=database.id,
+        user=user.id,
+        time=he.time,
+        version=he.version,
+        note=he.note,
+        type=he.type,
     )
 
+    seg_values, song_values = _get_history_values(database, user)
+    segment_values = _get_history_segments(database) if he.type == "segmentation" else None
+
+    tick = None
+    if runner is not None:
+        nrows = seg_values.count() + song_values.count()
+        if segment_values is not None:
+            nrows += segment_values.count()
+        runner.start(limit=max(1, nrows))
+        tick = runner.tick
+
+    zip_file.writestr("meta.json", json.dumps(meta))
+    zip_file.writestr("root.extraattrvalue.json", "here for checking purpose")
+
+    if segment_values is not None:
+        write_song_info(zip_file, segment_values.iterator(), tick)
+
     extra_attrs = list(ExtraAttr.objects.values_list("id", "klass", "type", "name"))
-    zip_file.writestr("extraattr.json", json.dumps(extra_attrs, indent=4))
-    zip_file.writestr("segment.extraattrvalue.json", json.dumps(seg_extra_attr_values, indent=4))
-    zip_file.writestr("audiofile.extraattrvalue.json", json.dumps(song_extra_attr_values, indent=4))
+    zip_file.writestr("extraattr.json", json.dumps(extra_attrs))
+    write_json_rows(zip_file, "segment.extraattrvalue.json", seg_values.iterator(), tick)
+    write_json_rows(zip_file, "audiofile.extraattrvalue.json", song_values.iterator(), tick)
 
 
-def save_segmentation_history(database, user, zip_file):
+@app.task(bind=False)
+def save_history_async(task_id, *args, **kwargs):
     """
-    Save segmentation scheme of all songs in this database. Songs are referenced BY NAME
-    :param database:
-    :param user:
-    :param zip_file:
-    :return:
+    Write the zip file of the HistoryEntry that is the target of the task
     """
-    segment_values = Segment.objects.filter(audio_file__database=database).values_list(
-        "id",
-        "audio_file__name",
-        "audio_file",
-        "start_time_ms",
-        "end_time_ms",
-        "mean_ff",
-        "min_ff",
-        "max_ff",
-        "tid",
-    )
+    task = get_or_wait(task_id)
+    runner = TaskRunner(task)
+    tmp_filepath = None
+    try:
+        runner.preparing()
+        cls, he_id = task.target.split(":")
+        assert cls == HistoryEntry.__name__
+        he = HistoryEntry.objects.get(id=int(he_id))
+
+        filepath = history_path(he.filename)
+        ensure_parent_folder_exists(filepath)
 
-    seg_ids = []
-    song_ids = []
-    song_info = {}
-    for (
-        seg_id,
-        song_name,
-        song_id,
-        start,
-        end,
-        mean_ff,
-        min_ff,
-        max_ff,
-        tid,
-    ) in segment_values:
-        seg_ids.append(seg_id)
-        if song_name not in song_info:
-            song_ids.append(song_id)
-            song_info[song_name] = (song_id, [])
-
-        song_info[song_name][1].append((seg_id, start, end, mean_ff, min_ff, max_ff, tid))
-
-    zip_file.writestr("songinfo.json", json.dumps(song_info, indent=4))
-    save_label_history(database, user, zip_file, seg_ids, song_ids)
+        # Written under a temporary name so that a half-written file is never downloaded or imported
+        tmp_filepath = "{}.tmp".format(filepath)
+        with zipfile.ZipFile(tmp_filepath, "w", HISTORY_COMPRESSION, True) as zip_file:
+            write_history(he, zip_file, runner)
+
+        runner.wrapping_up()
+        os.replace(tmp_filepath, filepath)
+        runner.complete()
+    except Exception as e:
+        if tmp_filepath is not None and os.path.isfile(tmp_filepath):
+            os.remove(tmp_filepath)
+        runner.error(e)
 
 
 def save_history(request):
     """
-    Save a copy of all ExtraAttrValue (labels, notes, ...) in a HistoryEntry
+    Save a copy of all ExtraAttrValue (labels, notes, ...) in a HistoryEntry. The zip file is written in the
+    background, the HistoryEntry shows as pending until it's done
     :param request: must specify a comment to store with this copy
-    :return: name of the zip file created
+    :return: the grid row of the new HistoryEntry
     :version: 2.0.0
     """
     version = 4
@@ -109,27 +200,6 @@ def save_history(request):
     assert_permission(user, database, DatabasePermission.VIEW)
     assert_values(backup_type, ["labels", "segmentation"])
 
-    meta = dict(
-        database=database_id,
-        user=user.id,
-        time=timezone.now(),
-        version=version,
-        note=comment,
-        type=backup_type,
-    )
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_BZIP2, False) as zip_file:
-        zip_file.writestr("meta.json", json.dumps(meta))
-        zip_file.writestr("root.extraattrvalue.json", "here for checking purpose")
-
-        if backup_type == "labels":
-            save_label_history(database, user, zip_file)
-        else:
-            save_segmentation_history(database, user, zip_file)
-
-    binary_content = zip_buffer.getvalue()
-
     he = HistoryEntry.objects.create(
         user=user,
         time=timezone.now(),
@@ -138,12 +208,13 @@ def save_history(request):
         note=comment,
         type=backup_type,
     )
-    filename = he.filename
-    filepath = history_path(filename)
-    ensure_parent_folder_exists(filepath)
 
-    with open(filepath, "wb") as f:
-        f.write(binary_content)
+    task = Task(user=user, target="{}:{}".format(HistoryEntry.__name__, he.id))
+    task.save()
+    he.task = task
+    he.save()
+
+    delay_in_production(save_history_async, task.id)
 
     tz_offset = request.session["detected_tz"]
     tz = offset_to_timezone(tz_offset)
@@ -293,20 +364,16 @@ def import_history_with_segmentation(database, user, filelist):
                     )
                 )
 
-        seg_key_to_new_id = {}
-        with transaction.atomic():
-            for segment in new_segments:
-                segment.save()
-                if segment.tid is None:
-                    segment.tid = segment.id
-                    segment.save()
-
-                seg_key = (
-                    segment.start_time_ms,
-                    segment.end_time_ms,
-                    segment.audio_file.name,
-                )
-                seg_key_to_new_id[seg_key] = segment.id
+        # Create the missing segments in bulk, then give those without a saved TID their own ID as TID in one query
+        Segment.objects.bulk_create(new_segments, batch_size=BULK_ATTR_MAX_IN_LIST)
+        new_segments_song_ids = list(set(x.audio_file_id for x in new_segments))
+        Segment.objects.filter(audio_file__in=new_segments_song_ids, tid=None).update(tid=F("id"))
+
+        # MySQL doesn't return the IDs of bulk-created objects, so they are found by their endpoints
+        created_segments = Segment.objects.filter(audio_file__in=new_segments_song_ids).values_list(
+            "id", "start_time_ms", "end_time_ms", "audio_file__name"
+        )
+        seg_key_to_new_id = {(x[1], x[2], x[3]): x[0] for x in created_segments}
 
         for seg_key, _seg_id in seg_key_to_old_id.items():
             if seg_key in seg_key_to_new_id:
@@ -323,43 +390,62 @@ def import_history_with_segmentation(database, user, filelist):
 
 def update_extra_attr_values(user, new_entries):
     """
-    Update the ExtraAttr ids in case they are different from the saved
+    Create or update the user's values of the entries. Only the values of the owners and attributes present in the
+    entries are read, so the cost depends on the size of the entries, not on how many values the user has
     :param user:
-    :param new_entries:
+    :param new_entries: list of (owner_id, attr_id, value)
     :return:
     """
-    extra_attr_key_to_value = {
-        (x[0], x[1]): (x[2], x[3])
-        for x in ExtraAttrValue.objects.filter(user=user).values_list("owner_id", "attr", "value", "id")
-    }
+    owner_ids = list(set(x[0] for x in new_entries))
+    attr_ids = list(set(x[1] for x in new_entries))
 
-    extra_attr_values_to_update = {}
+    extra_attr_key_to_value = {}
+    values = ExtraAttrValue.objects.filter(user=user, attr__in=attr_ids)
+    for i in range(0, len(owner_ids), BULK_ATTR_MAX_IN_LIST):
+        chunk = values.filter(owner_id__in=owner_ids[i : i + BULK_ATTR_MAX_IN_LIST])
+        for owner_id, attr_id, value, extra_attr_value_id in chunk.values_list("owner_id", "attr", "value", "id"):
+            extra_attr_key_to_value[(owner_id, attr_id)] = (value, extra_attr_value_id)
+
+    extra_attr_values_to_update = []
     extra_attr_values_to_create = []
+    attr_id_to_changes = {}
 
     for owner_id, attr_id, _value in new_entries:
         key = (owner_id, attr_id)
 
         if key in extra_attr_key_to_value:
             value, extra_attr_value_id = extra_attr_key_to_value[key]
-            if value != _value:
-                extra_attr_values_to_update[extra_attr_value_id] = _value
+            if value == _value:
+                continue
+            extra_attr_values_to_update.append(ExtraAttrValue(id=extra_attr_value_id, value=_value))
+            created = False
         else:
             extra_attr_values_to_create.append(
                 ExtraAttrValue(owner_id=owner_id, value=_value, user=user, attr_id=attr_id)
             )
+            created = True
 
-    extra_attr_values_object_to_update = ExtraAttrValue.objects.filter(id__in=extra_attr_values_to_update.keys()).only(
-        "value", "id"
-    )
-
-    for extra_attr_value in extra_attr_values_object_to_update:
-        new_value = extra_attr_values_to_update[extra_attr_value.id]
-        extra_attr_value.value = new_value
+        changes = attr_id_to_changes.setdefault(attr_id, dict(owner_ids=[], created_owner_ids=[], values=set()))
+        changes["owner_ids"].append(owner_id)
+        changes["values"].add(_value)
+        if created:
+            changes["created_owner_ids"].append(owner_id)
 
     with transaction.atomic():
-        bulk_update(extra_attr_values_object_to_update, update_fields=["value"])
-        ExtraAttrValue.objects.bulk_create(extra_attr_values_to_create)
-
+        bulk_update(extra_attr_values_to_update, update_fields=["value"], batch_size=BULK_ATTR_MAX_IN_LIST)
+        ExtraAttrValue.objects.bulk_create(extra_attr_values_to_create, batch_size=BULK_ATTR_MAX_IN_LIST)
+
+    # Only the attributes and owners that changed need their stored labels and counts updated
+    for attr in ExtraAttr.objects.filter(id__in=list(attr_id_to_changes.keys())):
+        changes = attr_id_to_changes[attr.id]
+        extra_attr_values_changed.send(
+            sender=ExtraAttrValue,
+            attr=attr,
+            user=user,
+            owner_ids=changes["owner_ids"],
+            created_owner_ids=changes["created_owner_ids"],
+            value=changes["values"].pop() if len(changes["values"]) == 1 else None,
+        )
     return True
 
 
@@ -2,9 +2,12 @@ import os
 
 from django.http import HttpResponse
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 
 import numpy as np
 
+from koe.annotation_coverage import get_annotation_percentages
 from koe.model_utils import get_or_error
 from koe.models import (
     Database,
@@ -12,11 +15,17 @@ from koe.models import (
     DataMatrix,
     DerivedTensorData,
     Ordination,
-    Segment,
 )
-from koe.ts_utils import bytes_to_ndarray, extract_tensor_metadata, write_metadata
+from koe.ts_utils import (
+    bytes_to_ndarray,
+    extract_tensor_metadata,
+    get_metadata_version,
+    write_metadata,
+    write_metadata_columns,
+)
 from root.exceptions import CustomAssertionError
-from root.models import ExtraAttr, ExtraAttrValue, User
+from root.models import User
+from root.utils import data_path, ensure_parent_folder_exists
 from root.views import can_have_exception
 
 
@@ -27,30 +36,6 @@ __all__ = [
 ]
 
 
-def _get_annotation_info(database, annotators):
-    syls = Segment.objects.filter(audio_file__database=database)
-    nsyls = syls.count()
-
-    labelling_levels = ["label", "label_family", "label_subfamily"]
-    labelling_attrs = ExtraAttr.objects.filter(klass=Segment.__name__, name__in=labelling_levels)
-
-    annotation_info = {}
-
-    for annotator in annotators:
-        user_annotation = ExtraAttrValue.objects.filter(owner_id__in=syls, user=annotator)
-        annotation_info[annotator] = {}
-
-        for labelling_attr in labelling_attrs:
-            user_annotation_this_level = user_annotation.filter(attr=labelling_attr)
-            if nsyls == 0:
-                user_annotation_complete_this_level = 100
-            else:
-                user_annotation_complete_this_level = user_annotation_this_level.count() / nsyls * 100
-
-            annotation_info[annotator][labelling_attr.name] = user_annotation_complete_this_level
-    return annotation_info
-
-
 def _render_annotation_info(annotation_info, tensors):
     return render_to_string(
         "partials/annotator_dropdown_list_options.html",
@@ -63,7 +48,7 @@ def get_annotators_and_presets(request):
     database = get_or_error(Database, dict(id=database_id))
 
     annotators = [x.user for x in DatabaseAssignment.objects.filter(database=database_id)]
-    annotation_info = _get_annotation_info(database, annotators)
+    annotation_info = get_annotation_percentages(database, annotators)
 
     tensors = DerivedTensorData.objects.filter(database=database)
 
@@ -86,50 +71,111 @@ def get_data_matrix_config(request):
     return dict(origin="request_database_access", success=True, warning=None, payload=selections)
 
 
+def _get_cached_metadata(kind, obj_id, annotator, version, ext, build):
+    """
+    Read the metadata of a tensor or ordination saved at this version, or build and save it.
+    Only the latest version is kept
+    :param kind: 'tensor' or 'ordination'
+    :param version: see get_metadata_version. If None, the metadata is built and not saved
+    :param build: a function that returns the content as a string
+    :return: the content
+    """
+    if version is None:
+        return build()
+
+    folder = data_path("binary/metadata/{}/{}".format(kind, obj_id), str(annotator.id))
+    cache_path = os.path.join(folder, "{}.{}".format(version, ext))
+    if os.path.isfile(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    content = build()
+
+    ensure_parent_folder_exists(cache_path)
+    for filename in os.listdir(folder):
+        os.remove(os.path.join(folder, filename))
+
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, cache_path)
+    return content
+
+
+def _get_metadata_response(request, version, content_type, get_content):
+    """
+    Respond with the metadata, or with 304 Not Modified if the client has this version already
+    """
+    etag = None if version is None else quote_etag(version)
+    if etag is not None:
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+    content = get_content()
+    response = HttpResponse()
+    response.write(content)
+    response["Content-Type"] = content_type
+    response["Content-Length"] = len(content)
+    if etag is not None:
+        # Let the browser keep it but always ask if it has changed
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+    return response
+
+
 def get_metadata(request, tensor_name):
+    """
+    Metadata of a tensor in TSV, as required by the embedding projector
+    """
     tensor = get_or_error(DerivedTensorData, dict(name=tensor_name))
     full_tensor = tensor.full_tensor
+    annotator = tensor.annotator
 
     full_sids_path = full_tensor.get_sids_path()
-    sids = bytes_to_ndarray(full_sids_path, np.int32)
+    version = get_metadata_version(full_sids_path, annotator, full_tensor.database)
 
-    metadata, headers = extract_tensor_metadata(sids, tensor.annotator)
-    content = write_metadata(metadata, sids, headers)
+    def build():
+        sids = bytes_to_ndarray(full_sids_path, np.int32)
+        metadata, headers = extract_tensor_metadata(sids, annotator, full_tensor.database)
+        return write_metadata(metadata, sids, headers)
 
-    response = HttpResponse()
-    response.write(content)
-    response["Content-Type"] = "text/tsv"
-    response["Content-Length"] = len(content)
-    return response
+    def get_content():
+        return _get_cached_metadata("tensor", tensor.id, annotator, version, "tsv", build)
+
+    return _get_metadata_response(request, version, "text/tsv", get_content)
 
 
 @can_have_exception
 def get_ordination_metadata(request, ord_id, viewas):
+    """
+    Metadata of an ordination in columnar JSON, see write_metadata_columns
+    """
     ord = get_or_error(Ordination, dict(id=ord_id))
+    database = ord.dm.database
 
     sids_path = ord.get_sids_path()
-    sids = bytes_to_ndarray(sids_path, np.int32)
-
     viewas = get_or_error(User, dict(username=viewas))
-
-    try:
-        metadata, headers = extract_tensor_metadata(sids, viewas)
-    except KeyError as e:
-        err_message = (
-            "Syllable #{} has been deleted from the database since the creation of this ordination and "
-            'thus renders it invalid. Please choose another one or rerun the datamatrix named "{}"'.format(
-                str(e), ord.dm
+    version = get_metadata_version(sids_path, viewas, database)
+
+    def build():
+        sids = bytes_to_ndarray(sids_path, np.int32)
+        try:
+            metadata, headers = extract_tensor_metadata(sids, viewas, database)
+        except KeyError as e:
+            err_message = (
+                "Syllable #{} has been deleted from the database since the creation of this ordination and "
+                'thus renders it invalid. Please choose another one or rerun the datamatrix named "{}"'.format(
+                    str(e), ord.dm
+                )
             )
-        )
-        raise CustomAssertionError(err_message)
+            raise CustomAssertionError(err_message)
+        return write_metadata_columns(metadata, sids, headers)
 
-    content = write_metadata(metadata, sids, headers)
+    def get_content():
+        return _get_cached_metadata("ordination", ord.id, viewas, version, "json", build)
 
-    response = HttpResponse()
-    response.write(content)
-    response["Content-Type"] = "text/tsv"
-    response["Content-Length"] = len(content)
-    return response
+    return _get_metadata_response(request, version, "application/json", get_content)
 
 
 def get_tensor_data_file_paths(request):
@@ -101,6 +101,29 @@ def songs_to_syl_seqs(songs, sid2label, enums2labels, use_pseudo=True):
     return song_sequences
 
 
+def get_song_sid_sequences(songs):
+    """
+    Load the segment IDs of songs into one array with one query, songs in the same order and segments sorted the same
+    way as songs_to_syl_seqs. Labelling is then left to the caller (e.g. by indexing an array), so that the same
+    sequences can be relabelled many times without going back to the database
+    :param songs: a QuerySet of AudioFile
+    :return: sids, song_starts. The segment IDs of song i are sids[song_starts[i]:song_starts[i + 1]]
+    """
+    segs = Segment.objects.filter(audio_file__in=songs).order_by("audio_file__name", "start_time_ms")
+    values = np.array(list(segs.values_list("id", "audio_file__id")), dtype=np.int64).reshape((-1, 2))
+    sids = values[:, 0].astype(np.int32)
+    song_ids = values[:, 1]
+
+    # Songs are ordered by their first appearance, each song's segments stay in the same order
+    _, first_inds, song_enums = np.unique(song_ids, return_index=True, return_inverse=True)
+    song_ranks = np.argsort(np.argsort(first_inds))
+    order = np.argsort(song_ranks[song_enums], kind="stable")
+    sids = sids[order]
+
+    song_starts = np.concatenate(([0], np.cumsum(np.bincount(song_ranks[song_enums])))).astype(np.int64)
+    return sids, song_starts
+
+
 def calc_class_ajacency(
     database,
     syl_label_enum_arr,
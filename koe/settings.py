@@ -153,6 +153,26 @@ CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = envconf["timezone"]
 
 
+# Number of processes used to extract and aggregate features of a DataMatrix. 1 to run in the calling process
+FEATURE_EXTRACTION_WORKERS = envconf.get("feature_extraction_workers", 1)
+
+# Number of processes used to run the folds of k-fold validations (and hyperopt trials). 1 to run in the calling process
+# Separate from FEATURE_EXTRACTION_WORKERS because each of these workers holds a copy of the whole dataset and a
+# model, so usually fewer of them fit in memory
+EVALUATION_WORKERS = envconf.get("evaluation_workers", 1)
+
+# Encoded audio of played segments is kept in memory (per process) up to this many bytes, least recently used first out
+SEGMENT_AUDIO_CACHE_MAX_BYTES = envconf.get("segment_audio_cache_max_bytes", 64 * 1024 * 1024)
+# If given, the encoded audio is also stored in this folder, shared between processes, up to this many bytes
+SEGMENT_AUDIO_CACHE_FOLDER = envconf.get("segment_audio_cache_folder", None)
+SEGMENT_AUDIO_CACHE_FOLDER_MAX_BYTES = envconf.get("segment_audio_cache_folder_max_bytes", 1024 * 1024 * 1024)
+
+# Encode audio clips of segments in the background when a segmentation is saved, so that playing them is only a read
+ENCODE_SEGMENT_CLIPS = envconf.get("encode_segment_clips", False)
+
+# Also keep the spectrograms of each page of syllables in one pack file, so that the grids load them in a few requests
+SPECT_PACKS = envconf.get("spect_packs", False)
+
 LOGIN_URL = "/login"
 
 # site configuration
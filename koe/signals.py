@@ -1,10 +1,13 @@
 from django.conf import settings
 from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
-from koe.models import Database, DatabaseAssignment
-from root.models import ExtraAttrValue, User
+from koe.annotation_coverage import add_annotations, invalidate_annotation_coverage
+from koe.label_store import remove_label_columns, update_label_columns
+from koe.models import Database, DatabaseAssignment, Segment
+from root.models import ExtraAttrValue, User, extra_attr_values_changed
 
 
 @receiver(user_logged_in, sender=User)
@@ -24,3 +27,38 @@ def remove_expired_database_access(**kwargs):
             current_database_id = int(current_database_id)
             if current_database_id in expired_database_ids:
                 current_database.delete()
+
+
+@receiver(extra_attr_values_changed)
+def update_stored_labels(**kwargs):
+    attr = kwargs["attr"]
+    user = kwargs["user"]
+    if attr is None:
+        remove_label_columns(user)
+    elif attr.klass == Segment.__name__:
+        update_label_columns(attr, user, kwargs["owner_ids"], kwargs["value"])
+
+
+@receiver(extra_attr_values_changed)
+def update_annotation_coverage(**kwargs):
+    attr = kwargs["attr"]
+    created_owner_ids = kwargs["created_owner_ids"]
+    if attr is None:
+        invalidate_annotation_coverage()
+    elif attr.klass == Segment.__name__:
+        if created_owner_ids is None:
+            invalidate_annotation_coverage(kwargs["owner_ids"])
+        else:
+            add_annotations(attr, kwargs["user"], created_owner_ids)
+
+
+@receiver(post_save, sender=ExtraAttrValue)
+def update_stored_label(**kwargs):
+    extra_attr_value = kwargs["instance"]
+    attr = extra_attr_value.attr
+    if attr.klass == Segment.__name__:
+        # Updating a column in place means rewriting it, which is too costly for code that saves values in a loop.
+        # Remove it instead, it will be rebuilt once on the next read
+        remove_label_columns(extra_attr_value.user, attr.name)
+        if kwargs["created"]:
+            add_annotations(attr, extra_attr_value.user, [extra_attr_value.owner_id])
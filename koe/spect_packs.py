@@ -0,0 +1,129 @@
+"""
+Syllable spectrograms are stored one PNG per TID, in pages of PAGE_CAPACITY (see get_abs_spect_path).
+Showing a grid page this way costs one request per syllable. A spectrogram pack puts all PNGs of one page into a
+single file with an offset index at the front, so that the client can read the index and then the bytes of all
+the spectrograms it needs with two (range) requests per page.
+
+Layout of a pack (little endian):
+    magic (8 bytes) | count (uint32) | count x (tid, offset, length) (uint32 each) | PNG data...
+Offsets are absolute (from the beginning of the file). Entries are sorted by tid.
+
+The individual PNGs remain the source of truth: packs are rebuilt from them whenever they change.
+"""
+
+import os
+
+from django.conf import settings
+
+import numpy as np
+
+from koe.utils import ABS_SPECT_FFT_TEMPLATE, PAGE_CAPACITY, get_abs_spect_pack_path
+from root.utils import ensure_parent_folder_exists
+
+
+SPECT_PACK_MAGIC = b"KOESPK01"
+SPECT_PACK_ENTRY_DTYPE = np.dtype([("tid", "<u4"), ("offset", "<u4"), ("length", "<u4")])
+SPECT_PACK_PREFIX_SIZE = len(SPECT_PACK_MAGIC) + 4
+
+
+def get_page_folder(page):
+    return os.path.dirname(ABS_SPECT_FFT_TEMPLATE.format(page, 0))
+
+
+def get_spect_pages():
+    """
+    :return: sorted list of all pages that have a spectrogram folder
+    """
+    syllable_folder = os.path.dirname(get_page_folder(0))
+    if not os.path.isdir(syllable_folder):
+        return []
+    return sorted(int(x) for x in os.listdir(syllable_folder) if x.isdigit())
+
+
+def pack_spectrograms(page):
+    """
+    (Re)build the pack of one page from the individual PNGs. The pack is replaced atomically so that it can be
+    served while being rebuilt. If the page has no spectrogram the pack is removed
+    :param page: page number
+    :return: number of spectrograms packed
+    """
+    pack_path = get_abs_spect_pack_path(page)
+    page_folder = get_page_folder(page)
+
+    tids = []
+    if os.path.isdir(page_folder):
+        for filename in os.listdir(page_folder):
+            name, ext = os.path.splitext(filename)
+            if ext == ".png" and name.isdigit():
+                tids.append(int(name))
+    tids.sort()
+
+    if len(tids) == 0:
+        if os.path.isfile(pack_path):
+            os.remove(pack_path)
+        return 0
+
+    blobs = []
+    for tid in tids:
+        with open(ABS_SPECT_FFT_TEMPLATE.format(page, tid), "rb") as f:
+            blobs.append(f.read())
+
+    index = np.zeros(len(tids), dtype=SPECT_PACK_ENTRY_DTYPE)
+    index["tid"] = tids
+    index["length"] = [len(x) for x in blobs]
+    data_start = SPECT_PACK_PREFIX_SIZE + index.nbytes
+    index["offset"][0] = data_start
+    index["offset"][1:] = data_start + np.cumsum(index["length"][:-1])
+
+    ensure_parent_folder_exists(pack_path)
+    tmp_path = "{}.{}.tmp".format(pack_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(SPECT_PACK_MAGIC)
+        f.write(np.uint32(len(tids)).astype("<u4").tobytes())
+        f.write(index.tobytes())
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, pack_path)
+    return len(tids)
+
+
+def read_spect_pack_index(page):
+    """
+    :return: structured array of (tid, offset, length) of the pack or None if this page has no pack
+    """
+    pack_path = get_abs_spect_pack_path(page)
+    if not os.path.isfile(pack_path):
+        return None
+    with open(pack_path, "rb") as f:
+        prefix = f.read(SPECT_PACK_PREFIX_SIZE)
+        assert prefix[: len(SPECT_PACK_MAGIC)] == SPECT_PACK_MAGIC, "{} is not a spectrogram pack".format(pack_path)
+        count = int(np.frombuffer(prefix, dtype="<u4", offset=len(SPECT_PACK_MAGIC))[0])
+        return np.frombuffer(f.read(count * SPECT_PACK_ENTRY_DTYPE.itemsize), dtype=SPECT_PACK_ENTRY_DTYPE)
+
+
+def read_packed_spectrogram(tid):
+    """
+    :return: the PNG bytes of the spectrogram of this tid from its page's pack, or None if it's not packed
+    """
+    page = tid // PAGE_CAPACITY
+    index = read_spect_pack_index(page)
+    if index is None:
+        return None
+    loc = np.searchsorted(index["tid"], tid)
+    if loc == len(index) or index["tid"][loc] != tid:
+        return None
+    with open(get_abs_spect_pack_path(page), "rb") as f:
+        f.seek(int(index["offset"][loc]))
+        return f.read(int(index["length"][loc]))
+
+
+def update_spect_packs(tids):
+    """
+    Rebuild the packs of all pages containing these tids. Does nothing unless SPECT_PACKS is enabled
+    :param tids: tids of spectrograms that have been created, changed or deleted
+    """
+    if not settings.SPECT_PACKS:
+        return
+    pages = np.unique(np.asarray(list(tids), dtype=np.int64) // PAGE_CAPACITY)
+    for page in pages:
+        pack_spectrograms(int(page))
@@ -1,11 +1,11 @@
 import os
 
 from django.conf import settings
-from django.db.models import Case, When
 
 import numpy as np
 
 from koe.models import AudioFile, Segment
+from root.models import get_ordered_values
 
 
 def get_sids_tids(database, population_name=None):
@@ -35,8 +35,7 @@ def get_sids_tids(database, population_name=None):
 
 
 def get_tids(sids):
-    preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(sids)])
-    tids = Segment.objects.filter(id__in=sids).order_by(preserved).values_list("tid", flat=True)
+    tids = get_ordered_values(Segment.objects, sids, ["tid"], flat=True)
     return np.array(tids, dtype=np.int32)
 
 
@@ -75,7 +75,9 @@ def get_server_constants():
             url = reverse(name, kwargs={"type": "arg"})
         urls[name] = url
 
-    return json.dumps({"literals": literals, "aliases": aliases, "urls": urls})
+    server_settings = {"spectPacks": settings.SPECT_PACKS}
+
+    return json.dumps({"literals": literals, "aliases": aliases, "urls": urls, "settings": server_settings})
 
 
 @register.simple_tag
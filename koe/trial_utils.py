@@ -0,0 +1,109 @@
+"""
+Run independent trials (e.g. the folds of a k-fold validation) over a pool of processes, and keep the results of the
+completed trials in a checkpoint file, so that an interrupted run can resume without redoing them
+"""
+
+import os
+import pickle
+
+from django.conf import settings
+
+from koe.utils import worker_pool
+
+
+# Data shared by all trials of a run_trials() call. The pool is forked after this is set, so the workers inherit it
+# instead of having it pickled with every work item
+_shared = {}
+
+
+class TrialCheckpoint:
+    """
+    An append-only file of (key, result) of completed trials. The first record is the signature of the run (e.g. its
+    arguments) - if that doesn't match, the file belongs to a different run and is started over
+    """
+
+    def __init__(self, path, signature=None):
+        self.path = path
+        self.results = {}
+
+        if os.path.isfile(path):
+            self._load(signature)
+        if not os.path.isfile(path):
+            with open(path, "wb") as f:
+                pickle.dump(signature, f)
+
+    def _load(self, signature):
+        with open(self.path, "rb") as f:
+            try:
+                stored_signature = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                stored_signature = None
+
+            matched = stored_signature == signature
+            valid_length = f.tell()
+            while matched:
+                try:
+                    key, result = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                self.results[key] = result
+                valid_length = f.tell()
+
+        if not matched:
+            print("Checkpoint {} is of a different run, starting over".format(self.path))
+            os.remove(self.path)
+
+        # The last record is incomplete if the run was killed while writing it
+        elif valid_length < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_length)
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, key, default=None):
+        return self.results.get(key, default)
+
+    def add(self, key, result):
+        self.results[key] = result
+        with open(self.path, "ab") as f:
+            pickle.dump((key, result), f)
+
+
+def _run_work_item(func_and_work_item):
+    func, key, work_item = func_and_work_item
+    return key, func(work_item, _shared)
+
+
+def run_trials(func, work_items, shared=None, checkpoint=None):
+    """
+    Run func on each work item and yield (key, result). If settings.EVALUATION_WORKERS > 1 the work items are spread
+    over a pool of processes and the results are yielded in order of completion.
+    :param func: a picklable, module-level function taking (work item, shared)
+    :param work_items: list of (key, work item). Keys must be picklable and unique
+    :param shared: dict of data used by all work items, e.g. the whole dataset
+    :param checkpoint: a TrialCheckpoint. Work items whose key is in it are not run again, their stored results are
+                       yielded first. Results of the others are added to it as soon as they complete
+    """
+    _shared.clear()
+    if shared is not None:
+        _shared.update(shared)
+
+    remaining = []
+    for key, work_item in work_items:
+        if checkpoint is not None and key in checkpoint:
+            yield key, checkpoint.get(key)
+        else:
+            remaining.append((func, key, work_item))
+
+    try:
+        with worker_pool(min(settings.EVALUATION_WORKERS, len(remaining))) as imap:
+            for key, result in imap(_run_work_item, remaining):
+                if checkpoint is not None:
+                    checkpoint.add(key, result)
+                yield key, result
+    finally:
+        _shared.clear()
@@ -2,20 +2,23 @@
 Utils for tensorflow
 """
 
+import hashlib
 import io
 import json
 import os
 import uuid
 
 from django.conf import settings
+from django.db.models import Count, Max
 from django.urls import reverse
 
 import numpy as np
 from sklearn.decomposition import PCA, FastICA
 
+from koe.label_store import get_label_column, get_label_column_version, lookup_labels
 from koe.ml_utils import run_clustering
-from koe.models import DerivedTensorData, Segment
-from root.models import ExtraAttrValue
+from koe.models import AudioFile, DerivedTensorData, Segment
+from root.models import ExtraAttr, ExtraAttrValue, get_extra_attr_values
 from root.utils import ensure_parent_folder_exists
 
 
@@ -33,6 +36,8 @@ def ica_reduce(data, n_components=50):
     return dim_reduce_func.fit_transform(data)
 
 
+COLUMNAR_MAGIC = b"KOECOLS1"
+
 reduce_funcs = {
     "ica": ica_reduce,
     "pca": pca_reduce,
@@ -57,6 +62,92 @@ def bytes_to_ndarray(filename, dtype=np.float32):
     return arr
 
 
+def ndarray_to_columnar(arr, col_inds, filename):
+    """
+    Store a 2D matrix column group by column group, each group transposed and contiguous on disk, so that a group
+    can be read back without touching the rest of the matrix.
+    Layout: magic, header length (uint32), JSON header, padding to the next 8-byte boundary, then the groups
+    :param arr: 2D array (nrows x ncols)
+    :param col_inds: dict of group name -> (start column, end column) as produced by extract_rawdata
+    :param filename: path to the columnar file
+    :return: None
+    """
+    assert isinstance(arr, np.ndarray) and arr.ndim == 2
+
+    nrows = arr.shape[0]
+    groups = {}
+    offset = 0
+    for name, (start, end) in sorted(col_inds.items(), key=lambda x: x[1][0]):
+        groups[name] = (start, end, offset)
+        offset += (end - start) * nrows * arr.dtype.itemsize
+
+    header = json.dumps(dict(nrows=nrows, dtype=arr.dtype.str, groups=groups)).encode("utf-8")
+    data_start = _columnar_data_start(len(header))
+
+    ensure_parent_folder_exists(filename)
+    with open(filename, "wb") as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+        f.write(b"\0" * (data_start - f.tell()))
+        for name, (start, end, _) in sorted(groups.items(), key=lambda x: x[1][2]):
+            np.ascontiguousarray(arr[:, start:end].T).tofile(f)
+
+
+def _columnar_data_start(header_len):
+    header_end = len(COLUMNAR_MAGIC) + 4 + header_len
+    return (header_end + 7) // 8 * 8
+
+
+def read_columnar_header(filename):
+    """
+    :param filename: path to a file written by ndarray_to_columnar
+    :return: number of rows, dtype, dict of group name -> (start column, end column, offset) and the data offset
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(COLUMNAR_MAGIC))
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError("{} is not a columnar matrix file".format(filename))
+        header_len = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(header_len).decode("utf-8"))
+
+    return header["nrows"], np.dtype(header["dtype"]), header["groups"], _columnar_data_start(header_len)
+
+
+def columnar_to_ndarray(filename, group_names=None, rows=None):
+    """
+    Read only the requested column groups (and rows) of a columnar matrix file. Groups are memory-mapped so the
+    rest of the file is never read.
+    :param filename: path to a file written by ndarray_to_columnar
+    :param group_names: names of the column groups, in the order they should appear in the result. None to read
+                        all groups in their original column order
+    :param rows: indices of the rows to read. None to read all rows
+    :return: 2D array (nrows x total number of columns of the groups)
+    """
+    nrows, dtype, groups, data_start = read_columnar_header(filename)
+    nrows_out = nrows if rows is None else len(rows)
+    if group_names is None:
+        group_names = sorted(groups.keys(), key=lambda x: groups[x][0])
+
+    blocks = []
+    for name in group_names:
+        if name not in groups:
+            raise ValueError("Column group {} doesn't exist in {}".format(name, filename))
+        start, end, offset = groups[name]
+        ncols = end - start
+        if ncols == 0 or nrows == 0:
+            blocks.append(np.empty((nrows_out, ncols), dtype=dtype))
+            continue
+
+        block = np.memmap(filename, dtype=dtype, mode="r", offset=data_start + offset, shape=(ncols, nrows))
+        if rows is None:
+            blocks.append(np.array(block.T))
+        else:
+            blocks.append(block[:, rows].T)
+
+    return np.concatenate(blocks, axis=1)
+
+
 def load_config(config_file):
     if os.path.isfile(config_file):
         with open(config_file, "r", encoding="utf-8") as f:
@@ -107,6 +198,83 @@ def write_metadata(metadata, sids, headers, filename=None):
         return content
 
 
+def write_metadata_columns(metadata, sids, headers):
+    """
+    A columnar, much more compact alternative to write_metadata: ids and tids are lists of int and each other column
+    is stored as its distinct values + the index of each row's value
+    :return: a JSON string
+    """
+    rows = [metadata[sid] for sid in sids]
+    columns = []
+    for col_ind in range(2, len(headers)):
+        values, indices = np.unique(np.array([row[col_ind] for row in rows], dtype=str), return_inverse=True)
+        columns.append(dict(values=values.tolist(), indices=indices.tolist()))
+
+    return json.dumps(
+        dict(
+            headers=headers,
+            ids=[int(row[0]) for row in rows],
+            tids=[int(row[1]) for row in rows],
+            columns=columns,
+        )
+    )
+
+
+def get_metadata_version(sids_path, annotator, database):
+    """
+    Cheaply tell if the metadata of a tensor or ordination has changed, with three aggregate queries and without
+    loading or building the label columns. The version changes if:
+     - its sids are rewritten
+     - segments are added to or removed from the database
+     - labels of the annotator are created or deleted, or changed through the setters (which rewrite or remove the
+       label columns, see koe.label_store)
+     - the gender of an individual of the database changes, or a song is moved to another individual
+    :return: a version string, or None if there's no database to keep the labels of, or if a label column doesn't
+             exist (e.g. it's been removed after a single value was saved): the metadata is then built, which builds
+             the column, and not cached
+    """
+    if database is None:
+        return None
+
+    column_versions = []
+    for label_level in metadata_label_levels:
+        column_version = get_label_column_version(database, annotator, label_level)
+        if column_version is None:
+            return None
+        column_versions.append(column_version)
+
+    segment_stats = Segment.objects.filter(audio_file__database=database).aggregate(
+        count=Count("id"), max_id=Max("id")
+    )
+
+    label_attrs = ExtraAttr.objects.filter(klass=Segment.__name__, name__in=metadata_label_levels)
+    segs = Segment.objects.filter(audio_file__database=database).values("id")
+    label_stats = (
+        ExtraAttrValue.objects.filter(attr__in=label_attrs, user=annotator, owner_id__in=segs)
+        .values_list("attr")
+        .annotate(count=Count("id"), max_id=Max("id"))
+        .order_by("attr")
+    )
+
+    genders = (
+        AudioFile.objects.filter(database=database)
+        .values_list("individual", "individual__gender")
+        .annotate(count=Count("id"))
+        .order_by("individual")
+    )
+
+    parts = [
+        database.id,
+        annotator.id,
+        os.stat(sids_path).st_mtime_ns,
+        segment_stats["count"],
+        segment_stats["max_id"],
+    ]
+    parts += list(label_stats) + list(genders) + column_versions
+
+    return hashlib.md5("-".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
 def get_tensor_file_paths(config_name, tensors_name):
     binary_path = os.path.join(settings.MEDIA_URL, "oss_data", config_name, "{}.bytes".format(tensors_name))[1:]
     metadata_path = os.path.join(settings.MEDIA_URL, "oss_data", config_name, "{}.tsv".format(tensors_name))[1:]
@@ -134,26 +302,36 @@ def get_rawdata_from_binary(filename, nrows, dtype=np.float32):
     return arr.reshape((nrows, size // nrows))
 
 
-def cherrypick_tensor_data_by_feature_aggreation(full_data, col_inds, features, aggregations):
-    rawdata = []
-
+def get_column_group_names(features, aggregations):
+    """
+    :return: names of the column groups (keys of col_inds) that make up the given features and aggregations
+    """
+    group_names = []
     for feature in features:
         if feature.is_fixed_length:
-            start, end = col_inds[feature.name]
-            rawdata_stacked = full_data[:, start:end]
-            rawdata.append(rawdata_stacked)
-
+            group_names.append(feature.name)
         else:
             for aggregation in aggregations:
-                start, end = col_inds["{}_{}".format(feature.name, aggregation.name)]
-                rawdata_stacked = full_data[:, start:end]
-                rawdata.append(rawdata_stacked)
+                group_names.append("{}_{}".format(feature.name, aggregation.name))
+    return group_names
+
+
+def cherrypick_tensor_data_by_feature_aggreation(full_data, col_inds, features, aggregations):
+    rawdata = []
+
+    for group_name in get_column_group_names(features, aggregations):
+        start, end = col_inds[group_name]
+        rawdata_stacked = full_data[:, start:end]
+        rawdata.append(rawdata_stacked)
 
     rawdata = np.concatenate(rawdata, axis=1)
     return rawdata
 
 
-def cherrypick_tensor_data_by_sids(full_data, full_sids, sids):
+def get_rows_by_sids(full_sids, sids):
+    """
+    :return: row indices of sids in a matrix whose rows correspond to full_sids
+    """
     sorted_ids, sort_order = np.unique(full_sids, return_index=True)
 
     non_existing_idx = np.where(np.logical_not(np.isin(sids, sorted_ids)))
@@ -163,8 +341,11 @@ def cherrypick_tensor_data_by_sids(full_data, full_sids, sids):
         err_msg = "These IDs don't exist: {}".format(",".join(list(map(str, non_existing_ids))))
         raise ValueError(err_msg)
 
-    lookup_ids_rows = np.searchsorted(sorted_ids, sids)
-    return full_data[lookup_ids_rows, :]
+    return sort_order[np.searchsorted(sorted_ids, sids)]
+
+
+def cherrypick_tensor_data_by_sids(full_data, full_sids, sids):
+    return full_data[get_rows_by_sids(full_sids, sids), :]
 
 
 def make_subtensor(user, full_tensor, annotator, features, aggregations, dimreduce, ndims):
@@ -172,17 +353,22 @@ def make_subtensor(user, full_tensor, annotator, features, aggregations, dimredu
     if not reduce_func:
         ndims = None
 
-    full_sids_path = full_tensor.get_sids_path()
-    full_bytes_path = full_tensor.get_bytes_path()
-    full_cols_path = full_tensor.get_cols_path()
+    full_columns_path = full_tensor.get_columns_path()
 
-    sids = bytes_to_ndarray(full_sids_path, np.int32)
+    if os.path.isfile(full_columns_path):
+        new_data = columnar_to_ndarray(full_columns_path, get_column_group_names(features, aggregations))
+    else:
+        full_sids_path = full_tensor.get_sids_path()
+        full_bytes_path = full_tensor.get_bytes_path()
+        full_cols_path = full_tensor.get_cols_path()
+
+        sids = bytes_to_ndarray(full_sids_path, np.int32)
 
-    full_data = get_rawdata_from_binary(full_bytes_path, len(sids))
-    with open(full_cols_path, "r", encoding="utf-8") as f:
-        col_inds = json.load(f)
+        full_data = get_rawdata_from_binary(full_bytes_path, len(sids))
+        with open(full_cols_path, "r", encoding="utf-8") as f:
+            col_inds = json.load(f)
 
-    new_data = cherrypick_tensor_data_by_feature_aggreation(full_data, col_inds, features, aggregations)
+        new_data = cherrypick_tensor_data_by_feature_aggreation(full_data, col_inds, features, aggregations)
     if reduce_func:
         new_data = reduce_func(new_data, n_components=ndims)
 
@@ -222,28 +408,29 @@ def make_subtensor(user, full_tensor, annotator, features, aggregations, dimredu
     return new_tensor
 
 
-def extract_tensor_metadata(sids, annotator):
-    label_levels = ["label", "label_subfamily", "label_family"]
+metadata_label_levels = ["label", "label_subfamily", "label_family"]
+
+
+def extract_tensor_metadata(sids, annotator, database=None):
+    """
+    :param database: if given, labels are read from the label store of this database instead of ExtraAttrValue
+    """
+    label_levels = metadata_label_levels
     headers = ["id", "tid"] + label_levels + ["sex"]
 
     metadata = {id: [str(id), str(tid)] for id, tid in Segment.objects.filter(id__in=sids).values_list("id", "tid")}
 
-    for i in range(len(label_levels)):
-        label_level = label_levels[i]
-        segment_to_label = {
-            x: y.lower()
-            for x, y in ExtraAttrValue.objects.filter(
-                attr__name=label_level,
-                attr__klass=Segment.__name__,
-                owner_id__in=sids,
-                user=annotator,
-            )
-            .order_by("owner_id")
-            .values_list("owner_id", "value")
-        }
-
-        for sid in sids:
-            metadata[sid].append(segment_to_label.get(sid, ""))
+    if database is None:
+        label_values = get_extra_attr_values(Segment.__name__, [int(x) for x in sids], annotator, label_levels)
+        for label_level in label_levels:
+            segment_to_label = label_values.get(label_level, {})
+            for sid in sids:
+                metadata[sid].append(segment_to_label.get(sid, "").lower())
+    else:
+        for label_level in label_levels:
+            labels = lookup_labels(get_label_column(database, annotator, label_level), sids)
+            for sid, label in zip(sids, labels):
+                metadata[sid].append(label.lower())
 
     sid_to_gender = {
         x: y.lower() if y else "unknown"
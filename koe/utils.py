@@ -11,8 +11,10 @@ import re
 from itertools import product
 
 from django.conf import settings
+from django.db import connections
 
 import numpy as np
+from billiard import Pool
 
 from koe import wavfile
 from koe.wavfile import get_wav_info
@@ -73,6 +75,28 @@ def printoptions(*args, **kwargs):
         np.set_printoptions(**original)
 
 
+@contextlib.contextmanager
+def worker_pool(nworkers):
+    """
+    Provide an imap function that runs in a pool of nworkers processes, or in this process if nworkers <= 1.
+    billiard (celery's fork of multiprocessing) is used because it can start a pool from inside a celery worker.
+    The pool is forked on entering, so the workers see whatever module-level data was set before that
+    :return: a function (func, iterable) -> iterator of the results. With a pool they come in order of completion
+    """
+    if nworkers <= 1:
+        yield map
+        return
+
+    # The forked workers must not inherit (and later close) this process's database connections
+    connections.close_all()
+    pool = Pool(processes=nworkers)
+    try:
+        yield pool.imap_unordered
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def wav_2_mono(file, **kwargs):
     """
     Read a wav file and return fs and first channel's data stream.
@@ -491,6 +515,7 @@ PAGE_CAPACITY = 1000
 SPECT_FFT_TEMPLATE = os.path.join(settings.MEDIA_URL, "spect", "syllable", "{}", "{}.png")
 URL_SPECT_FFT_TEMPLATE = SPECT_FFT_TEMPLATE[1:]
 ABS_SPECT_FFT_TEMPLATE = os.path.join(settings.BASE_DIR, URL_SPECT_FFT_TEMPLATE)
+ABS_SPECT_PACK_TEMPLATE = os.path.join(settings.MEDIA_ROOT, "spect", "syllable", "{}.pack")
 
 
 def get_abs_spect_path(spect_id):
@@ -503,6 +528,10 @@ def get_url_spect_path(spect_id):
     return URL_SPECT_FFT_TEMPLATE.format(page, spect_id)
 
 
+def get_abs_spect_pack_path(page):
+    return ABS_SPECT_PACK_TEMPLATE.format(page)
+
+
 def get_closest_neighbours(distmat, labels, nneighbours=3):
     # To discount each element as its nearest neighbour (distance to itself is 0), we first
     # set the diagonal value to more than current max distance. Later we'll restore it
@@ -211,44 +211,6 @@ def get_incomplete_tasks(target_class):
     return dms2tasks
 
 
-def recreate_associated_ordination_tasks(dmid, user):
-    """
-    This is to facilitate datamatrix recreation: if the datamatrix is to be created, it will invalidate all associated
-     ordinations. They need to be rerun as well.
-    :param dmid: id of the datamatrix
-    :return: a list of task ids
-    """
-    tasks = []
-    for ord in Ordination.objects.filter(dm=dmid):
-        task = ord.task
-        if task is None or task.user != user:
-            task = Task(user=user, target="{}:{}".format(Ordination.__name__, ord.id))
-            task.save()
-            ord.task = task
-            ord.save()
-        tasks.append(task)
-    return tasks
-
-
-def recreate_associated_similarity_tasks(dmid, user):
-    """
-    This is to facilitate datamatrix recreation: if the datamatrix is to be created, it will invalidate all associated
-     similarity indices.
-    :param dmid: id of the datamatrix
-    :return: a list of task ids
-    """
-    tasks = []
-    for si in SimilarityIndex.objects.filter(dm=dmid):
-        task = si.task
-        if task is None or task.user != user:
-            task = Task(user=user, target="{}:{}".format(SimilarityIndex.__name__, si.id))
-            task.save()
-            si.task = task
-            si.save()
-        tasks.append(task)
-    return tasks
-
-
 class FeatureExtrationView(FormView):
     form_class = FeatureExtrationForm
     page_name = "feature-extraction"
@@ -330,15 +292,10 @@ class FeatureExtrationView(FormView):
         dm.task = task
         dm.save()
 
-        delay_in_production(extract_database_measurements, task.id, force=is_recreating)
-        if is_recreating:
-            ord_tasks = recreate_associated_ordination_tasks(dmid, user)
-            for task in ord_tasks:
-                delay_in_production(construct_ordination, task.id)
-
-            sim_tasks = recreate_associated_similarity_tasks(dmid, user)
-            for task in sim_tasks:
-                delay_in_production(calculate_similarity, task.id)
+        # Recreating only brings the matrix up to date with the database, unless the user asks to re-extract everything.
+        # Either way, if the matrix changes its ordinations and similarity indices are then reconstructed
+        force = is_recreating and form_data.get("force", False)
+        delay_in_production(extract_database_measurements, task.id, force=force, incremental=is_recreating)
 
         context = self.get_context_data()
         context["task"] = task
@@ -388,7 +345,7 @@ class OrdinationExtrationView(FormView):
 
         has_error = False
 
-        if ord_id:
+        if ord_id and not Ordination.objects.filter(id=ord_id, stale=True).exists():
             form.add_error("ordination", "Already extracted")
             has_error = True
 
@@ -399,7 +356,8 @@ class OrdinationExtrationView(FormView):
         params = Ordination.clean_params(params)
 
         dm = get_or_error(DataMatrix, dict(id=dm_id))
-        if Ordination.objects.filter(dm=dm, method=method, ndims=ndims, params=params).exists():
+        ord = Ordination.objects.filter(dm=dm, method=method, ndims=ndims, params=params).first()
+        if ord is not None and not ord.stale:
             form.add_error("ordination", "Already extracted")
             has_error = True
 
@@ -409,8 +367,9 @@ class OrdinationExtrationView(FormView):
             rendered = render_to_string("partials/ordination-selection-form.html", context=context)
             return HttpResponse(json.dumps(dict(success=True, payload=dict(success=False, html=rendered))))
 
-        ord = Ordination(dm=dm, method=method, ndims=ndims, params=params)
-        ord.save()
+        if ord is None:
+            ord = Ordination(dm=dm, method=method, ndims=ndims, params=params)
+            ord.save()
 
         task = Task(user=user, target="{}:{}".format(Ordination.__name__, ord.id))
         task.save()
@@ -481,20 +440,20 @@ class SimilarityExtrationView(FormView):
         if not has_error:
             if dm_id:
                 dm = get_or_error(DataMatrix, dict(id=dm_id))
-                si = SimilarityIndex.objects.filter(dm=dm).first()
-                if si is not None:
+                si = SimilarityIndex.objects.filter(dm=dm, ord=None).first()
+                if si is None:
+                    si = SimilarityIndex(dm=dm)
+                elif not si.stale:
                     form.add_error("data_matrix", "Already extracted")
                     has_error = True
-                else:
-                    si = SimilarityIndex(dm=dm)
             else:
                 ord = get_or_error(Ordination, dict(id=ord_id))
                 si = SimilarityIndex.objects.filter(ord=ord).first()
-                if si is not None:
+                if si is None:
+                    si = SimilarityIndex(ord=ord, dm=ord.dm)
+                elif not si.stale:
                     form.add_error("ordination", "Already extracted")
                     has_error = True
-                else:
-                    si = SimilarityIndex(ord=ord, dm=ord.dm)
 
         if has_error:
             context = self.get_context_data()
@@ -538,3 +538,112 @@ def write_24b(filename, rate, data):
     assert shape[2] == 3
 
     _write(filename, rate, data, bitrate=24)
+
+
+# Size of the buffer used when copying/converting wav data without loading the whole file
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _find_data_chunk(fid):
+    """
+    Read the format chunk and find the data chunk of a wav file
+    :param fid: file object, positioned at the start of the file
+    :return: (comp, noc, rate, ba, bits) and the position and size (bytes) of the data. For WAVE_FORMAT_EXTENSIBLE,
+             comp is the tag of the sub-format (e.g. 1 for PCM, 3 for IEEE float)
+    """
+    fsize = _read_riff_chunk(fid)
+    fmt = None
+
+    while fid.tell() < fsize:
+        chunk_id = fid.read(4)
+        if chunk_id == b"fmt ":
+            size, comp, noc, rate, sbytes, ba, bits = struct.unpack("<IHHIIHH", fid.read(20))
+            extension = fid.read(size - 16) if size > 16 else b""
+            # _write_header only writes plain format chunks, so an extensible format is replaced by its sub-format,
+            # whose tag is the first two bytes of the sub-format GUID (after cbSize, valid bits and channel mask)
+            if comp == WAVE_FORMAT_EXTENSIBLE:
+                if len(extension) < 24:
+                    raise ValueError("Malformed extensible format chunk in file {}".format(fid.name))
+                comp = struct.unpack("<H", extension[8:10])[0]
+            fmt = (comp, noc, rate, ba, bits)
+        elif chunk_id == b"data":
+            size = struct.unpack("<I", fid.read(4))[0]
+            if fmt is None:
+                break
+            return fmt, fid.tell(), size
+        elif len(chunk_id) < 4:
+            break
+        else:
+            _skip_unknown_chunk(fid)
+
+    raise ValueError("Unable to find FMT and DATA blocks in file {}".format(fid.name))
+
+
+def _write_header(fid, rate, comp, noc, ba, bits, data_size):
+    fid.write(b"RIFF")
+    fid.write(struct.pack("<I", 36 + data_size + (data_size & 1)))
+    fid.write(b"WAVE")
+    fid.write(b"fmt ")
+    fid.write(struct.pack("<ihHIIHH", 16, comp, noc, rate, rate * ba, ba, bits))
+    fid.write(b"data")
+    fid.write(struct.pack("<I", data_size))
+
+
+def _stream_blocks(fid, data_size, block_size):
+    remaining = data_size
+    while remaining > 0:
+        block = fid.read(min(block_size, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+
+def change_rate(filename, new_rate, new_filename):
+    """
+    Write a copy of a wav file with a different sample rate in its header, without changing the actual data.
+    Only the format and data chunks are kept. The data is copied in blocks, never loaded entirely
+    :param filename: path to the original wav file
+    :param new_rate: the new sample rate
+    :param new_filename: path to the new wav file
+    :return: None
+    """
+    with open(filename, "rb") as fid:
+        (comp, noc, rate, ba, bits), data_start, data_size = _find_data_chunk(fid)
+        fid.seek(data_start, SEEK_ABSOLUTE)
+
+        block_size = nearest_multiple(STREAM_BUFFER_SIZE, ba)
+        with open(new_filename, "wb") as new_fid:
+            _write_header(new_fid, new_rate, comp, noc, ba, bits, data_size)
+            for block in _stream_blocks(fid, data_size, block_size):
+                new_fid.write(block)
+            if data_size & 1:
+                new_fid.write(b"\x00")
+
+
+def float_to_pcm(filename, new_filename):
+    """
+    Convert an IEEE float wav file into a 32-bit integer PCM wav file, block by block
+    :param filename: path to the IEEE float wav file
+    :param new_filename: path to the new wav file. Must be different from filename
+    :return: None
+    """
+    with open(filename, "rb") as fid:
+        (comp, noc, rate, ba, bits), data_start, data_size = _find_data_chunk(fid)
+        if comp != 3:
+            raise ValueError("File {} is not an IEEE float wav file".format(filename))
+        fid.seek(data_start, SEEK_ABSOLUTE)
+
+        float_dtype = "<f{}".format(bits // 8)
+        new_ba = noc * 4
+        new_data_size = data_size // ba * new_ba
+        block_size = nearest_multiple(STREAM_BUFFER_SIZE, ba)
+
+        with open(new_filename, "wb") as new_fid:
+            _write_header(new_fid, rate, 1, noc, new_ba, 32, new_data_size)
+            for block in _stream_blocks(fid, data_size - data_size % ba, block_size):
+                data = np.frombuffer(block, dtype=float_dtype)
+                data = np.clip(data.astype(np.float64), -1.0, 1.0) * (2**31 - 1)
+                new_fid.write(data.astype("<i4").tobytes())
@@ -0,0 +1,16 @@
+# Generated by Django 2.0.4 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("root", "0003_auto_20191201_0709"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="extraattrvalue",
+            index=models.Index(fields=["attr", "user", "owner_id"], name="root_extraa_attr_id_25ad67_idx"),
+        ),
+    ]
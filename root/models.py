@@ -4,10 +4,11 @@ import string
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.db import models, utils
-from django.db.models import Case, When
 from django.db.models.base import ModelBase
 from django.db.models.query import QuerySet
+from django.dispatch import Signal
 
+import numpy as np
 import six
 from django_bulk_update.helper import bulk_update
 
@@ -27,10 +28,19 @@ __all__ = [
     "value_setter",
     "value_getter",
     "get_bulk_id",
+    "get_ordered_values",
     "has_field",
+    "extra_attr_values_changed",
 ]
 
 
+# Sent after values of an extra attribute have been changed in bulk (post_save isn't sent by update/bulk_create).
+# created_owner_ids are the owners that didn't have a value before.
+# owner_ids, created_owner_ids or value is None if not known, attr is None if all attributes of this user might have
+# been changed
+extra_attr_values_changed = Signal(providing_args=["attr", "user", "owner_ids", "created_owner_ids", "value"])
+
+
 def enum(*sequential, **named):
     original_enums = dict(zip(sequential, range(len(sequential))), **named)
     enums = dict((key, value) for key, value in original_enums.items())
@@ -280,12 +290,60 @@ class ExtraAttrValue(models.Model):
         unique_together = ("user", "owner_id", "attr")
         indexes = [
             models.Index(fields=["owner_id"]),
+            models.Index(fields=["attr", "user", "owner_id"]),
         ]
 
     def __str__(self):
         return "{}'s {} = {}".format(self.owner_id, self.attr.name, self.value)
 
 
+# Lists of IDs are sent to the database in chunks of this size, see get_extra_attr_values and get_ordered_values
+BULK_ATTR_MAX_IN_LIST = 1000
+
+
+def get_extra_attr_values(klass, owners, user, attrs=None):
+    """
+    Read the values of extra attributes of many objects with one query, pivoted by attribute.
+    The owners are never sent as a huge IN list: a QuerySet becomes a subquery (prefer this), and a list of IDs is
+    sent in chunks of BULK_ATTR_MAX_IN_LIST. Either way values are found through the (attr, user, owner_id) index
+    :param klass: name of the class of the owners, e.g. 'Segment'
+    :param owners: a QuerySet of the owners, or a list of their IDs
+    :param user: the User (or username) that the values belong to
+    :param attrs: names of the attributes (or ExtraAttr objects) to read. If None, read all attributes of klass
+    :return: dict of format {attr name -> {owner_id -> value}}. Values are not converted from string
+    """
+    extra_attrs = ExtraAttr.objects.filter(klass=klass)
+    if attrs is not None:
+        attr_names = [x.name if isinstance(x, ExtraAttr) else x for x in attrs]
+        extra_attrs = extra_attrs.filter(name__in=attr_names)
+    attr_id_to_name = {x: y for x, y in extra_attrs.values_list("id", "name")}
+
+    retval = {name: {} for name in attr_id_to_name.values()}
+    if len(attr_id_to_name) == 0:
+        return retval
+
+    values = ExtraAttrValue.objects.filter(attr__in=list(attr_id_to_name.keys()))
+    if isinstance(user, str):
+        values = values.filter(user__username=user)
+    else:
+        values = values.filter(user=user)
+
+    if isinstance(owners, QuerySet):
+        chunks = [values.filter(owner_id__in=owners.values("id"))]
+    else:
+        owners = list(owners)
+        chunks = [
+            values.filter(owner_id__in=owners[i : i + BULK_ATTR_MAX_IN_LIST])
+            for i in range(0, len(owners), BULK_ATTR_MAX_IN_LIST)
+        ]
+
+    for chunk in chunks:
+        for attr_id, owner_id, value in chunk.values_list("attr", "owner_id", "value"):
+            retval[attr_id_to_name[attr_id]][owner_id] = value
+
+    return retval
+
+
 def get_bulk_attrs(objs, attr):
     """
     Return values of an attribute for all objects
@@ -310,6 +368,39 @@ def get_bulk_id(objs):
     return [obj.id for obj in objs]
 
 
+def get_ordered_values(objs, ids, fields, flat=False):
+    """
+    Same as objs.filter(id__in=ids).values_list(*fields) but in the order of ids.
+    Rows are fetched with plain IN lists (in chunks of BULK_ATTR_MAX_IN_LIST) and reordered here, instead of
+    ordering by a CASE with one WHEN per ID, which is slow to parse and can exceed the maximum statement size
+    :param objs: a QuerySet (or Manager) to fetch rows from
+    :param ids: IDs of the rows, in the order wanted
+    :param fields: names of the fields to fetch
+    :param flat: if True, fields must contain only one field and values are returned instead of tuples
+    :return: a list of values (or tuples of values) in the order of ids. IDs that are not found are skipped
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    rows = []
+    for i in range(0, len(ids), BULK_ATTR_MAX_IN_LIST):
+        rows += objs.filter(id__in=ids[i : i + BULK_ATTR_MAX_IN_LIST].tolist()).values_list("id", *fields)
+
+    if len(rows) == 0:
+        return []
+
+    row_ids = np.array([x[0] for x in rows], dtype=np.int64)
+    sorted_row_inds = np.argsort(row_ids)
+    sorted_row_ids = row_ids[sorted_row_inds]
+
+    positions = np.searchsorted(sorted_row_ids, ids)
+    positions[positions == len(sorted_row_ids)] = 0
+    found = sorted_row_ids[positions] == ids
+    row_inds = sorted_row_inds[positions[found]]
+
+    if flat:
+        return [rows[i][1] for i in row_inds]
+    return [rows[i][1:] for i in row_inds]
+
+
 class AutoSetterGetterMixin:
     @classmethod
     def _get_(cls, objs, attr):
@@ -332,8 +423,12 @@ class AutoSetterGetterMixin:
         """
         if not isinstance(objs, QuerySet):
             ids = [x.id for x in objs]
-            preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(ids)])
-            objs = objs[0].__class__.objects.filter(id__in=ids).order_by(preserved)
+            klass = objs[0].__class__
+            if isinstance(value, list):
+                id_to_obj = klass.objects.in_bulk(ids)
+                objs = [id_to_obj[id] for id in ids if id in id_to_obj]
+            else:
+                objs = klass.objects.filter(id__in=ids)
 
         if isinstance(value, list):
             for obj, val in zip(objs, value):
@@ -360,18 +455,16 @@ class AutoSetterGetterMixin:
         if isinstance(objs, QuerySet):
             objids = list(objs.values_list("id", flat=True))
         else:
-            objids = {obj.id: None for obj in objs}
+            objids = [obj.id for obj in objs]
 
         retval = {objid: None for objid in objids}
 
         extra_attr = ExtraAttr.objects.get(klass=cls.__name__, name=attr)
         str2val = value_getter[extra_attr.type]
 
-        values = ExtraAttrValue.objects.filter(user=user, owner_id__in=objids, attr__name=attr).values_list(
-            "owner_id", "value"
-        )
+        values = get_extra_attr_values(cls.__name__, objids, user, [extra_attr])[attr]
 
-        for owner_id, value in values:
+        for owner_id, value in values.items():
             retval[owner_id] = str2val(value)
 
         return retval
@@ -406,6 +499,14 @@ class AutoSetterGetterMixin:
         ]
 
         ExtraAttrValue.objects.bulk_create(newly_created)
+        extra_attr_values_changed.send(
+            sender=cls,
+            attr=extra_attr,
+            user=user,
+            owner_ids=ids,
+            created_owner_ids=nonexistings_owner_ids,
+            value=value,
+        )
 
     @classmethod
     def get_FIELD(cls, attr):
@@ -1,13 +1,15 @@
 import datetime
 import importlib
 import json
+import re
 from collections import OrderedDict
 
 from django.conf import settings
 from django.db import IntegrityError, transaction
-from django.db.models import ForeignKey, ManyToManyField
+from django.db.models import FloatField, ForeignKey, ManyToManyField, OuterRef, Subquery
 from django.db.models.base import ModelBase
 from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.db.models.functions import Cast
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -94,6 +96,152 @@ def get_attrs(objs, table, extras):
     return rows
 
 
+number_filter_lookups = [
+    ("<=", "__lte"),
+    (">=", "__gte"),
+    ("==", ""),
+    ("<", "__lt"),
+    (">", "__gt"),
+    ("=", ""),
+]
+
+# Extra attribute values are free text, only those that look like a number are cast to one for sorting and filtering
+numeric_value_regex = r"^ *[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)? *$"
+
+max_page_size = 1000
+
+date_filter_regex = re.compile(r"^(?:from\((\d{4}-\d{2}-\d{2})\))?(?:to\((\d{4}-\d{2}-\d{2})\))?$")
+
+
+def get_filter_kwargs(lookup, filter_type, value):
+    """
+    Convert the value typed in a grid's filter into queryset filter arguments. Supports the same syntax as the
+    client-side filters (see grid-utils.js)
+    :param lookup: name of the field or annotation to filter
+    :param filter_type: the column's filter type (String, Number, Boolean or Date)
+    :param value: the filter value, e.g. '>=100', '[1,2,3]', '10..20', 'from(2018-01-01)to(2019-01-01)', '^A.*'
+    :return: dict of filter arguments
+    """
+    value = value.strip()
+    if value == "":
+        return {}
+
+    try:
+        if filter_type == "String":
+            return {"{}__iregex".format(lookup): value}
+
+        if filter_type == "Boolean":
+            return {lookup: value == "true"}
+
+        if filter_type == "Date":
+            match = date_filter_regex.match(value)
+            if match is None:
+                raise ValueError()
+            kwargs = {}
+            from_date, to_date = match.groups()
+            if from_date:
+                kwargs["{}__gte".format(lookup)] = datetime.datetime.strptime(from_date, "%Y-%m-%d").date()
+            if to_date:
+                kwargs["{}__lte".format(lookup)] = datetime.datetime.strptime(to_date, "%Y-%m-%d").date()
+            return kwargs
+
+        if filter_type == "Number":
+            for operator, suffix in number_filter_lookups:
+                if value.startswith(operator):
+                    return {lookup + suffix: float(value[len(operator) :])}
+
+            if value.startswith("[") and value.endswith("]"):
+                return {"{}__in".format(lookup): [float(x) for x in value[1:-1].split(",")]}
+
+            for operator, lower_suffix, upper_suffix in [("..", "__gt", "__lt"), ("++", "__gte", "__lte")]:
+                if operator in value:
+                    lower, upper = value.split(operator, 1)
+                    return {lookup + lower_suffix: float(lower), lookup + upper_suffix: float(upper)}
+
+            return {lookup: float(value)}
+    except ValueError:
+        pass
+
+    raise CustomAssertionError("Invalid filter value: {}".format(value))
+
+
+def _annotate_column(objs, column, extras):
+    """
+    Make a column sortable and filterable in SQL
+    :return: the (possibly annotated) queryset and the lookup name of the column
+    """
+    slug = column["slug"]
+    sql = column["sql"]
+
+    if column["is_extra_attr"]:
+        klass = objs.model
+        attr = ExtraAttr.objects.get(klass=klass.__name__, name=slug)
+        viewas = extras.get("viewas", None) or extras.user.username
+        values = ExtraAttrValue.objects.filter(attr=attr, owner_id=OuterRef("pk"), user__username=viewas)
+        if column["filter"] == "Number":
+            values = values.filter(value__regex=numeric_value_regex)
+            value = Cast(Subquery(values.values("value")[:1]), FloatField())
+        else:
+            value = Subquery(values.values("value")[:1])
+        lookup = "_extra_{}".format(slug)
+        return objs.annotate(**{lookup: value}), lookup
+
+    if sql is None:
+        raise CustomAssertionError("Column {} can't be sorted or filtered when the grid is paged".format(slug))
+
+    if isinstance(sql, str):
+        return objs, sql
+
+    lookup = "_sql_{}".format(slug)
+    return objs.annotate(**{lookup: sql}), lookup
+
+
+def get_page_ids(objs, table, extras, offset, limit, sort_by=None, sort_asc=True, filters=None):
+    """
+    Sort and filter the objects of a table in SQL, then return only the IDs of one window of them.
+    The table must have a scoper, which restricts the objects to those that its getter would display
+    :param objs: QuerySet of all objects
+    :param table: the table config
+    :param extras: same extras given to the table's getter
+    :param offset: index of the first row to return
+    :param limit: maximum number of rows to return, at most max_page_size
+    :param sort_by: slug of the column to sort by. Sorted by ID if None
+    :param sort_asc: True to sort ascending
+    :param filters: dict of column slug -> filter value (see get_filter_kwargs)
+    :return: list of IDs in this window, and the total number of rows (after filtering)
+    """
+    scoper = table.get("scoper", None)
+    if scoper is None:
+        raise CustomAssertionError("This table cannot be paged")
+    if offset < 0:
+        raise CustomAssertionError("Invalid offset: {}".format(offset))
+    if limit <= 0 or limit > max_page_size:
+        raise CustomAssertionError("Limit must be between 1 and {}".format(max_page_size))
+
+    objs = scoper(objs, extras)
+    columns = {column["slug"]: column for column in table["columns"]}
+
+    if filters:
+        for slug, value in filters.items():
+            column = columns.get(slug, None)
+            if column is None or column["filter"] is None:
+                raise CustomAssertionError("Column {} can't be filtered".format(slug))
+            objs, lookup = _annotate_column(objs, column, extras)
+            objs = objs.filter(**get_filter_kwargs(lookup, column["filter"], value))
+
+    ordering = ["pk"]
+    if sort_by:
+        column = columns.get(sort_by, None)
+        if column is None or not column["sortable"]:
+            raise CustomAssertionError("Column {} can't be sorted".format(sort_by))
+        objs, lookup = _annotate_column(objs, column, extras)
+        ordering = [lookup if sort_asc else "-{}".format(lookup), "pk"]
+
+    total = objs.count()
+    ids = list(objs.order_by(*ordering).values_list("pk", flat=True)[offset : offset + limit])
+    return ids, total
+
+
 def init_tables():
     """
     Modify the raw table config in jsons to make the items (getters/setters) directly usable as Python object
@@ -112,6 +260,9 @@ def init_tables():
         if has_bulk_getter:
             table["getter"] = global_namespace[table["getter"]]
 
+        if "scoper" in table:
+            table["scoper"] = global_namespace[table["scoper"]]
+
         table["table-editable"] = getattr(klass, "get_table_editability", True)
         table["row-editable"] = getattr(klass, "get_row_editability", None)
         table["filter"] = getattr(klass, "filter", None)
@@ -170,6 +321,15 @@ def init_tables():
             if editable:
                 column["setter"] = setter
 
+            # How to sort/filter this column in SQL when the grid is paged: a field lookup, or an expression given by
+            # the class's get_sql_<slug>(). Extra attributes are looked up by a subquery (see _annotate_column)
+            sql = column.get("sql", slug if is_attribute else None)
+            sql_getter = getattr(klass, "get_sql_{}".format(slug), None)
+            if sql_getter is not None:
+                sql = sql_getter()
+            column["sql"] = sql
+            column["is_extra_attr"] = is_extra_attr
+
             if is_extra_attr:
                 ExtraAttr.objects.get_or_create(klass=klass.__name__, type=_type, name=slug)
 
@@ -253,6 +413,9 @@ def get_grid_column_definition(request):
         if "options" in column:
             col_def["options"] = column["options"]
 
+        if "scoper" in table:
+            col_def["serverSortable"] = column["sql"] is not None or column["is_extra_attr"]
+
         if not is_addon:
             col_def["name"] = column["name"]
 
@@ -309,8 +472,27 @@ def get_grid_content(request):
         objs = klass.objects.all()
     else:
         objs = filter(extras)
-    rows = get_attrs(objs, table, extras)
-    return dict(origin="get_grid_content", success=True, warning=None, payload=rows)
+
+    if "limit" not in request.POST:
+        rows = get_attrs(objs, table, extras)
+        return dict(origin="get_grid_content", success=True, warning=None, payload=rows)
+
+    try:
+        offset = int(request.POST.get("offset", 0))
+        limit = int(request.POST["limit"])
+    except ValueError:
+        raise CustomAssertionError("Offset and limit must be integers")
+    sort_by = request.POST.get("sort-by", None)
+    sort_asc = request.POST.get("sort-asc", "true") == "true"
+    filters = json.loads(request.POST.get("filters", "{}"))
+
+    ids, total = get_page_ids(objs, table, extras, offset, limit, sort_by, sort_asc, filters)
+    rows = get_attrs(klass.objects.filter(pk__in=ids), table, extras)
+
+    id2row = {row["id"]: row for row in rows}
+    rows = [id2row[id] for id in ids if id in id2row]
+    payload = dict(rows=rows, total=total, offset=offset)
+    return dict(origin="get_grid_content", success=True, warning=None, payload=payload)
 
 
 def set_property_bulk(request):
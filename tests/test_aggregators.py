@@ -47,3 +47,24 @@ class Test(TestCase):
 
         correct = np.array([method(div, axis=-1) for div in divs]).ravel()
         self.assertTrue(np.allclose(correct, results))
+
+    def test_process_batch(self):
+        from koe.aggregator import enabled_aggregators, make_ragged_batch
+
+        lengths = [1, 2, 3, 5, 7, 29, 30, 71, 200]
+        for nrows in [None, 1, 13]:
+            if nrows is None:
+                arrs = [np.random.rand(length).astype(np.float32) for length in lengths]
+            else:
+                arrs = [np.random.rand(nrows, length).astype(np.float32) for length in lengths]
+            values, offsets = make_ragged_batch(arrs)
+
+            for group in enabled_aggregators.values():
+                for aggregator in group:
+                    results = aggregator.process_batch(values, offsets)
+                    self.assertEqual(len(results), len(arrs))
+
+                    for arr, result in zip(arrs, results):
+                        correct = aggregator.process(arr)
+                        self.assertEqual(np.shape(correct), np.shape(result))
+                        self.assertTrue(np.allclose(correct, result, atol=tol), aggregator.name)
@@ -0,0 +1,128 @@
+import datetime
+import io
+from contextlib import redirect_stdout
+
+import django
+from django.test import TestCase
+
+
+django.setup()
+
+
+class AnnotationCoverageTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        from koe.annotation_coverage import _cache_key
+        from koe.models import AudioFile, AudioTrack, Database, Individual, Segment
+        from root.models import ExtraAttr, User, ValueTypes
+
+        self.annotator = User.objects.create(username="coverage_test", email="coverage_test@example.com")
+        self.other = User.objects.create(username="coverage_test_other", email="coverage_test_other@example.com")
+        self.database = Database.objects.create(name="coverage_test")
+        individual = Individual.objects.create(name="coverage_test")
+        track = AudioTrack.objects.create(name="coverage_test", date=datetime.date(2020, 1, 1))
+        self.audio_file = AudioFile.objects.create(
+            name="coverage_test",
+            fs=48000,
+            length=1000,
+            noc=1,
+            database=self.database,
+            individual=individual,
+            track=track,
+            added=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        self.segments = [
+            Segment.objects.create(audio_file=self.audio_file, start_time_ms=i * 10, end_time_ms=i * 10 + 5)
+            for i in range(4)
+        ]
+        for level in ["label", "label_family"]:
+            ExtraAttr.objects.get_or_create(
+                klass=Segment.__name__, name=level, defaults=dict(type=ValueTypes.SHORT_TEXT)
+            )
+        cache.delete(_cache_key(self.database.id))
+
+    def _set_labels(self, segments, level, value, user):
+        from dotmap import DotMap
+
+        from koe.models import Segment
+
+        Segment._set_extra_(segments, level, value, DotMap(user=user))
+
+    def test_count_annotations(self):
+        from koe.annotation_coverage import count_annotations
+
+        self.assertEqual(count_annotations(self.database.id), {})
+
+        self._set_labels(self.segments[:3], "label", "A", self.annotator)
+        self._set_labels(self.segments[:1], "label_family", "F", self.annotator)
+        self._set_labels(self.segments[2:], "label", "B", self.other)
+
+        counts = count_annotations(self.database.id)
+        self.assertEqual(counts[self.annotator.id], dict(label=3, label_family=1, label_subfamily=0))
+        self.assertEqual(counts[self.other.id], dict(label=2, label_family=0, label_subfamily=0))
+
+    def test_incremental_updates(self):
+        from koe.annotation_coverage import get_annotation_coverage, get_annotation_percentages
+        from root.models import User
+
+        user_ids = [self.annotator.id, self.other.id]
+        nsyls, counts = get_annotation_coverage(self.database, user_ids)
+        self.assertEqual(nsyls, 4)
+        self.assertEqual(counts[self.annotator.id]["label"], 0)
+
+        # Only the segments are queried while they don't change. New labels are added to the cached counts,
+        # relabelling doesn't count them twice
+        with self.assertNumQueries(1):
+            get_annotation_coverage(self.database, user_ids)
+        self._set_labels(self.segments[:2], "label", "A", self.annotator)
+        self._set_labels(self.segments[1:3], "label", "B", self.annotator)
+        self._set_labels(self.segments[:1], "label_family", "F", self.other)
+        _, counts = get_annotation_coverage(self.database, user_ids)
+        self.assertEqual(counts[self.annotator.id], dict(label=3, label_family=0, label_subfamily=0))
+        self.assertEqual(counts[self.other.id], dict(label=0, label_family=1, label_subfamily=0))
+        self.assertEqual(counts, get_annotation_coverage(self.database, user_ids, refresh=True)[1])
+
+        percentages = get_annotation_percentages(self.database, [self.annotator])
+        self.assertEqual(percentages[self.annotator]["label"], 75)
+
+        # A user who wasn't counted before triggers a recount instead of showing as zero
+        late = User.objects.create(username="coverage_test_late", email="coverage_test_late@example.com")
+        self._set_labels(self.segments[3:], "label", "C", late)
+        _, counts = get_annotation_coverage(self.database, [late.id])
+        self.assertEqual(counts[late.id]["label"], 1)
+
+    def test_recount_on_segments_changed(self):
+        from koe.annotation_coverage import get_annotation_coverage
+        from koe.models import Segment
+
+        self._set_labels(self.segments, "label", "A", self.annotator)
+        self.assertEqual(
+            get_annotation_coverage(self.database, [self.annotator.id]),
+            (4, {self.annotator.id: dict(label=4, label_family=0, label_subfamily=0)}),
+        )
+
+        Segment.objects.filter(id=self.segments[0].id).delete()
+        nsyls, counts = get_annotation_coverage(self.database, [self.annotator.id])
+        self.assertEqual(nsyls, 3)
+        self.assertEqual(counts[self.annotator.id]["label"], 3)
+
+        segment = Segment.objects.create(audio_file=self.audio_file, start_time_ms=100, end_time_ms=105)
+        self._set_labels([segment], "label", "A", self.annotator)
+        nsyls, counts = get_annotation_coverage(self.database, [self.annotator.id])
+        self.assertEqual(nsyls, 4)
+        self.assertEqual(counts[self.annotator.id]["label"], 4)
+
+    def test_command(self):
+        from django.core.management import call_command
+
+        self._set_labels(self.segments[:1], "label", "A", self.annotator)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            call_command("annotation_coverage", database_name="coverage_test")
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "coverage_test: 4 syllables")
+        # Users who haven't labelled anything aren't listed
+        self.assertEqual(len(lines), 2)
+        self.assertIn("coverage_test: label: 1 (25.0%), label_family: 0 (0.0%)", lines[1])
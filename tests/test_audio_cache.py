@@ -0,0 +1,69 @@
+import os
+import shutil
+import time
+import uuid
+
+import django
+from django.test import TestCase
+
+
+django.setup()
+
+
+class BytesLRUCacheTest(TestCase):
+    def test_evict_least_recently_used(self):
+        from koe.audio_cache import BytesLRUCache
+
+        cache = BytesLRUCache(max_bytes=30)
+        cache.set("a", b"0" * 10)
+        cache.set("b", b"1" * 10)
+        cache.set("c", b"2" * 10)
+
+        self.assertEqual(cache.get("a"), b"0" * 10)
+
+        # Adding "d" must evict "b", which is now the least recently used
+        cache.set("d", b"3" * 10)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"2" * 10)
+
+        # Too big to be kept at all
+        cache.set("e", b"4" * 31)
+        self.assertIsNone(cache.get("e"))
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], 30)
+
+    def test_shared_folder(self):
+        from koe.audio_cache import BytesLRUCache
+
+        folder = "/tmp/{}".format(uuid.uuid4().hex)
+        try:
+            cache1 = BytesLRUCache(max_bytes=100, folder=folder, folder_max_bytes=25, prune_every=1)
+            cache2 = BytesLRUCache(max_bytes=100, folder=folder, folder_max_bytes=25, prune_every=1)
+
+            computed = []
+
+            def compute(value):
+                computed.append(value)
+                return value
+
+            cache1.get_or_compute("a", compute, b"0" * 10)
+            time.sleep(0.01)
+            cache1.get_or_compute("b", compute, b"1" * 10)
+
+            # Computed by the other process
+            self.assertEqual(cache2.get_or_compute("a", compute, b"x"), b"0" * 10)
+            self.assertEqual(len(computed), 2)
+            self.assertEqual(cache2.stats()["disk_hits"], 1)
+
+            # Folder goes over its limit, "b" is the least recently used file
+            time.sleep(0.01)
+            cache1.set("c", b"2" * 10)
+            self.assertEqual(len(os.listdir(folder)), 2)
+            self.assertIsNone(cache2.get("b"))
+            self.assertEqual(cache2.get("c"), b"2" * 10)
+        finally:
+            shutil.rmtree(folder)
@@ -210,3 +210,119 @@ class BinStorageTest(TestCase):
 
         with self.assertRaises((ValueError, FileNotFoundError)):
             bs.retrieve(non_existing_ids, self.loc)
+
+
+class BinStorageMmapTest(TestCase):
+    def setUp(self):
+        self.ids, self.arrs = create_random_id_based_dataset(npoints=2000)
+        self.loc = os.path.join("/tmp", uuid.uuid4().hex)
+        os.mkdir(self.loc)
+        bs.store(self.ids, self.arrs, self.loc)
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def test_retrieve_mmap(self):
+        selected_ids = self.ids[:200]
+        copied_arrs = bs.retrieve(selected_ids, self.loc)
+        mapped_arrs = bs.retrieve(selected_ids, self.loc, mmap=True)
+
+        for copied_arr, mapped_arr in zip(copied_arrs, mapped_arrs):
+            self.assertTrue(np.allclose(copied_arr, mapped_arr))
+
+    def test_index_cache_invalidated_on_update(self):
+        selected_ids = self.ids[:100]
+        bs.retrieve(selected_ids, self.loc)
+        ids_before = bs.retrieve_ids(self.loc)
+
+        new_ids = np.arange(self.ids.max() + 1, self.ids.max() + 11)
+        _, new_arrs = create_random_id_based_dataset(npoints=20)
+        update_arrs = new_arrs[:10]
+        append_arrs = new_arrs[10:]
+
+        bs.store(selected_ids[:10], update_arrs, self.loc)
+        bs.store(new_ids, append_arrs, self.loc)
+
+        ids_after = bs.retrieve_ids(self.loc)
+        self.assertEqual(len(ids_after), len(ids_before) + len(new_ids))
+
+        retrieved_arrs = bs.retrieve(np.concatenate((selected_ids[:10], new_ids)), self.loc, mmap=True)
+        for expected_arr, retrieved_arr in zip(update_arrs + append_arrs, retrieved_arrs):
+            self.assertTrue(np.allclose(expected_arr, retrieved_arr))
+
+
+class BinStorageCompactTest(TestCase):
+    def setUp(self):
+        self.ids, self.arrs = create_random_id_based_dataset(npoints=2000)
+        self.loc = os.path.join("/tmp", uuid.uuid4().hex)
+        os.mkdir(self.loc)
+        bs.store(self.ids, self.arrs, self.loc)
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def _folder_size(self):
+        return sum(os.path.getsize(os.path.join(self.loc, x)) for x in os.listdir(self.loc))
+
+    def _assert_retrievable(self, id2arr):
+        ids = np.array(list(id2arr.keys()))
+        for id, retrieved_arr in zip(ids, bs.retrieve(ids, self.loc)):
+            self.assertTrue(np.allclose(id2arr[id], retrieved_arr))
+
+    def test_update_appends_then_compact(self):
+        id2arr = {x: y for x, y in zip(self.ids, self.arrs)}
+        size_before = self._folder_size()
+
+        updated_ids = self.ids[:500]
+        _, updated_arrs = create_random_id_based_dataset(npoints=500)
+        bs.store(updated_ids, updated_arrs, self.loc)
+        id2arr.update({x: y for x, y in zip(updated_ids, updated_arrs)})
+
+        # No backups are made and replaced values are left in place until compaction
+        self.assertFalse(any(".bak_" in x for x in os.listdir(self.loc)))
+        self.assertGreater(self._folder_size(), size_before)
+        self._assert_retrievable(id2arr)
+
+        # Leftovers of an interrupted write and of the old backup-based updates are reclaimed too
+        for leftover in [bs.TMP_PREFIX + "index.1-1000", "value.1-1000.bak_2020-01-01_00-00-00"]:
+            with open(os.path.join(self.loc, leftover), "wb") as f:
+                f.write(b"\0" * 40)
+
+        size_before_compaction = self._folder_size()
+        reclaimed = bs.compact(self.loc)
+
+        values_size = sum(np.size(x) for x in id2arr.values()) * 4
+        index_size = len(id2arr) * bs.INDEX_FILE_NCOLS * 4
+        self.assertEqual(self._folder_size(), values_size + index_size)
+        self.assertEqual(reclaimed, size_before_compaction - self._folder_size())
+        self.assertEqual(bs.compact(self.loc), 0)
+        self._assert_retrievable(id2arr)
+
+    def test_finish_interrupted_compaction(self):
+        id2arr = {x: y for x, y in zip(self.ids, self.arrs)}
+        _, updated_arrs = create_random_id_based_dataset(npoints=10)
+        bs.store(self.ids[:10], updated_arrs, self.loc)
+        id2arr.update({x: y for x, y in zip(self.ids[:10], updated_arrs)})
+
+        # Simulate a crash right after the compacted value file has been swapped in
+        batch_begin = (self.ids[0] - 1) // bs.BATCH_SIZE * bs.BATCH_SIZE + 1
+        batch_part = "{}-{}".format(batch_begin, batch_begin + bs.BATCH_SIZE - 1)
+        index_filename = os.path.join(self.loc, bs.INDEX_PREFIX + batch_part)
+        value_filename = os.path.join(self.loc, bs.VALUE_PREFIX + batch_part)
+        original_replace = os.replace
+
+        def crashing_replace(src, dst):
+            if dst == index_filename and os.path.basename(src).startswith(bs.COMPACT_PREFIX):
+                raise KeyboardInterrupt()
+            original_replace(src, dst)
+
+        os.replace = crashing_replace
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                bs._compact_batch(index_filename, value_filename)
+        finally:
+            os.replace = original_replace
+
+        bs.compact(self.loc)
+        self.assertFalse(any(x.startswith(bs.COMPACT_PREFIX) for x in os.listdir(self.loc)))
+        self._assert_retrievable(id2arr)
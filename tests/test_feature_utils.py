@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+from uuid import uuid4
+
+import django
+from django.test import TestCase
+
+import numpy as np
+
+
+django.setup()
+
+
+class FakeDataMatrix:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_sids_path(self):
+        return os.path.join(self.folder, "dm.ids")
+
+    def get_bytes_path(self):
+        return os.path.join(self.folder, "dm.bytes")
+
+    def get_cols_path(self):
+        return os.path.join(self.folder, "dm.cols")
+
+
+class FeatureUtilsTest(TestCase):
+    def setUp(self):
+        self.folder = "/tmp/{}".format(uuid4().hex)
+        os.mkdir(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_update_datamatrix_removes_rows(self):
+        from koe.feature_utils import _update_datamatrix
+        from koe.ts_utils import bytes_to_ndarray, get_rawdata_from_binary, ndarray_to_bytes
+
+        dm = FakeDataMatrix(self.folder)
+        sids = np.arange(100, 120, dtype=np.int32)
+        data = np.random.rand(20, 5).astype(np.float32)
+        ndarray_to_bytes(sids, dm.get_sids_path())
+        ndarray_to_bytes(data, dm.get_bytes_path())
+        with open(dm.get_cols_path(), "w", encoding="utf-8") as f:
+            json.dump(dict(a=(0, 2), b=(2, 5)), f)
+
+        self.assertFalse(_update_datamatrix(dm, sids, [], [], [], []))
+
+        kept_sids = np.delete(sids, [0, 3, 4, 18])
+        self.assertTrue(_update_datamatrix(dm, kept_sids, [], [], [], []))
+
+        new_sids = bytes_to_ndarray(dm.get_sids_path(), np.int32)
+        new_data = get_rawdata_from_binary(dm.get_bytes_path(), len(new_sids))
+        self.assertEqual(sorted(new_sids), kept_sids.tolist())
+        self.assertEqual(os.path.getsize(dm.get_bytes_path()), 16 * 5 * 4)
+        self.assertTrue(np.array_equal(new_data, data[new_sids - 100]))
+
+
+class ReconstructDependantsTest(TestCase):
+    def test_reconstruct_stale_dependants(self):
+        from koe.feature_utils import reconstruct_stale_dependants
+        from koe.models import Database, DataMatrix, Ordination, SimilarityIndex
+        from koe.ts_utils import bytes_to_ndarray, ndarray_to_bytes
+        from root.models import User
+
+        user = User.objects.create(username="reconstruct_test", email="reconstruct_test@example.com")
+        database = Database.objects.create(name="reconstruct_test")
+        dm = DataMatrix.objects.create(name="reconstruct_test", database=database, features_hash="1", ndims=4)
+        ord = Ordination.objects.create(dm=dm, method="pca", ndims=2, stale=True)
+        ord_sim = SimilarityIndex.objects.create(dm=dm, ord=ord, stale=True)
+        dm_sim = SimilarityIndex.objects.create(dm=dm, stale=True)
+        fresh_ord = Ordination.objects.create(dm=dm, method="ica", ndims=2)
+
+        sids = np.arange(1, 31, dtype=np.int32)
+        ndarray_to_bytes(sids, dm.get_sids_path())
+        ndarray_to_bytes(np.random.rand(30, 4).astype(np.float32), dm.get_bytes_path())
+
+        try:
+            reconstruct_stale_dependants(dm, user, send_email=None, raise_err=True)
+
+            for obj in [ord, ord_sim, dm_sim]:
+                obj.refresh_from_db()
+                self.assertFalse(obj.stale)
+                self.assertEqual(obj.task.user, user)
+                self.assertTrue(obj.task.is_completed())
+                self.assertEqual(bytes_to_ndarray(obj.get_sids_path(), np.int32).tolist(), sids.tolist())
+
+            # Only the stale ones are reconstructed
+            fresh_ord.refresh_from_db()
+            self.assertIsNone(fresh_ord.task)
+        finally:
+            for obj in [dm, ord, ord_sim, dm_sim]:
+                for path in [obj.get_sids_path(), obj.get_bytes_path()]:
+                    if os.path.isfile(path):
+                        os.remove(path)
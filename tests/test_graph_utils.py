@@ -0,0 +1,83 @@
+import django
+from django.test import TestCase
+
+import numpy as np
+
+
+django.setup()
+
+
+class GraphUtilsTest(TestCase):
+    def test_extract_graph_edges(self):
+        from koe.graph_utils import count_bigrams, extract_graph_edges, extract_graph_properties
+
+        nlabels = 6
+        enum2label = {x: str(x) for x in range(1, nlabels)}
+        song_lengths = [5, 1, 8, 3, 12]
+        labels = np.random.randint(1, nlabels, sum(song_lengths))
+        labels[: nlabels - 1] = np.arange(1, nlabels)
+        song_starts = np.concatenate(([0], np.cumsum(song_lengths)))
+        song_sequences = {i: labels[x:y].tolist() for i, (x, y) in enumerate(zip(song_starts[:-1], song_starts[1:]))}
+
+        expected_edges, node_dict = extract_graph_properties(song_sequences, enum2label)
+        edges, nodes = extract_graph_edges(*count_bigrams(labels, song_starts, nlabels))
+
+        self.assertEqual(nodes, sorted(node_dict.keys()))
+        self.assertEqual([x[:2] for x in edges], [x[:2] for x in expected_edges])
+        for (_, _, attrs), (_, _, expected_attrs) in zip(edges, expected_edges):
+            self.assertEqual(attrs["weight"], expected_attrs["weight"])
+            self.assertAlmostEqual(attrs["distance"], expected_attrs["distance"])
+
+    def test_count_bigrams_skips_unlabelled(self):
+        from koe.graph_utils import count_bigrams
+
+        labels = np.array([1, 2, -1, 2, 1, 1, 2])
+        counts, link_codes = count_bigrams(labels, [0, 5, 7], 3)
+
+        self.assertEqual(counts.tolist(), [[0, 0, 0], [0, 0, 2], [0, 1, 0]])
+        self.assertEqual(link_codes.tolist(), [1 * 3 + 2, 2 * 3 + 1])
+
+    def test_get_class_of_sids(self):
+        from koe.cluster_analysis_utils import SimpleNameMerger, get_class_of_sids, merge_labels
+
+        sids = np.array([40, 10, 30, 20, 50])
+        classes_info = [[1, 3], [0, 4], [2]]
+        clusters = np.array([1, 0, 1])
+        enum2label = {0: "a", 1: "b", 2: "c"}
+        sid_to_cluster, merged_enum2label = merge_labels(
+            clusters, classes_info, sids, enum2label, SimpleNameMerger().merge
+        )
+
+        lookup_sids = np.array([50, 60, 20, 10, 30])
+        classes = get_class_of_sids(sids, classes_info, len(clusters), lookup_sids)
+        self.assertEqual(classes.tolist(), [1, -1, 0, 0, 2])
+        self.assertEqual(
+            [clusters[x] + 1 for x, sid in zip(classes, lookup_sids) if x >= 0],
+            [sid_to_cluster[x] for x in lookup_sids if x in sid_to_cluster],
+        )
+        self.assertEqual(merged_enum2label, {2: "a -&- c", 1: "b"})
+
+    def test_reference_stats(self):
+        import networkx as nx
+
+        from koe.graph_utils import _reference_stats_cache, get_reference_stats, measure_graph, resolve_meas
+
+        graph = nx.connected_watts_strogatz_graph(20, 4, 0.2, seed=1)
+        _reference_stats_cache.clear()
+        stats = get_reference_stats(graph, 4, 2, seed=42)
+        _reference_stats_cache.clear()
+        self.assertEqual(stats, get_reference_stats(graph, 4, 2, seed=42))
+
+        # Same degree sequence: the references are reused
+        relabelled = nx.relabel_nodes(graph, {x: 100 - x for x in graph.nodes})
+        self.assertEqual(stats, get_reference_stats(relabelled, 4, 2, seed=42))
+        self.assertEqual(len(_reference_stats_cache), 1)
+
+        measurements_order, measurements_output = resolve_meas("small_world_measures")
+        self.assertEqual(measurements_output, ["Omega", "Sigma"])
+        timings = {}
+        meas = measure_graph(
+            list(graph.edges), list(graph.nodes), measurements_order, timings, nrand=4, niter=2, seed=42
+        )
+        self.assertEqual(set(meas.keys()), {"Omega", "Sigma"})
+        self.assertEqual(list(timings.keys()), ["_get_small_world_measures"])
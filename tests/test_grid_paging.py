@@ -0,0 +1,92 @@
+import datetime
+
+import django
+from django.test import TestCase
+
+
+django.setup()
+
+
+class GridPagingTest(TestCase):
+    def test_filter_kwargs(self):
+        from root.exceptions import CustomAssertionError
+        from root.views import get_filter_kwargs
+
+        self.assertEqual(get_filter_kwargs("name", "String", "^a.*"), {"name__iregex": "^a.*"})
+        self.assertEqual(get_filter_kwargs("name", "String", " "), {})
+        self.assertEqual(get_filter_kwargs("x", "Number", ">=2.5"), {"x__gte": 2.5})
+        self.assertEqual(get_filter_kwargs("x", "Number", "<3"), {"x__lt": 3})
+        self.assertEqual(get_filter_kwargs("x", "Number", "==3"), {"x": 3})
+        self.assertEqual(get_filter_kwargs("x", "Number", "7"), {"x": 7})
+        self.assertEqual(get_filter_kwargs("x", "Number", "[1,2,3]"), {"x__in": [1, 2, 3]})
+        self.assertEqual(get_filter_kwargs("x", "Number", "1..5"), {"x__gt": 1, "x__lt": 5})
+        self.assertEqual(get_filter_kwargs("x", "Number", "1++5"), {"x__gte": 1, "x__lte": 5})
+        self.assertEqual(get_filter_kwargs("b", "Boolean", "true"), {"b": True})
+        self.assertEqual(
+            get_filter_kwargs("d", "Date", "from(2018-01-02)to(2019-03-04)"),
+            {"d__gte": datetime.date(2018, 1, 2), "d__lte": datetime.date(2019, 3, 4)},
+        )
+        self.assertEqual(get_filter_kwargs("d", "Date", "to(2019-03-04)"), {"d__lte": datetime.date(2019, 3, 4)})
+
+        with self.assertRaises(CustomAssertionError):
+            get_filter_kwargs("x", "Number", "abc")
+        with self.assertRaises(CustomAssertionError):
+            get_filter_kwargs("d", "Date", "yesterday")
+
+    def test_numeric_value_regex(self):
+        import re
+
+        from root.views import numeric_value_regex
+
+        for value in ["3", "-2.5", "+.5", "1e-3", "4.", " 7 "]:
+            self.assertIsNotNone(re.match(numeric_value_regex, value), value)
+        for value in ["", " ", "abc", "1.2.3", "-", "1e", "12 cm"]:
+            self.assertIsNone(re.match(numeric_value_regex, value), value)
+
+    def test_page_window(self):
+        from root.exceptions import CustomAssertionError
+        from root.views import get_page_ids, max_page_size
+
+        table = dict(scoper=lambda objs, extras: objs, columns=[])
+        for offset, limit in [(-1, 10), (0, 0), (0, -5), (0, max_page_size + 1)]:
+            with self.assertRaises(CustomAssertionError):
+                get_page_ids(None, table, None, offset, limit)
+
+
+class GridPagingDbTest(TestCase):
+    def test_number_extra_attr(self):
+        from dotmap import DotMap
+
+        from koe.models import AudioFile, AudioTrack, Database, Individual, Segment
+        from root.models import ExtraAttr, ExtraAttrValue, User, ValueTypes
+        from root.views import _annotate_column
+
+        user = User.objects.create(username="grid_paging_test", email="grid_paging_test@example.com")
+        database = Database.objects.create(name="grid_paging_test")
+        audio_file = AudioFile.objects.create(
+            name="grid_paging_test",
+            fs=48000,
+            length=1000,
+            noc=1,
+            database=database,
+            individual=Individual.objects.create(name="grid_paging_test"),
+            track=AudioTrack.objects.create(name="grid_paging_test", date=datetime.date(2020, 1, 1)),
+            added=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        attr = ExtraAttr.objects.create(klass=Segment.__name__, name="grid_paging_test", type=ValueTypes.SHORT_TEXT)
+        values = ["10", "", "abc", "-2.5", None]
+        segs = []
+        for i, value in enumerate(values):
+            seg = Segment.objects.create(audio_file=audio_file, start_time_ms=i * 10, end_time_ms=i * 10 + 5)
+            if value is not None:
+                ExtraAttrValue.objects.create(attr=attr, owner_id=seg.id, user=user, value=value)
+            segs.append(seg)
+
+        column = dict(slug="grid_paging_test", sql=None, is_extra_attr=True, filter="Number")
+        objs = Segment.objects.filter(audio_file=audio_file)
+        objs, lookup = _annotate_column(objs, column, DotMap(user=user))
+
+        # Values that aren't numbers are treated as missing instead of failing the cast
+        sid_to_value = dict(objs.values_list("id", lookup))
+        self.assertEqual([sid_to_value[x.id] for x in segs], [10, None, None, -2.5, None])
+        self.assertEqual(list(objs.filter(**{lookup + "__gt": 0}).values_list("id", flat=True)), [segs[0].id])
@@ -0,0 +1,199 @@
+import datetime
+import os
+import shutil
+from uuid import uuid4
+
+import numpy as np
+
+import django
+from django.test import TestCase
+
+
+django.setup()
+
+
+class LabelStoreTest(TestCase):
+    def test_lookup_labels(self):
+        from koe.label_store import lookup_labels
+
+        column = np.array([3, 5, 8, 13], dtype=np.int32), np.array([2, 0, 1, 2], dtype=np.int32), ["a", "b"]
+
+        labels = lookup_labels(column, [13, 5, 1, 3, 8, 20])
+        self.assertEqual(labels.tolist(), ["b", "", "", "b", "a", ""])
+
+        labels = lookup_labels(column, [8, 4], default="__NONE__")
+        self.assertEqual(labels.tolist(), ["a", "__NONE__"])
+
+        empty_column = np.array([], dtype=np.int32), np.array([], dtype=np.int32), []
+        self.assertEqual(lookup_labels(empty_column, [1, 2]).tolist(), ["", ""])
+
+
+class LabelColumnTest(TestCase):
+    def setUp(self):
+        from koe.models import AudioFile, AudioTrack, Database, Individual, Segment
+        from root.models import ExtraAttr, User, ValueTypes
+
+        self.annotator = User.objects.create(username="label_store_test", email="label_store_test@example.com")
+        self.database = Database.objects.create(name="label_store_test")
+        individual = Individual.objects.create(name="label_store_test")
+        track = AudioTrack.objects.create(name="label_store_test", date=datetime.date(2020, 1, 1))
+        self.audio_file = AudioFile.objects.create(
+            name="label_store_test",
+            fs=48000,
+            length=1000,
+            noc=1,
+            database=self.database,
+            individual=individual,
+            track=track,
+            added=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        self.segments = [
+            Segment.objects.create(audio_file=self.audio_file, start_time_ms=i * 10, end_time_ms=i * 10 + 5)
+            for i in range(5)
+        ]
+        self.attr, _ = ExtraAttr.objects.get_or_create(
+            klass=Segment.__name__, name="label", defaults=dict(type=ValueTypes.SHORT_TEXT)
+        )
+
+    def tearDown(self):
+        from koe.label_store import LABEL_STORE_FOLDER
+        from root.utils import data_path
+
+        shutil.rmtree(data_path(LABEL_STORE_FOLDER, str(self.database.id)), ignore_errors=True)
+
+    def _set_labels(self, segments, value):
+        from dotmap import DotMap
+
+        from koe.models import Segment
+
+        Segment._set_extra_(segments, "label", value, DotMap(user=self.annotator))
+
+    def test_update_label_columns(self):
+        from koe.label_store import _get_column_path, get_sid_to_label
+
+        path = _get_column_path(self.database.id, self.annotator.id, "label")
+        self._set_labels(self.segments[:2], "A")
+        self.assertEqual(
+            get_sid_to_label(self.database, self.annotator, "label"), {x.id: "A" for x in self.segments[:2]}
+        )
+
+        # Through the setter, the stored column is updated in place and not rebuilt
+        mtime = os.stat(path).st_mtime_ns
+        self._set_labels(self.segments[1:3], "B")
+        self.assertNotEqual(os.stat(path).st_mtime_ns, mtime)
+        expected = {self.segments[0].id: "A", self.segments[1].id: "B", self.segments[2].id: "B"}
+        self.assertEqual(get_sid_to_label(self.database, self.annotator, "label"), expected)
+
+    def test_rebuild(self):
+        from koe.label_store import _get_column_path, get_label_column, get_sid_to_label
+        from koe.models import Segment
+        from root.models import ExtraAttrValue
+
+        path = _get_column_path(self.database.id, self.annotator.id, "label")
+        self._set_labels(self.segments[:2], "A")
+        get_sid_to_label(self.database, self.annotator, "label")
+
+        # A single save removes the column
+        value = ExtraAttrValue.objects.get(owner_id=self.segments[0].id, user=self.annotator, attr=self.attr)
+        value.value = "C"
+        value.save()
+        self.assertFalse(os.path.isfile(path))
+        expected = {self.segments[0].id: "C", self.segments[1].id: "A"}
+        self.assertEqual(get_sid_to_label(self.database, self.annotator, "label"), expected)
+
+        # Values created without the setters
+        ExtraAttrValue.objects.bulk_create(
+            [ExtraAttrValue(owner_id=self.segments[4].id, user=self.annotator, attr=self.attr, value="D")]
+        )
+        expected[self.segments[4].id] = "D"
+        self.assertEqual(get_sid_to_label(self.database, self.annotator, "label"), expected)
+
+        # Segments added or removed
+        new_segment = Segment.objects.create(audio_file=self.audio_file, start_time_ms=100, end_time_ms=105)
+        self._set_labels([new_segment], "E")
+        expected[new_segment.id] = "E"
+        self.assertEqual(get_sid_to_label(self.database, self.annotator, "label"), expected)
+
+        Segment.objects.filter(id=self.segments[4].id).delete()
+        ExtraAttrValue.objects.filter(owner_id=self.segments[4].id).delete()
+        del expected[self.segments[4].id]
+        self.assertEqual(get_sid_to_label(self.database, self.annotator, "label"), expected)
+
+        # Unlabelled segment removed
+        Segment.objects.filter(id=self.segments[3].id).delete()
+        sids, enums, names = get_label_column(self.database, self.annotator, "label")
+        remaining_sids = [x.id for x in self.segments[:3]] + [new_segment.id]
+        self.assertEqual(sids.tolist(), remaining_sids)
+        self.assertEqual(names, ["A", "C", "E"])
+
+    def test_column_lock(self):
+        import threading
+
+        from koe.label_store import _get_column_path, _lock_column, remove_label_columns
+
+        path = _get_column_path(self.database.id, self.annotator.id, "label")
+        self._set_labels(self.segments[:2], "A")
+
+        # An update waits for the column to be unlocked
+        updated = threading.Event()
+
+        def update():
+            with _lock_column(path):
+                updated.set()
+
+        with _lock_column(path):
+            thread = threading.Thread(target=update)
+            thread.start()
+            self.assertFalse(updated.wait(0.2))
+        thread.join()
+        self.assertTrue(updated.is_set())
+
+        # Lock files outlive their columns, so that no two processes ever lock different files for the same column
+        remove_label_columns(self.annotator)
+        self.assertFalse(os.path.isfile(path))
+        self.assertTrue(os.path.isfile("{}.lock".format(path)))
+
+    def test_metadata_version(self):
+        from koe.label_store import _get_column_path, get_label_column
+        from koe.models import AudioFile, Database, Individual, Segment
+        from koe.ts_utils import get_metadata_version, metadata_label_levels
+        from root.models import ExtraAttrValue
+
+        sids_path = "/tmp/{}.ids".format(uuid4().hex)
+        open(sids_path, "wb").close()
+
+        self._set_labels(self.segments[:2], "A")
+
+        # Without the label columns there's no version, until building the metadata builds them
+        self.assertIsNone(get_metadata_version(sids_path, self.annotator, self.database))
+        for level in metadata_label_levels:
+            get_label_column(self.database, self.annotator, level)
+        version = get_metadata_version(sids_path, self.annotator, self.database)
+        self.assertIsNotNone(version)
+        self.assertEqual(version, get_metadata_version(sids_path, self.annotator, self.database))
+
+        self._set_labels(self.segments[:1], "B")
+        new_version = get_metadata_version(sids_path, self.annotator, self.database)
+        self.assertNotEqual(version, new_version)
+
+        Individual.objects.filter(id=self.audio_file.individual_id).update(gender="F")
+        version = get_metadata_version(sids_path, self.annotator, self.database)
+        self.assertNotEqual(new_version, version)
+
+        # Labels in other databases don't matter
+        other_database = Database.objects.create(name="label_store_test_other")
+        other_audio_file = AudioFile.objects.get(id=self.audio_file.id)
+        other_audio_file.id = None
+        other_audio_file.database = other_database
+        other_audio_file.save()
+        other_segment = Segment.objects.create(audio_file=other_audio_file, start_time_ms=0, end_time_ms=5)
+        self._set_labels([other_segment], "A")
+        self.assertEqual(version, get_metadata_version(sids_path, self.annotator, self.database))
+
+        # A single save removes the column, which isn't rebuilt just to tell the version
+        value = ExtraAttrValue.objects.get(owner_id=self.segments[0].id, user=self.annotator, attr=self.attr)
+        value.value = "C"
+        value.save()
+        self.assertIsNone(get_metadata_version(sids_path, self.annotator, self.database))
+        self.assertFalse(os.path.isfile(_get_column_path(self.database.id, self.annotator.id, "label")))
+        os.remove(sids_path)
@@ -0,0 +1,84 @@
+import os
+import shutil
+
+import django
+from django.test import TestCase, override_settings
+
+import numpy as np
+
+
+django.setup()
+
+
+extracted_tids = []
+
+
+def fake_extractor(wav_file_path, fs, start, end, nfft, noverlap):
+    extracted_tids.append(start)
+    return np.full((3, end - start), start, dtype=np.float32)
+
+
+class S2SEncUtilsTest(TestCase):
+    # nfft and noverlap that no database uses, to not touch real cached spectrograms
+    nfft = 987
+    noverlap = 654
+
+    def setUp(self):
+        self.segs_info = [
+            (sid, sid, "/tmp/none.wav", 48000, sid, sid + 1 + sid % 4, self.nfft, self.noverlap)
+            for sid in range(1, 12)
+        ]
+        del extracted_tids[:]
+
+    def tearDown(self):
+        from koe.ml.s2senc_utils import get_spect_cache_loc
+
+        cache_loc = get_spect_cache_loc(fake_extractor, self.nfft, self.noverlap)
+        shutil.rmtree(os.path.dirname(cache_loc), ignore_errors=True)
+
+        # Also remove the parent folders if the test created them
+        try:
+            os.removedirs(os.path.dirname(os.path.dirname(cache_loc)))
+        except OSError:
+            pass
+
+    def _check_batches(self, batches, batch_size):
+        seen = set()
+        for batch_segs_info, spects, lengths, preprocessed in batches:
+            self.assertLessEqual(len(spects), batch_size)
+            self.assertEqual(preprocessed, max(lengths))
+            for seg_info, spect, length in zip(batch_segs_info, spects, lengths):
+                sid, tid, _, _, start, end, _, _ = seg_info
+                self.assertEqual(spect.shape, (end - start, 3))
+                self.assertEqual(length, end - start)
+                self.assertTrue(np.allclose(spect, start * 2))
+                seen.add(sid)
+        self.assertEqual(seen, set(x[0] for x in self.segs_info))
+
+    def test_iter_spect_batches(self):
+        from koe.ml.s2senc_utils import iter_spect_batches
+
+        def transform(spect):
+            return spect * 2
+
+        def preprocess(spects):
+            return max(len(x) for x in spects)
+
+        batches = iter_spect_batches(self.segs_info, fake_extractor, 4, transform, preprocess)
+        self._check_batches(batches, 4)
+
+        with override_settings(FEATURE_EXTRACTION_WORKERS=3):
+            batches = iter_spect_batches(self.segs_info, fake_extractor, 5, transform, preprocess)
+            self._check_batches(batches, 5)
+
+    def test_cache(self):
+        from koe.ml.s2senc_utils import iter_spects
+
+        spects = dict(iter_spects(self.segs_info[:6], fake_extractor, use_cache=True, window_size=4))
+        self.assertEqual(sorted(extracted_tids), list(range(1, 7)))
+
+        del extracted_tids[:]
+        cached_spects = dict(iter_spects(self.segs_info, fake_extractor, use_cache=True, window_size=4))
+        self.assertEqual(sorted(extracted_tids), list(range(7, 12)))
+        for seg_info, spect in spects.items():
+            self.assertTrue(np.allclose(spect, cached_spects[seg_info]))
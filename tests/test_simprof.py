@@ -0,0 +1,56 @@
+import django
+from django.test import TestCase
+
+import numpy as np
+from scipy.spatial.distance import pdist
+
+
+django.setup()
+
+
+class SimprofTest(TestCase):
+    def test_permuted_pdists(self):
+        from koe.management.abstract_commands.run_symprof import FeatureGroupPermuter, batch_pdist
+
+        measures = np.random.rand(30, 6) * 100
+        permuter = FeatureGroupPermuter(dict(a=(0, 2), b=(2, 3), c=(4, 6)))
+        permuted = permuter.permute_batch(measures, 20)
+        self.assertEqual(permuted.shape, (20, 30, 6))
+
+        for trial in permuted:
+            # Each group of columns is shuffled with the same order, column 3 isn't in any group so it stays unchanged
+            for start, end in [(0, 2), (2, 3), (4, 6)]:
+                row_inds = [np.where(measures[:, start] == x)[0][0] for x in trial[:, start]]
+                self.assertEqual(sorted(row_inds), list(range(30)))
+                self.assertTrue(np.array_equal(trial[:, start:end], measures[row_inds, start:end]))
+            self.assertTrue(np.array_equal(trial[:, 3], measures[:, 3]))
+
+        dists = batch_pdist(permuted)
+        for trial, trial_dists in zip(permuted, dists):
+            self.assertTrue(np.allclose(trial_dists, pdist(trial)))
+
+        np.random.seed(1)
+        dists = permuter.permuted_pdists(measures, 20)
+        np.random.seed(1)
+        self.assertTrue(np.allclose(dists, batch_pdist(permuter.permute_batch(measures, 20))))
+
+    def test_recursive_simprof(self):
+        from koe.management.abstract_commands.run_symprof import PcaPermuter, recursive_simprof
+
+        # Three well separated groups of classes
+        np.random.seed(0)
+        centres = np.array([[0, 0, 0, 0], [50, 0, 50, 0], [0, 50, 0, 50]])
+        measures = np.concatenate([centre + np.random.rand(10, 4) for centre in centres])
+        np.random.shuffle(measures)
+
+        clusters = []
+        recursive_simprof(measures, PcaPermuter(4), np.arange(30), clusters, min_cluster_size=5)
+
+        self.assertEqual(sorted(np.concatenate(clusters)), list(range(30)))
+
+        # The groups are always separated. Within a group a random split can still happen (as often as the
+        # significance level)
+        groups = [set(np.where(np.abs(measures - centre).max(axis=1) < 2)[0]) for centre in centres]
+        for cluster in clusters:
+            self.assertEqual(sum(set(cluster) <= group for group in groups), 1)
+        self.assertGreaterEqual(len(clusters), 3)
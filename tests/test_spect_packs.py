@@ -0,0 +1,61 @@
+import os
+import shutil
+
+import django
+from django.test import TestCase
+
+
+django.setup()
+
+
+class SpectPacksTest(TestCase):
+    # A page far beyond any real tid, to not touch existing spectrograms
+    page = 987654
+
+    def tearDown(self):
+        from koe.spect_packs import get_page_folder
+        from koe.utils import get_abs_spect_pack_path
+
+        shutil.rmtree(get_page_folder(self.page), ignore_errors=True)
+        pack_path = get_abs_spect_pack_path(self.page)
+        if os.path.isfile(pack_path):
+            os.remove(pack_path)
+
+    def test_pack_spectrograms(self):
+        from koe.spect_packs import pack_spectrograms, read_packed_spectrogram, read_spect_pack_index
+        from koe.utils import PAGE_CAPACITY, get_abs_spect_pack_path, get_abs_spect_path
+        from root.utils import ensure_parent_folder_exists
+
+        tids = [self.page * PAGE_CAPACITY + x for x in [17, 3, 999, 250]]
+        contents = {}
+        for tid in tids:
+            spect_path = get_abs_spect_path(tid)
+            ensure_parent_folder_exists(spect_path)
+            contents[tid] = os.urandom(100 + tid % 1000)
+            with open(spect_path, "wb") as f:
+                f.write(contents[tid])
+
+        self.assertEqual(pack_spectrograms(self.page), len(tids))
+
+        index = read_spect_pack_index(self.page)
+        self.assertEqual(index["tid"].tolist(), sorted(tids))
+        for tid in tids:
+            self.assertEqual(read_packed_spectrogram(tid), contents[tid])
+
+        # The data of the last spectrogram ends the file
+        last = index[-1]
+        self.assertEqual(os.path.getsize(get_abs_spect_pack_path(self.page)), last["offset"] + last["length"])
+
+        self.assertIsNone(read_packed_spectrogram(self.page * PAGE_CAPACITY + 4))
+
+        # Removing a spectrogram and repacking drops it from the pack
+        os.remove(get_abs_spect_path(tids[0]))
+        self.assertEqual(pack_spectrograms(self.page), len(tids) - 1)
+        self.assertIsNone(read_packed_spectrogram(tids[0]))
+        self.assertEqual(read_packed_spectrogram(tids[1]), contents[tids[1]])
+
+        # No spectrogram left: no pack
+        for tid in tids[1:]:
+            os.remove(get_abs_spect_path(tid))
+        self.assertEqual(pack_spectrograms(self.page), 0)
+        self.assertIsNone(read_spect_pack_index(self.page))
@@ -0,0 +1,65 @@
+import os
+from uuid import uuid4
+
+import django
+from django.test import TestCase, override_settings
+
+import numpy as np
+
+
+django.setup()
+
+
+def square(work_item, shared):
+    return work_item**2 + shared["offset"]
+
+
+class TrialUtilsTest(TestCase):
+    def setUp(self):
+        self.checkpoint_file = "/tmp/{}.checkpoint".format(uuid4().hex)
+
+    def tearDown(self):
+        if os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def test_checkpoint(self):
+        from koe.trial_utils import TrialCheckpoint, run_trials
+
+        work_items = [(x, x) for x in range(10)]
+        checkpoint = TrialCheckpoint(self.checkpoint_file, "run 1")
+        results = dict(run_trials(square, work_items[:6], dict(offset=1), checkpoint))
+        self.assertEqual(results, {x: x**2 + 1 for x in range(6)})
+
+        # Simulate a run killed while writing its last result
+        with open(self.checkpoint_file, "ab") as f:
+            f.write(b"\x80\x04\x95")
+
+        # Resumed: the stored results are reused even though the offset is different now
+        checkpoint = TrialCheckpoint(self.checkpoint_file, "run 1")
+        self.assertEqual(len(checkpoint), 6)
+        with override_settings(EVALUATION_WORKERS=2):
+            results = dict(run_trials(square, work_items, dict(offset=2), checkpoint))
+        self.assertEqual(results, {x: x**2 + (1 if x < 6 else 2) for x in range(10)})
+        self.assertEqual(len(TrialCheckpoint(self.checkpoint_file, "run 1")), 10)
+
+        # A different run starts over
+        self.assertEqual(len(TrialCheckpoint(self.checkpoint_file, "run 2")), 0)
+
+    def test_seeded_run_nfolds(self):
+        from koe.ml_utils import classifiers, run_nfolds
+        from koe.trial_utils import TrialCheckpoint
+
+        data = np.random.rand(60, 4)
+        enum_labels = np.repeat(np.arange(3), 20)
+        data[:, 0] += enum_labels
+        args = (data, len(data), 5, 2, enum_labels, 3, classifiers["rf"], None, 42)
+
+        scores, hitrates, importances = run_nfolds(*args, n_estimators=5)
+        self.assertEqual(len(scores), 10)
+        self.assertEqual(importances.shape, (10, 4))
+
+        checkpoint = TrialCheckpoint(self.checkpoint_file)
+        self.assertEqual(scores, run_nfolds(*args, checkpoint, "all", n_estimators=5)[0])
+        self.assertEqual(len(checkpoint), 10)
+
+        self.assertEqual(scores, run_nfolds(*args, TrialCheckpoint(self.checkpoint_file), "all", n_estimators=5)[0])
@@ -1,3 +1,4 @@
+import json
 import os
 from uuid import uuid4
 
@@ -24,6 +25,42 @@ class TsUtilsTest(TestCase):
 
         self.assertTrue(np.allclose(arr, arr_))
 
+    def test_columnar(self):
+        django.setup()
+        from koe.ts_utils import columnar_to_ndarray, ndarray_to_columnar
+
+        arr = np.random.rand(100, 20).astype(np.float32)
+        col_inds = {"a": (0, 3), "b": (3, 4), "c": (4, 12), "d": (12, 20)}
+        filename = "/tmp/{}.columns".format(uuid4().hex)
+
+        ndarray_to_columnar(arr, col_inds, filename)
+
+        self.assertTrue(np.allclose(arr, columnar_to_ndarray(filename)))
+
+        rows = np.array([5, 0, 99, 42])
+        expected = np.concatenate((arr[rows, 12:20], arr[rows, 0:3]), axis=1)
+        self.assertTrue(np.allclose(expected, columnar_to_ndarray(filename, ["d", "a"], rows)))
+
+        with self.assertRaises(ValueError):
+            columnar_to_ndarray(filename, ["e"])
+
+        os.remove(filename)
+
+    def test_write_metadata_columns(self):
+        django.setup()
+        from koe.ts_utils import write_metadata_columns
+
+        headers = ["id", "tid", "label", "sex"]
+        metadata = {3: ["3", "30", "b", "m"], 1: ["1", "10", "a", "f"], 2: ["2", "20", "b", "m"]}
+        sids = [2, 3, 1]
+
+        meta = json.loads(write_metadata_columns(metadata, sids, headers))
+        self.assertEqual(meta["headers"], headers)
+        self.assertEqual(meta["ids"], [2, 3, 1])
+        self.assertEqual(meta["tids"], [20, 30, 10])
+        for col_ind, column in enumerate(meta["columns"], 2):
+            self.assertEqual([column["values"][x] for x in column["indices"]], [metadata[x][col_ind] for x in sids])
+
     def test_pca(self):
         django.setup()
         from koe.models import Aggregation, Database, Feature, FullTensorData
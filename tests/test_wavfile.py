@@ -1,10 +1,15 @@
 import contextlib
 import os
+import struct
 import wave
 from logging import warning
+from uuid import uuid4
 
 from django.test import TestCase
 
+import numpy as np
+from scipy.io import wavfile as scipy_wavfile
+
 from koe import wavfile
 
 
@@ -41,3 +46,63 @@ class WavfileTest(TestCase):
         for idx, af_file_path in enumerate(files_to_test):
             print("Testing {}/{}: {}".format(idx + 1, n_files_to_test, af_file_path))
             self._test_single_file(af_file_path)
+
+    def test_change_rate(self):
+        filepath = "tests/example 1.wav"
+        new_filepath = "/tmp/{}.wav".format(uuid4().hex)
+
+        fs, length = wavfile.get_wav_info(filepath)
+        wavfile.change_rate(filepath, fs * 2, new_filepath)
+
+        new_fs, new_length = wavfile.get_wav_info(new_filepath)
+        self.assertEqual(new_fs, fs * 2)
+        self.assertEqual(new_length, length)
+
+        data = wavfile.read_segment(filepath, normalised=False)
+        new_data = wavfile.read_segment(new_filepath, normalised=False)
+        os.remove(new_filepath)
+
+        self.assertTrue(np.array_equal(data, new_data))
+
+    def test_change_rate_extensible(self):
+        filepath = "/tmp/{}.wav".format(uuid4().hex)
+        new_filepath = "/tmp/{}.wav".format(uuid4().hex)
+
+        # 24-bit stereo PCM in a WAVE_FORMAT_EXTENSIBLE format chunk
+        data = np.random.randint(-(2**23), 2**23, (1001, 2)).astype("<i4")
+        data_bytes = b"".join(x.tobytes()[:3] for x in data.ravel())
+        sub_format = struct.pack("<H", 1) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+        fmt_chunk = struct.pack("<HHIIHHHHI", 0xFFFE, 2, 44100, 44100 * 6, 6, 24, 22, 24, 3) + sub_format
+        with open(filepath, "wb") as f:
+            f.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt_chunk) + 8 + len(data_bytes)) + b"WAVE")
+            f.write(b"fmt " + struct.pack("<I", len(fmt_chunk)) + fmt_chunk)
+            f.write(b"data" + struct.pack("<I", len(data_bytes)) + data_bytes)
+
+        wavfile.change_rate(filepath, 22050, new_filepath)
+        with contextlib.closing(wave.open(new_filepath, "r")) as f:
+            self.assertEqual(f.getframerate(), 22050)
+            self.assertEqual(f.getnchannels(), 2)
+            self.assertEqual(f.getsampwidth(), 3)
+            self.assertEqual(f.readframes(f.getnframes()), data_bytes)
+
+        new_data = wavfile.read_segment(new_filepath, normalised=False)
+        os.remove(filepath)
+        os.remove(new_filepath)
+        self.assertTrue(np.array_equal(data, new_data.reshape(data.shape)))
+
+    def test_float_to_pcm(self):
+        filepath = "/tmp/{}.wav".format(uuid4().hex)
+        new_filepath = "/tmp/{}.wav".format(uuid4().hex)
+
+        data = np.random.uniform(-1, 1, (10000, 2)).astype(np.float32)
+        data[0] = [1, -1]
+        scipy_wavfile.write(filepath, 44100, data)
+
+        wavfile.float_to_pcm(filepath, new_filepath)
+        new_fs, new_data = scipy_wavfile.read(new_filepath)
+        os.remove(filepath)
+        os.remove(new_filepath)
+
+        self.assertEqual(new_fs, 44100)
+        self.assertEqual(new_data.dtype, np.int32)
+        self.assertTrue(np.allclose(data, new_data / (2**31 - 1), atol=1e-6))